@@ -1,17 +1,28 @@
 # -*- coding: UTF-8 -*-
 
 import os
-import subprocess
-import pandas as pd
-import argparse
 import re
+import sys
+import json
+import shlex
+import shutil
+import hashlib
+import argparse
+import tempfile
+import threading
 import traceback
+import subprocess
 import numpy as np
+import pandas as pd
+from time import time
 from typing import List
+from concurrent.futures import ThreadPoolExecutor
 
 
 # Repeat experiments with different random seeds and save results to csv
 # Example: python exp.py --in_f run.sh --out_f exp.csv --n 5
+# Jobs (command x seed) can run concurrently, each on its own set of cores: python exp.py --n 5 --n_jobs 4
+# Results of every job are kept in a json file next to the csv, so that an interrupted sweep resumes where it stopped.
 
 def parse_args():
     parser = argparse.ArgumentParser(description="Run")
@@ -30,7 +41,17 @@ def parse_args():
     parser.add_argument('--skip', type=int, default=0,
                         help='skip number.')
     parser.add_argument('--gpu', type=str, default='0',
-                        help='Set CUDA_VISIBLE_DEVICES')
+                        help='Set CUDA_VISIBLE_DEVICES (comma-separated GPUs are assigned to concurrent jobs in turn)')
+    parser.add_argument('--n_jobs', type=int, default=1,
+                        help='Number of concurrent jobs (0: as many as the available cores allow with --threads).')
+    parser.add_argument('--threads', type=int, default=0,
+                        help='CPU threads (and pinned cores) of each job (0: available cores / n_jobs).')
+    parser.add_argument('--retries', type=int, default=1,
+                        help='Times to retry a failed job.')
+    parser.add_argument('--stack_seeds', type=int, default=0,
+                        help='Train the n seeds of each command in one job (main.py --n_seeds, stackable models).')
+    parser.add_argument('--prepare_corpus', type=int, default=1,
+                        help='Build the corpus cache of each dataset once before starting concurrent jobs.')
     return parser.parse_args()
 
 
@@ -50,86 +71,307 @@ def find_info(result: List[str]) -> dict:
     return info
 
 
+def read_result_file(result_file: str) -> dict:
+    """
+    Structured results saved by main.py --result_file (empty if the command did not write them)
+    """
+    if not os.path.isfile(result_file):
+        return dict()
+    with open(result_file) as f:
+        result = json.load(f)
+    if 'seeds' in result:  # several seeds trained at once
+        return {'seeds': {str(r['seed']): seed_info(r) for r in result['seeds']}}
+    return seed_info(result)
+
+
+def seed_info(result: dict) -> dict:
+    info = {'Test': ','.join('{}:{:<.4f}'.format(k, v) for k, v in result['test'].items())}
+    if result.get('best_iter') is not None:
+        info['Best Iter'] = str(result['best_iter'])
+        info['Time'] = '{:<.1f}'.format(result['train_time'])
+    return info
+
+
+def available_cpus() -> List[int]:
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+class Slot(object):
+    """
+    Resources of one concurrent job: pinned cores, thread count and GPU (None: the GPU given by the command)
+    """
+    def __init__(self, cpus: List[int], gpu: str = None):
+        self.cpus = cpus
+        self.gpu = gpu
+
+    def env(self) -> dict:
+        env = dict(os.environ)
+        if len(self.cpus):
+            for var in ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS']:
+                env[var] = str(len(self.cpus))
+        return env
+
+    def wrap(self, command: str) -> str:
+        # taskset pins the shell before it starts the job, so that all the threads and processes of the job
+        # (e.g., OpenMP pools, DataLoader workers) inherit the cores
+        if len(self.cpus) and shutil.which('taskset') is not None:
+            return 'taskset -c {} /bin/sh -c {}'.format(','.join(str(c) for c in self.cpus), shlex.quote(command))
+        return command
+
+    def pin(self, pid: int):
+        # without taskset: pin the shell right after it started (threads created before are not covered)
+        if len(self.cpus) and shutil.which('taskset') is None and hasattr(os, 'sched_setaffinity'):
+            try:
+                os.sched_setaffinity(pid, self.cpus)
+            except OSError:  # the job already exited
+                pass
+
+
+def make_slots(n_jobs: int, threads: int, gpu: str) -> List[Slot]:
+    cpus = available_cpus()
+    if n_jobs <= 0:
+        n_jobs = max(1, len(cpus) // threads) if threads > 0 else len(cpus)
+    gpus = gpu.split(',') if ',' in gpu and n_jobs > 1 else [None]
+    if n_jobs == 1 and threads <= 0:  # a single job keeps the whole machine, as in sequential runs
+        return [Slot([])]
+    threads = threads if threads > 0 else max(1, len(cpus) // n_jobs)
+    slots = list()
+    for i in range(n_jobs):
+        start = (i * threads) % len(cpus)
+        slot_cpus = [cpus[(start + j) % len(cpus)] for j in range(min(threads, len(cpus)))]
+        slots.append(Slot(slot_cpus, gpus[i % len(gpus)]))
+    return slots
+
+
+def job_command(cmd: str, seed: int, gpu: str) -> str:
+    command = cmd
+    if command.find(' --random_seed') == -1:
+        command += ' --random_seed ' + str(seed)
+    if command.find(' --gpu ') == -1:
+        command += ' --gpu ' + gpu
+    if '${random_seed}' in command:
+        command = command.replace('${random_seed}', str(seed))
+    return command
+
+
+def prepare_corpus(commands: List[str]):
+    """
+    Read each dataset once and save its corpus cache before concurrent jobs start: the jobs then open the same
+    memory-mapped cache files (shared pages) instead of all reading and saving the dataset at the same time.
+    Only the arrays used in place (ragged columns, user histories) are shared: each job still copies the
+    interaction columns into its own datasets (BaseModel.Dataset.data).
+    """
+    try:
+        import main  # models (and torch) are only imported here
+    except Exception:
+        traceback.print_exc()
+        print('Skip corpus preparation')
+        return
+    prepared = set()
+    for command in commands:
+        tokens = shlex.split(command)
+        main_idx = [i for i, t in enumerate(tokens) if t.endswith('main.py')]
+        if not len(main_idx):
+            continue
+        try:
+            _, args, model_name, reader_name, _ = main.parse_args(tokens[main_idx[0] + 1:])
+            key = (args.path, args.dataset, model_name.reader + args.data_appendix)
+            if key in prepared:
+                continue
+            args.regenerate = 0  # the jobs themselves regenerate if asked to
+            main.load_corpus(args, model_name, reader_name)
+            prepared.add(key)
+            print('Corpus ready: {}'.format(os.path.join(*key)))
+        except Exception:
+            traceback.print_exc()
+
+
+def run_job(command: str, slot: Slot, result_file: str) -> dict:
+    """
+    Run a command on the resources of slot
+    :return: parsed results, wall time, peak resident memory (of the largest process) and exit status
+    """
+    if 'main.py' in command and command.find(' --result_file') == -1:
+        command += ' --result_file ' + result_file
+    if os.path.exists(result_file):  # left by a failed attempt
+        os.remove(result_file)
+    start = time()
+    proc = subprocess.Popen(slot.wrap(command), shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                            env=slot.env())
+    slot.pin(proc.pid)
+    output = proc.stdout.read().decode('utf-8', errors='replace')
+    proc.stdout.close()
+    _, status, usage = os.wait4(proc.pid, 0)  # resource usage of this job only (including its reaped children)
+    proc.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+    lines = [line.strip() for line in output.split(os.linesep)]
+    info = find_info(lines)
+    info.update(read_result_file(result_file))
+    peak_kb = usage.ru_maxrss if sys.platform != 'darwin' else usage.ru_maxrss / 1024
+    info.update({
+        'Wall Time': '{:<.1f}'.format(time() - start),
+        'Peak Mem (MB)': '{:<.1f}'.format(peak_kb / 1024),
+        'returncode': proc.returncode,
+        'output_tail': lines[-20:],
+    })
+    return info
+
+
+class Sweep(object):
+    """
+    Records of all the jobs of a result file, saved as json (one record per command) and rendered to csv
+    """
+    columns = ['Model', 'Test', 'Best Iter', 'Time', 'Seed', 'Wall Time', 'Peak Mem (MB)', 'Status', 'Run CMD']
+
+    def __init__(self, csv_path: str, n: int):
+        self.csv_path = csv_path
+        self.json_path = os.path.splitext(csv_path)[0] + '.json'
+        self.n = n
+        self.records = dict()  # (run command, seed) -> record
+        self.lock = threading.Lock()
+        if os.path.isfile(self.json_path):
+            with open(self.json_path) as f:
+                for record in json.load(f):
+                    self.records[(record['Run CMD'], record['Seed'])] = record
+
+    def done(self, command: str, seed: str) -> bool:
+        key = (command, seed)
+        return key in self.records and self.records[key]['Status'] == 'ok'
+
+    def add(self, records: List[dict]):
+        with self.lock:
+            for record in records:
+                self.records[(record['Run CMD'], record['Seed'])] = record
+            self.save()
+
+    def save(self):
+        tmp_path = self.json_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(list(self.records.values()), f, indent=1)
+        os.replace(tmp_path, self.json_path)
+        self.to_frame().to_csv(self.csv_path, index=False)
+
+    def to_frame(self) -> pd.DataFrame:
+        # jobs of each command, the average of its seeds and three blank rows, commands in the order of the records
+        rows, groups = list(), dict()
+        for record in self.records.values():
+            groups.setdefault(record['cmd'], list()).append(record)
+        for cmd, records in groups.items():
+            records = sorted(records, key=lambda r: int(r['Seed']))
+            for record in records:
+                rows.append([str(record.get(c, '')) for c in self.columns])
+            tests = [r['Test'] for r in records if r['Status'] == 'ok' and r.get('Test', '') != '']
+            if self.n > 1 and len(tests) > 1:
+                info = {'Model': records[0]['Model']}
+                tests_tuple = [[(m.split(':')[0], float(m.split(':')[1])) for m in t.split(',')] for t in tests]
+                avgs = ['{}:{:<.4f}'.format(tests_tuple[0][mi][0], np.average([t[mi][1] for t in tests_tuple]))
+                        for mi in range(len(tests_tuple[0]))]
+                info['Test'] = ','.join(avgs)
+                iters = [int(r['Best Iter']) for r in records if r['Status'] == 'ok' and r.get('Best Iter', '') != '']
+                info['Best Iter'] = '%.1f' % (np.mean(iters)) if len(iters) else ''
+                info['Seed'] = 'avg of {}'.format(len(tests))
+                rows.append([info.get(c, '') for c in self.columns])
+            rows.extend([[''] * len(self.columns) for _ in range(3)])
+        return pd.DataFrame(rows, columns=self.columns)
+
+
 def main():
     args = parse_args()
-    columns = ['Model', 'Test', 'Best Iter', 'Time', 'Seed', 'Run CMD']
-    skip = args.skip
-    
-    df = pd.DataFrame(columns=columns)
-    # Read existing result record file
-    if os.path.isfile(os.path.join(args.log_dir, args.out_f)):
-        df = pd.read_csv(os.path.join(args.log_dir, args.out_f))
-        if (df.columns.to_numpy() != np.array(columns)).sum():
+    csv_path = os.path.join(args.log_dir, args.out_f)
+
+    if not os.path.exists(args.log_dir):
+        os.makedirs(args.log_dir)
+    sweep = Sweep(csv_path, args.n)
+    # Existing result file written by an older version, without job records
+    if os.path.isfile(csv_path) and not os.path.isfile(sweep.json_path):
+        df = pd.read_csv(csv_path)
+        if (df.columns.to_numpy() != np.array(Sweep.columns)).sum():
             overwrite = input('Warning! There exists a file also called %s with different format, overwrite it? y/n (default n)'%(args.out_f))
             if overwrite.lower().startswith('y'):
                 print("Overwrite %s"%(args.out_f))
-                df = pd.DataFrame(columns=columns)
             else:
                 exit(1)
 
-    if not os.path.exists(args.log_dir):
-        os.makedirs(args.log_dir)
     in_f = open(os.path.join(args.cmd_dir, args.in_f), 'r')
     lines = in_f.readlines()
 
-    # Iterate commands
+    # Jobs: commands x seeds
+    jobs, skip = list(), args.skip
     for cmd in lines:
         cmd = cmd.strip()
         if cmd == '' or cmd.startswith('#') or cmd.startswith('export'):
             continue
         p = re.compile('--model_name (\w+)')
         model_name = p.search(cmd).group(1)
-
-        # Repeat experiments
-        for i in range(args.base_seed, args.base_seed + args.n):
-            try:
-                command = cmd
-                if command.find(' --random_seed') == -1:
-                    command += ' --random_seed ' + str(i)
-                if command.find(' --gpu ') == -1:
-                    command += ' --gpu ' + args.gpu
-                if '${random_seed}' in command:
-                    command = command.replace('${random_seed}', str(i))
-                print(command)
-                if skip > 0:
-                    skip -= 1
-                    continue
-                result = subprocess.check_output(command, shell=True)
-                result = result.decode('utf-8')
-                result = [line.strip() for line in result.split(os.linesep)]
-                info = find_info(result)
-                info['Seed'] = str(i)
-                info['Run CMD'] = command
-                if args.n == 1:
-                    info['Model'] = model_name
-                row = [info[c] if c in info else '' for c in columns]
-                df.loc[len(df)] = row
-                df.to_csv(os.path.join(args.log_dir, args.out_f), index=False)
-                print(df[columns[:5]])
-            except Exception as e:
-                traceback.print_exc()
+        seeds = [str(i) for i in range(args.base_seed, args.base_seed + args.n)]
+        if args.stack_seeds and args.n > 1:
+            command = job_command(cmd, args.base_seed, args.gpu) + ' --n_seeds {}'.format(args.n)
+            job_seeds = [seeds]
+        else:
+            job_seeds = [[seed] for seed in seeds]
+        for job_seed in job_seeds:
+            if len(job_seed) == 1:
+                command = job_command(cmd, int(job_seed[0]), args.gpu)
+            if skip > 0:
+                skip -= 1
+                continue
+            if all(sweep.done(command, seed) for seed in job_seed):  # resume: finished in an earlier run
+                print('Done: ' + command)
                 continue
+            jobs.append({'cmd': cmd, 'Model': model_name, 'Seeds': job_seed, 'Run CMD': command})
+    if args.prepare_corpus and len(jobs):
+        prepare_corpus([job['Run CMD'] for job in jobs])
+
+    slots = make_slots(args.n_jobs, args.threads, args.gpu)
+    free_slots = list(range(len(slots)))
+    slot_lock = threading.Lock()
+    result_dir = tempfile.mkdtemp(prefix='exp-results-')
+
+    def execute(job: dict):
+        with slot_lock:
+            slot_id = free_slots.pop()
+        slot = slots[slot_id]
+        command = job['Run CMD']
+        if slot.gpu is not None and ' --gpu ' + args.gpu + ' ' in command + ' ':  # GPU added by job_command
+            command = (command + ' ').replace(' --gpu ' + args.gpu + ' ', ' --gpu ' + slot.gpu + ' ', 1).strip()
+        result_file = os.path.join(result_dir, hashlib.md5(command.encode('utf-8')).hexdigest() + '.json')
+        try:
+            for attempt in range(1 + args.retries):
+                print('[slot {}] {}'.format(slot_id, command))
+                try:
+                    info = run_job(command, slot, result_file)
+                except Exception:
+                    info = {'returncode': -1, 'output_tail': traceback.format_exc().splitlines()}
+                seed_infos = info.pop('seeds', {job['Seeds'][0]: {}} if len(job['Seeds']) == 1 else {})
+                ok = info['returncode'] == 0 and all(
+                    dict(info, **seed_infos.get(seed, {})).get('Test', '') != '' for seed in job['Seeds'])
+                if ok or attempt == args.retries:
+                    break
+                print('Retry ({}/{}): {}'.format(attempt + 1, args.retries, command))
+            records = list()
+            for seed in job['Seeds']:
+                record = {k: v for k, v in job.items() if k != 'Seeds'}
+                record.update(info)
+                record.update(seed_infos.get(seed, {}))
+                record['Seed'] = seed
+                record['Status'] = 'ok' if ok else 'failed'
+                record['Attempts'] = attempt + 1
+                records.append(record)
+            sweep.add(records)
+            if not ok:
+                print('Failed: {}{}{}'.format(command, os.linesep, os.linesep.join(info['output_tail'])))
+            with sweep.lock:
+                print(sweep.to_frame()[Sweep.columns[:8]])
+        finally:
+            with slot_lock:
+                free_slots.append(slot_id)
 
-        # Average results
-        if args.n > 1:
-            info = {'Model': model_name}
-            tests = df['Test'].tolist()[-args.n:]
-            tests_tuple =[[(m.split(':')[0],float(m.split(':')[1])) for m in t.split(',')] for t in tests]
-            # avgs = ['{}:{:<.4f}'.format(np.average([t[mi] for t in tests])) for mi in range(len(tests[0]))]
-            avgs = ['{}:{:<.4f}'.format(tests_tuple[0][mi][0],np.average([t[mi][1] for t in tests_tuple])) 
-				for mi in range(len(tests_tuple[0]))]
-            info['Test'] = ','.join(avgs)
-            epoch_avgs = np.mean([int(x) for x in df['Best Iter'].tolist()[-args.n:]])
-            info['Best Iter'] = "%.1f"%(epoch_avgs)
-            row = [info[c] if c in info else '' for c in columns]
-            df.loc[len(df)] = row
-            print(df[columns[:5]])
-        for i in range(3):
-            row = [''] * len(columns)
-            df.loc[len(df)] = row
-
-        # Save results
-        df.to_csv(os.path.join(args.log_dir, args.out_f), index=False)
+    with ThreadPoolExecutor(max_workers=len(slots)) as pool:
+        for future in [pool.submit(execute, job) for job in jobs]:
+            future.result()
+    sweep.save()
+    shutil.rmtree(result_dir, ignore_errors=True)
 
 
 if __name__ == '__main__':
@@ -8,7 +8,6 @@ import logging
 import numpy as np
 from time import time
 from tqdm import tqdm
-from torch.utils.data import DataLoader
 
 from utils import utils
 from models.BaseModel import BaseModel
@@ -20,19 +19,24 @@ class BUIRRunner(BaseRunner):
         model = dataset.model
         if model.optimizer is None:
             model.optimizer = self._build_optimizer(model)
-        dataset.actions_before_epoch()  # must sample before multi thread start
+        dl = self._train_loader(dataset)
 
         model.train()
         loss_lst = list()
-        dl = DataLoader(dataset, batch_size=self.batch_size, shuffle=True, num_workers=self.num_workers,
-                        collate_fn=dataset.collate_batch, pin_memory=self.pin_memory)
-        for batch in tqdm(dl, leave=False, desc='Epoch {:<3}'.format(epoch), ncols=100, mininterval=1):
-            batch = utils.batch_to_gpu(batch, model.device)
+        for batch in tqdm(self.timer.iterate(dl, train=True), leave=False, desc='Epoch {:<3}'.format(epoch),
+                          ncols=100, mininterval=1):
+            with self.timer.phase('h2d'):
+                batch = utils.batch_to_gpu(batch, model.device)
             model.optimizer.zero_grad()
-            out_dict = model(batch)
-            loss = model.loss(out_dict)
-            loss.backward()
-            model.optimizer.step()
-            model._update_target()
+            with self.timer.phase('forward'):
+                out_dict = model(batch)
+            with self.timer.phase('loss'):
+                loss = model.loss(out_dict)
+            with self.timer.phase('backward'):
+                loss.backward()
+            with self.timer.phase('optimizer_step'):  # including the momentum update of the target encoders
+                model.optimizer.step()
+                model._update_target()
+            self._after_step(model)
             loss_lst.append(loss.detach().cpu().data.numpy())
         return np.mean(loss_lst).item()
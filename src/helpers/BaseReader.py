@@ -8,6 +8,8 @@ import numpy as np
 import pandas as pd
 
 from utils import utils
+from utils import corpus_cache
+from utils.ragged import RaggedArray
 
 
 class BaseReader(object):
@@ -26,19 +28,38 @@ class BaseReader(object):
         self.prefix = args.path
         self.dataset = args.dataset
         self._read_data()
+        self._collect_clicked_set()
 
-        self.train_clicked_set = dict()  # store the clicked item set of each user in training set
-        self.residual_clicked_set = dict()  # store the residual clicked item set of each user
-        for key in ['train', 'dev', 'test']:
-            df = self.data_df[key]
-            for uid, iid in zip(df['user_id'], df['item_id']):
-                if uid not in self.train_clicked_set:
-                    self.train_clicked_set[uid] = set()
-                    self.residual_clicked_set[uid] = set()
-                if key == 'train':
-                    self.train_clicked_set[uid].add(iid)
-                else:
-                    self.residual_clicked_set[uid].add(iid)
+    @classmethod
+    def load_corpus(cls, cache_dir: str, args):
+        """
+        Open the columnar corpus cache written by save_corpus (None if missing or out of date)
+        """
+        version = corpus_cache.data_version(args.path, args.dataset)
+        return corpus_cache.load(cls, cache_dir, version)
+
+    def save_corpus(self, cache_dir: str):
+        corpus_cache.save(self, cache_dir, corpus_cache.data_version(self.prefix, self.dataset))
+
+    def __reduce_ex__(self, protocol):
+        # a corpus with a cache is pickled by reference (e.g., sent to a spawned evaluation process),
+        # and memory-mapped again on the other side instead of being copied
+        source = self.__dict__.get(corpus_cache.SOURCE_ATTR)
+        if source is None:
+            return super().__reduce_ex__(protocol)
+        return corpus_cache.reopen, (type(self),) + tuple(source)
+
+    def _collect_clicked_set(self):
+        """
+        self.train_clicked_set: sorted clicked items of each user in training set, as a user-indexed RaggedArray
+        self.residual_clicked_set: sorted clicked items of each user in dev/test set
+        """
+        residual_df = pd.concat([self.data_df[key][['user_id', 'item_id']] for key in ['dev', 'test']])
+        self.train_clicked_set = RaggedArray.from_groups(
+            self.data_df['train']['user_id'].values, self.data_df['train']['item_id'].values,
+            self.n_users, unique=True)
+        self.residual_clicked_set = RaggedArray.from_groups(
+            residual_df['user_id'].values, residual_df['item_id'].values, self.n_users, unique=True)
 
     def _read_data(self):
         logging.info('Reading data from \"{}\", dataset = \"{}\" '.format(self.prefix, self.dataset))
@@ -8,10 +8,14 @@ import logging
 import numpy as np
 from time import time
 from tqdm import tqdm
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, BatchSampler
 from typing import Dict, List
 
 from utils import utils
+from utils import checkpoint
+from utils.async_eval import AsyncEvaluator
+from utils.profiling import PhaseTimer
+from utils.shuffle import CandidateShuffle, get_shuffle
 from models.BaseModel import BaseModel
 
 
@@ -36,6 +40,26 @@ class BaseRunner(object):
 							help='Batch size during testing.')
 		parser.add_argument('--optimizer', type=str, default='Adam',
 							help='optimizer: SGD, Adam, Adagrad, Adadelta')
+		parser.add_argument('--item_chunk', type=int, default=65536,
+							help='Number of items scored at once by models supporting full ranking when test_all (0: all).')
+		parser.add_argument('--cand_shuffle', type=str, default='auto',
+							help='Shuffle of training candidates: row, column (shared by the batch), none, '
+								 'auto (none for permutation-invariant models, row otherwise).')
+		parser.add_argument('--ckpt_steps', type=int, default=0,
+							help='Save the full training state every ckpt_steps training steps (0: disabled).')
+		parser.add_argument('--ckpt_secs', type=int, default=0,
+							help='Save the full training state every ckpt_secs seconds of training (0: disabled).')
+		parser.add_argument('--async_eval', type=int, default=0,
+							help='Evaluate in a background process while training goes on, '
+								 'with results lagging at most async_eval epochs behind (0: synchronous).')
+		parser.add_argument('--profile', type=int, default=0,
+							help='Time the phases of training and evaluation, and export a per-epoch JSON summary '
+								 'and a Chrome trace next to the log file.')
+		parser.add_argument('--profile_steps', type=str, default='',
+							help='Range of training steps captured by torch.profiler, e.g., 100-110 (empty: none).')
+		parser.add_argument('--n_seeds', type=int, default=1,
+							help='Train the replicas of seeds random_seed, ..., random_seed+n_seeds-1 at once '
+								 '(stackable models only, see EnsembleRunner).')
 		parser.add_argument('--num_workers', type=int, default=5,
 							help='Number of processors when prepare batches in DataLoader')
 		parser.add_argument('--pin_memory', type=int, default=0,
@@ -56,7 +80,6 @@ class BaseRunner(object):
 		:param metrics: metric string list
 		:return: a result dict, the keys are metric@topk
 		"""
-		evaluations = dict()
 		# sort_idx = (-predictions).argsort(axis=1)
 		# gt_rank = np.argwhere(sort_idx == 0)[:, 1] + 1
 		# ↓ As we only have one positive sample, comparing with the first item will be more efficient. 
@@ -65,14 +88,26 @@ class BaseRunner(object):
 		# 	predictions_rnd = predictions.copy()
 		# 	predictions_rnd[:,1:] += np.random.rand(predictions_rnd.shape[0], predictions_rnd.shape[1]-1)*1e-6
 		# 	gt_rank = (predictions_rnd > predictions[:,0].reshape(-1,1)).sum(axis=-1)+1
+		evaluations = dict()
+		for key, values in BaseRunner.rank_metrics(gt_rank, topk, metrics).items():
+			evaluations[key] = values.mean()
+		return evaluations
+
+	@staticmethod
+	def rank_metrics(gt_rank: np.ndarray, topk: list, metrics: list) -> Dict[str, np.ndarray]:
+		"""
+		:param gt_rank: rank of the ground-truth item of each instance (starting from 1)
+		:return: a dict of metric values for each instance, the keys are metric@topk
+		"""
+		evaluations = dict()
 		for k in topk:
 			hit = (gt_rank <= k)
 			for metric in metrics:
 				key = '{}@{}'.format(metric, k)
 				if metric == 'HR':
-					evaluations[key] = hit.mean()
+					evaluations[key] = hit
 				elif metric == 'NDCG':
-					evaluations[key] = (hit / np.log2(gt_rank + 1)).mean()
+					evaluations[key] = hit / np.log2(gt_rank + 1)
 				else:
 					raise ValueError('Undefined evaluation metric: {}.'.format(metric))
 		return evaluations
@@ -86,6 +121,8 @@ class BaseRunner(object):
 		self.learning_rate = args.lr
 		self.batch_size = args.batch_size
 		self.eval_batch_size = args.eval_batch_size
+		self.item_chunk = args.item_chunk
+		self.cand_shuffle = args.cand_shuffle
 		self.l2 = args.l2
 		self.optimizer_name = args.optimizer
 		self.num_workers = args.num_workers
@@ -94,11 +131,29 @@ class BaseRunner(object):
 		self.metrics = [m.strip().upper() for m in args.metric.split(',')]
 		self.main_metric = '{}@{}'.format(self.metrics[0], self.topk[0]) if not len(args.main_metric) else args.main_metric # early stop based on main_metric
 		self.main_topk = int(self.main_metric.split("@")[1]) if "@" in self.main_metric else 0
+		self.async_eval = args.async_eval
 		self.time = None  # will store [start_time, last_step_time]
+		self.best_epoch, self.train_time = None, None  # set by train
+
+		# resumable training state, see save_checkpoint
+		self.ckpt_steps = args.ckpt_steps
+		self.ckpt_secs = args.ckpt_secs
+		self.ckpt_writer = None
+		self.resume_state = None
+		self.train_history = {'main_metric_results': list(), 'dev_results': list()}
+		self.cur_epoch, self.step, self.epoch_rng, self.ckpt_time = 0, 0, None, time()
+		if self._checkpoint_enabled() and self.async_eval > 0:
+			# the epochs still pending in the evaluator would be missing from the saved early-stop history
+			logging.warning('Checkpoints are not supported with asynchronous evaluation (async_eval > 0)')
+			self.ckpt_steps, self.ckpt_secs = 0, 0
 
 		self.log_path = os.path.dirname(args.log_file) # path to save predictions
 		self.save_appendix = args.log_file.split("/")[-1].split(".")[0] # appendix for prediction saving
 
+		# phase instrumentation, see utils.profiling
+		self.timer = PhaseTimer(enabled=args.profile > 0, profile_steps=args.profile_steps,
+								torch_trace_path=self._profile_path('torch_trace'))
+
 	def _check_time(self, start=False):
 		if self.time is None or start:
 			self.time = [time()] * 2
@@ -107,23 +162,98 @@ class BaseRunner(object):
 		self.time[1] = time()
 		return self.time[1] - tmp_time
 
+	def _profile_path(self, kind: str) -> str:
+		return os.path.join(self.log_path, '{}-{}.json'.format(self.save_appendix, kind))
+
 	def _build_optimizer(self, model):
 		logging.info('Optimizer: ' + self.optimizer_name)
 		optimizer = eval('torch.optim.{}'.format(self.optimizer_name))(
 			model.customize_parameters(), lr=self.learning_rate, weight_decay=self.l2)
 		return optimizer
 
+	@staticmethod
+	def checkpoint_path(model: BaseModel) -> str:
+		return os.path.splitext(model.model_path)[0] + '.ckpt'
+
+	@staticmethod
+	def final_checkpoint_path(model: BaseModel) -> str:
+		# training state at the end of a finished run, which is not resumed by --load (see search.py to extend it)
+		return os.path.splitext(model.model_path)[0] + '.final.ckpt'
+
+	def save_checkpoint(self, model: BaseModel, epoch: int, step: int):
+		"""
+		Hand a snapshot of the full training state to the background writer: weights, optimizer, progress (the epoch
+		in progress and the number of its finished steps), RNG states, and the early-stop history.
+		The RNG state at the beginning of the epoch replays its negative sampling and instance order when resuming.
+		"""
+		if self.ckpt_writer is None:
+			self.ckpt_writer = checkpoint.CheckpointWriter()
+		with self.timer.phase('checkpoint'):
+			self._submit_checkpoint(model, epoch, step)
+		self.ckpt_time = time()
+
+	def _submit_checkpoint(self, model: BaseModel, epoch: int, step: int):
+		state = {
+			'model': checkpoint.to_cpu(model.state_dict()),
+			'optimizer': checkpoint.to_cpu(model.optimizer.state_dict()) if model.optimizer is not None else None,
+			'epoch': epoch,
+			'step': step,
+			'epoch_rng': self.epoch_rng if step > 0 else None,
+			'rng': checkpoint.get_rng_state(),
+			'train_history': {k: list(v) for k, v in self.train_history.items()},
+		}
+		self.ckpt_writer.submit(self.checkpoint_path(model), state)
+
+	def load_checkpoint(self, model: BaseModel) -> bool:
+		"""
+		Restore the weights from the latest checkpoint of the model, and keep the rest of the state to resume
+		training from it. Return False if there is no checkpoint.
+		"""
+		state = checkpoint.load(self.checkpoint_path(model))
+		if state is None:
+			return False
+		model.load_state_dict(state['model'])
+		self.resume_state = state
+		logging.info('Resume from {} (epoch {}, step {})'.format(
+			self.checkpoint_path(model), state['epoch'] + 1, state['step']))
+		return True
+
+	def _checkpoint_enabled(self) -> bool:
+		return self.ckpt_steps > 0 or self.ckpt_secs > 0
+
 	def train(self, data_dict: Dict[str, BaseModel.Dataset]):
 		model = data_dict['train'].model
 		main_metric_results, dev_results = list(), list()
+		self.train_history = {'main_metric_results': main_metric_results, 'dev_results': dev_results}
+		start_epoch = 0
+		if self.resume_state is not None:
+			state = self.resume_state
+			model.optimizer = self._build_optimizer(model)
+			if state['optimizer'] is not None:
+				model.optimizer.load_state_dict(state['optimizer'])
+			main_metric_results.extend(state['train_history']['main_metric_results'])
+			dev_results.extend(state['train_history']['dev_results'])
+			start_epoch = state['epoch']
+			if state['epoch_rng'] is None:  # saved between two epochs
+				checkpoint.set_rng_state(state['rng'])
+				self.resume_state = None
+			if len(main_metric_results) and self.early_stop > 0 and self.eval_termination(main_metric_results):
+				start_epoch = self.epoch  # the job had already stopped early
+		evaluator = None
+		if self.async_eval > 0 and start_epoch < self.epoch:
+			evaluator = AsyncEvaluator(self, model, data_dict, max_lag=self.async_eval)
+		stop = False
+		self.timer.sync_cuda = self.timer.enabled and model.device.type == 'cuda'
 		self._check_time(start=True)
 		try:
-			for epoch in range(self.epoch):
+			for epoch in range(start_epoch, self.epoch):
+				self.cur_epoch = epoch
 				# Fit
 				self._check_time()
 				gc.collect()
 				torch.cuda.empty_cache()
-				loss = self.fit(data_dict['train'], epoch=epoch + 1)
+				with self.timer.phase('fit'):
+					loss = self.fit(data_dict['train'], epoch=epoch + 1)
 				if np.isnan(loss):
 					logging.info("Loss is Nan. Stop training at %d."%(epoch+1))
 					break
@@ -133,80 +263,180 @@ class BaseRunner(object):
 				if len(model.check_list) > 0 and self.check_epoch > 0 and epoch % self.check_epoch == 0:
 					utils.check(model.check_list)
 
-				# Record dev results
-				dev_result = self.evaluate(data_dict['dev'], [self.main_topk], self.metrics)
-				dev_results.append(dev_result)
-				main_metric_results.append(dev_result[self.main_metric])
-				logging_str = 'Epoch {:<5} loss={:<.4f} [{:<3.1f} s]	dev=({})'.format(
-					epoch + 1, loss, training_time, utils.format_metric(dev_result))
-
-				# Test
-				if self.test_epoch > 0 and epoch % self.test_epoch  == 0:
-					test_result = self.evaluate(data_dict['test'], self.topk[:1], self.metrics)
-					logging_str += ' test=({})'.format(utils.format_metric(test_result))
-				testing_time = self._check_time()
-				logging_str += ' [{:<.1f} s]'.format(testing_time)
-
-				# Save model and early stop
-				if max(main_metric_results) == main_metric_results[-1] or \
-						(hasattr(model, 'stage') and model.stage == 1):
-					model.save_model()
-					logging_str += ' *'
-				logging.info(logging_str)
-
-				if self.early_stop > 0 and self.eval_termination(main_metric_results):
-					logging.info("Early stop at %d based on dev result." % (epoch + 1))
+				# Record dev and test results
+				test = self.test_epoch > 0 and epoch % self.test_epoch == 0
+				if evaluator is None:
+					with self.timer.phase('evaluate'):
+						dev_result = self.evaluate(data_dict['dev'], [self.main_topk], self.metrics)
+						test_result = self.evaluate(data_dict['test'], self.topk[:1], self.metrics) if test else None
+					stop = self._record_epoch(model, epoch, loss, training_time, dev_result, test_result,
+											  self._check_time())
+				else:  # results of earlier epochs, the best model is saved from their weight snapshots
+					with self.timer.phase('evaluate'):
+						evaluator.submit(epoch, model, test, info=(loss, training_time))
+						results = evaluator.collect()
+					for ep, (ep_loss, ep_time), dev_result, test_result, eval_time, weights in results:
+						stop = self._record_epoch(model, ep, ep_loss, ep_time, dev_result, test_result, eval_time,
+												  weights=weights)
+						if stop:
+							break
+				if self._checkpoint_enabled():
+					self.save_checkpoint(model, epoch + 1, 0)
+				self.timer.end_epoch(epoch + 1, self._profile_path('profile'))
+				if stop:
 					break
 
 		except KeyboardInterrupt:
 			logging.info("Early stop manually")
 			exit_here = input("Exit completely without evaluation? (y/n) (default n):")
 			if exit_here.lower().startswith('y'):
+				if evaluator is not None:
+					evaluator.close()
+				if self.ckpt_writer is not None:  # the pending checkpoint is what a later --load 1 resumes from
+					self.ckpt_writer.wait()
 				logging.info(os.linesep + '-' * 45 + ' END: ' + utils.get_time() + ' ' + '-' * 45)
 				exit(1)
 
+		if evaluator is not None:
+			try:
+				if not stop:  # epochs trained but not evaluated yet
+					for ep, (ep_loss, ep_time), dev_result, test_result, eval_time, weights in evaluator.collect(0):
+						if self._record_epoch(model, ep, ep_loss, ep_time, dev_result, test_result, eval_time,
+											  weights=weights):
+							break
+			finally:
+				evaluator.close()
+
+		if self.ckpt_writer is not None:
+			self.ckpt_writer.wait()
+		if os.path.exists(self.checkpoint_path(model)):  # training is over: later runs load the best model instead
+			os.replace(self.checkpoint_path(model), self.final_checkpoint_path(model))
+		self.timer.stop_profiler()
+		self.timer.export_trace(self._profile_path('trace'))
+
 		# Find the best dev result across iterations
 		best_epoch = main_metric_results.index(max(main_metric_results))
+		self.best_epoch, self.train_time = best_epoch + 1, self.time[1] - self.time[0]
 		logging.info(os.linesep + "Best Iter(dev)={:>5}\t dev=({}) [{:<.1f} s] ".format(
 			best_epoch + 1, utils.format_metric(dev_results[best_epoch]), self.time[1] - self.time[0]))
 		model.load_model()
 
+	def _record_epoch(self, model: BaseModel, epoch: int, loss: float, training_time: float, dev_result: dict,
+					  test_result: dict, testing_time: float, weights: dict = None) -> bool:
+		"""
+		Log the results of an epoch, save the model if it is the best one so far, and check early stop.
+		:param weights: state dict the results come from (the current weights of the model by default)
+		:return: whether to stop training
+		"""
+		main_metric_results, dev_results = self.train_history['main_metric_results'], self.train_history['dev_results']
+		dev_results.append(dev_result)
+		main_metric_results.append(dev_result[self.main_metric])
+		logging_str = 'Epoch {:<5} loss={:<.4f} [{:<3.1f} s]	dev=({})'.format(
+			epoch + 1, loss, training_time, utils.format_metric(dev_result))
+		if test_result is not None:
+			logging_str += ' test=({})'.format(utils.format_metric(test_result))
+		logging_str += ' [{:<.1f} s]'.format(testing_time)
+
+		# Save model and early stop
+		if max(main_metric_results) == main_metric_results[-1] or \
+				(hasattr(model, 'stage') and model.stage == 1):
+			if weights is None:
+				model.save_model()
+			else:
+				utils.check_dir(model.model_path)
+				torch.save(weights, model.model_path)
+			logging_str += ' *'
+		logging.info(logging_str)
+
+		if self.early_stop > 0 and self.eval_termination(main_metric_results):
+			logging.info("Early stop at %d based on dev result." % (epoch + 1))
+			return True
+		return False
+
+	def _train_loader(self, dataset: BaseModel.Dataset) -> DataLoader:
+		"""
+		Start a training epoch: sample (actions_before_epoch) and draw the order of the instances. Both only depend on
+		the RNG state at the beginning of the epoch, which is kept for checkpoints, so that a resumed epoch replays
+		them and skips the batches already done.
+		"""
+		resume, skip = self.resume_state, 0
+		if resume is not None:
+			checkpoint.set_rng_state(resume['epoch_rng'])
+			skip = resume['step']
+		self.epoch_rng = checkpoint.get_rng_state()
+		with self.timer.phase('actions_before_epoch'):
+			dataset.actions_before_epoch()  # must sample before multi thread start
+		order = torch.randperm(len(dataset)).tolist()
+		if resume is not None:
+			checkpoint.set_rng_state(resume['rng'])
+			self.resume_state = None
+		self.step, self.ckpt_time = skip, time()
+		return self._data_loader(dataset, self.batch_size, order[skip * self.batch_size:])
+
+	def _data_loader(self, dataset: BaseModel.Dataset, batch_size: int, order=None) -> DataLoader:
+		"""
+		DataLoader over the instances in order (all of them by default). With --batch_feed, the dataset receives
+		the indices of a whole batch from a BatchSampler and builds its feed dict at once.
+		"""
+		order = range(len(dataset)) if order is None else order
+		if dataset.batch_feed:
+			return DataLoader(dataset, batch_size=None, sampler=BatchSampler(order, batch_size, drop_last=False),
+							  num_workers=self.num_workers, collate_fn=dataset.collate_batch, pin_memory=self.pin_memory)
+		return DataLoader(dataset, batch_size=batch_size, sampler=order,
+						  num_workers=self.num_workers, collate_fn=dataset.collate_batch, pin_memory=self.pin_memory)
+
+	def _after_step(self, model: BaseModel):
+		# called after each optimizer step of fit
+		self.step += 1
+		if (self.ckpt_steps > 0 and self.step % self.ckpt_steps == 0) or \
+				(self.ckpt_secs > 0 and time() - self.ckpt_time >= self.ckpt_secs):
+			self.save_checkpoint(model, self.cur_epoch, self.step)
+
 	def fit(self, dataset: BaseModel.Dataset, epoch=-1) -> float:
 		model = dataset.model
 		if model.optimizer is None:
 			model.optimizer = self._build_optimizer(model)
-		dataset.actions_before_epoch()  # must sample before multi thread start
+		dl = self._train_loader(dataset)
 
 		model.train()
 		loss_lst = list()
-		dl = DataLoader(dataset, batch_size=self.batch_size, shuffle=True, num_workers=self.num_workers,
-						collate_fn=dataset.collate_batch, pin_memory=self.pin_memory)
-		for batch in tqdm(dl, leave=False, desc='Epoch {:<3}'.format(epoch), ncols=100, mininterval=1):
-			batch = utils.batch_to_gpu(batch, model.device)
-
-			# randomly shuffle the items to avoid models remembering the first item being the target
-			item_ids = batch['item_id']
-			# for each row (sample), get random indices and shuffle the original items
-			indices = torch.argsort(torch.rand(*item_ids.shape), dim=-1)						
-			batch['item_id'] = item_ids[torch.arange(item_ids.shape[0]).unsqueeze(-1), indices]
-
+		shuffle = get_shuffle(self.cand_shuffle, model)
+		for batch in tqdm(self.timer.iterate(dl, train=True), leave=False, desc='Epoch {:<3}'.format(epoch),
+						  ncols=100, mininterval=1):
+			with self.timer.phase('h2d'):
+				batch = utils.batch_to_gpu(batch, model.device)
 			model.optimizer.zero_grad()
-			out_dict = model(batch)
-
-			# shuffle the predictions back so that the prediction scores match the original order (first item is the target)
-			prediction = out_dict['prediction']
-			if len(prediction.shape)==2: # only for ranking tasks
-				restored_prediction = torch.zeros(*prediction.shape).to(prediction.device)
-				# use the random indices to shuffle back
-				restored_prediction[torch.arange(item_ids.shape[0]).unsqueeze(-1), indices] = prediction   
-				out_dict['prediction'] = restored_prediction
-
-			loss = model.loss(out_dict)
-			loss.backward()
-			model.optimizer.step()
+			if model.sampled_softmax:  # item_id only holds the targets, negatives come from the batch itself
+				if model.shared_neg > 0:
+					batch['shared_items'] = torch.from_numpy(dataset.neg_sampler.draw(model.shared_neg)).to(model.device)
+				with self.timer.phase('loss'):  # the forward pass happens inside the sampled softmax loss
+					loss = model.sampled_softmax_loss(batch)
+			else:
+				with self.timer.phase('forward'):
+					out_dict = self._shuffled_forward(model, batch, shuffle)
+				with self.timer.phase('loss'):
+					loss = model.loss(out_dict)
+			with self.timer.phase('backward'):
+				loss.backward()
+			with self.timer.phase('optimizer_step'):
+				model.optimizer.step()
+			self._after_step(model)
 			loss_lst.append(loss.detach().cpu().data.numpy())
 		return np.mean(loss_lst).item()
 
+	@staticmethod
+	def _shuffled_forward(model: BaseModel, batch: dict, shuffle: CandidateShuffle) -> dict:
+		# shuffle the candidates to avoid models remembering the first item being the target
+		item_ids = batch['item_id']
+		batch['item_id'] = shuffle.shuffle(item_ids)
+		out_dict = model(batch)
+
+		# shuffle the predictions back so that the prediction scores match the original order (first item is the target)
+		prediction = out_dict['prediction']
+		if prediction.shape == item_ids.shape: # only for ranking tasks
+			out_dict['prediction'] = shuffle.restore(prediction)
+		return out_dict
+
 	def eval_termination(self, criterion: List[float]) -> bool:
 		if len(criterion) > self.early_stop and utils.non_increasing(criterion[-self.early_stop:]):
 			return True
@@ -217,10 +447,18 @@ class BaseRunner(object):
 	def evaluate(self, dataset: BaseModel.Dataset, topks: list, metrics: list) -> Dict[str, float]:
 		"""
 		Evaluate the results for an input dataset.
+		Predictions are reduced to ground-truth ranks batch by batch, and metrics are accumulated as running sums,
+		so that the whole prediction matrix is never kept in memory (e.g., when testing on all the items).
 		:return: result dict (key: metric@k)
 		"""
-		predictions = self.predict(dataset)
-		return self.evaluate_method(predictions, topks, metrics)
+		metric_sums, n_instances = dict(), 0
+		for batch, prediction in self._predict_batches(dataset):
+			with self.timer.phase('metrics'):
+				gt_rank = (prediction >= prediction[:, :1]).sum(axis=-1)
+				for key, values in self.rank_metrics(gt_rank, topks, metrics).items():
+					metric_sums[key] = metric_sums.get(key, 0) + values.sum()
+			n_instances += len(gt_rank)
+		return {key: value / n_instances for key, value in metric_sums.items()}
 
 	def predict(self, dataset: BaseModel.Dataset, save_prediction: bool = False) -> np.ndarray:
 		"""
@@ -229,27 +467,60 @@ class BaseRunner(object):
 		Example: ground-truth items: [1, 2], 2 negative items for each instance: [[3,4], [5,6]]
 				 predictions like: [[1,3,4], [2,5,6]]
 		"""
-		dataset.model.eval()
-		predictions = list()
-		dl = DataLoader(dataset, batch_size=self.eval_batch_size, shuffle=False, num_workers=self.num_workers,
-						collate_fn=dataset.collate_batch, pin_memory=self.pin_memory)
-		for batch in tqdm(dl, leave=False, ncols=100, mininterval=1, desc='Predict'):
-			if hasattr(dataset.model,'inference'):
-				prediction = dataset.model.inference(utils.batch_to_gpu(batch, dataset.model.device))['prediction']
+		predictions = [prediction for _, prediction in self._predict_batches(dataset)]
+		return np.concatenate(predictions)
+
+	def recommend(self, dataset: BaseModel.Dataset, topk: int) -> tuple:
+		"""
+		Top-K candidates of each instance, selected batch by batch with argpartition.
+		:return: recommended item ids and their predictions, both with shape (-1, topk) and sorted by prediction
+		"""
+		rec_items, rec_predictions = list(), list()
+		for batch, prediction in self._predict_batches(dataset):
+			k = min(topk, prediction.shape[1])
+			top_idx = np.argpartition(-prediction, k - 1, axis=1)[:, :k]
+			top_pred = np.take_along_axis(prediction, top_idx, axis=1)
+			order = np.argsort(-top_pred, axis=1, kind='stable')
+			top_idx, top_pred = np.take_along_axis(top_idx, order, axis=1), np.take_along_axis(top_pred, order, axis=1)
+			item_ids = batch['item_id'].cpu().numpy()
+			if dataset.model.test_all:  # column j is item j, except for the ground-truth item in the first column
+				top_items = np.where(top_idx == 0, item_ids[:, :1], top_idx)
 			else:
-				prediction = dataset.model(utils.batch_to_gpu(batch, dataset.model.device))['prediction']
-			predictions.extend(prediction.cpu().data.numpy())
-		predictions = np.array(predictions)
-
-		if dataset.model.test_all:
-			rows, cols = list(), list()
-			for i, u in enumerate(dataset.data['user_id']):
-				clicked_items = list(dataset.corpus.train_clicked_set[u] | dataset.corpus.residual_clicked_set[u])
-				idx = list(np.ones_like(clicked_items) * i)
-				rows.extend(idx)
-				cols.extend(clicked_items)
-			predictions[rows, cols] = -np.inf
-		return predictions
+				top_items = np.take_along_axis(item_ids, top_idx, axis=1)
+			rec_items.append(top_items)
+			rec_predictions.append(top_pred)
+		return np.concatenate(rec_items), np.concatenate(rec_predictions)
+
+	def _predict_batches(self, dataset: BaseModel.Dataset):
+		"""
+		Generate (batch, prediction) for consecutive batches of the dataset. Under test_all, clicked items
+		(except the ground-truth in the first column) are masked in place with -inf.
+		"""
+		dataset.model.eval()
+		dl = self._data_loader(dataset, self.eval_batch_size)
+		start = 0
+		for batch in tqdm(self.timer.iterate(dl, 'eval_loader_wait'), leave=False, ncols=100, mininterval=1,
+						  desc='Predict'):
+			with self.timer.phase('eval_h2d'):
+				batch = utils.batch_to_gpu(batch, dataset.model.device)
+			with self.timer.phase('predict'):
+				if dataset.model.full_ranking:
+					scores = dataset.model.full_predict(batch, self.item_chunk)
+					# same layout as candidate lists: the ground-truth item first, then all the items from 1
+					prediction = torch.cat([scores.gather(1, batch['item_id'][:, :1]), scores[:, 1:]], dim=1)
+				elif hasattr(dataset.model,'inference'):
+					prediction = dataset.model.inference(batch)['prediction']
+				else:
+					prediction = dataset.model(batch)['prediction']
+				prediction = prediction.cpu().data.numpy()
+
+				if dataset.model.test_all:
+					users = np.asarray(dataset.data['user_id'][start:start + len(prediction)])
+					for clicked_set in [dataset.corpus.train_clicked_set, dataset.corpus.residual_clicked_set]:
+						rows, cols = clicked_set.take(users)
+						prediction[rows, cols] = -np.inf
+			start += len(prediction)
+			yield batch, prediction
 
 	def print_res(self, dataset: BaseModel.Dataset) -> str:
 		"""
@@ -8,7 +8,6 @@ import logging
 import numpy as np
 from time import time
 from tqdm import tqdm
-from torch.utils.data import DataLoader
 from typing import Dict, List
 
 from utils import utils
@@ -52,7 +51,8 @@ class CTRRunner(BaseRunner):
 		:return: result dict (key: metric)
 		"""
 		predictions, labels = self.predict(dataset)
-		return self.evaluate_method(predictions, labels, metrics)
+		with self.timer.phase('metrics'):
+			return self.evaluate_method(predictions, labels, metrics)
 
 	def predict(self, dataset: BaseModel.Dataset, save_prediction: bool = False) -> np.ndarray:
 		"""
@@ -62,17 +62,20 @@ class CTRRunner(BaseRunner):
 		dataset.model.eval()
 		dataset.model.phase = 'eval'
 		predictions, labels = list(), list()
-		dl = DataLoader(dataset, batch_size=self.eval_batch_size, shuffle=False, num_workers=self.num_workers,
-						collate_fn=dataset.collate_batch, pin_memory=self.pin_memory)
-		for batch in tqdm(dl, leave=False, ncols=100, mininterval=1, desc='Predict'):
-			if hasattr(dataset.model,'inference'):
-				out_dict = dataset.model.inference(utils.batch_to_gpu(batch, dataset.model.device))
-				prediction, label = out_dict['prediction'], out_dict['label']
-			else:
-				out_dict = dataset.model(utils.batch_to_gpu(batch, dataset.model.device))
-				prediction, label = out_dict['prediction'], out_dict['label']
-			predictions.extend(prediction.cpu().data.numpy())
-			labels.extend(label.cpu().data.numpy())
+		dl = self._data_loader(dataset, self.eval_batch_size)
+		for batch in tqdm(self.timer.iterate(dl, 'eval_loader_wait'), leave=False, ncols=100, mininterval=1,
+						  desc='Predict'):
+			with self.timer.phase('eval_h2d'):
+				batch = utils.batch_to_gpu(batch, dataset.model.device)
+			with self.timer.phase('predict'):
+				if hasattr(dataset.model,'inference'):
+					out_dict = dataset.model.inference(batch)
+					prediction, label = out_dict['prediction'], out_dict['label']
+				else:
+					out_dict = dataset.model(batch)
+					prediction, label = out_dict['prediction'], out_dict['label']
+				predictions.extend(prediction.cpu().data.numpy())
+				labels.extend(label.cpu().data.numpy())
 		predictions = np.array(predictions)
 		labels = np.array(labels)
 
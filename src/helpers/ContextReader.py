@@ -53,7 +53,10 @@ class ContextReader(BaseReader):
 	def _collect_context(self):
 		logging.info('Collect context features...')
 		id_columns = ['user_id','item_id']
-		self.item_features, self.user_features = None, None # dict
+		self.item_feature_matrix, self.user_feature_matrix = None, None # id-indexed integer/categorical features
+		self.item_float_matrix, self.user_float_matrix = None, None # id-indexed numerical features
+		self.item_int_features, self.item_float_features = list(), list()
+		self.user_int_features, self.user_float_features = list(), list()
 		self.feature_max = dict()
 		for key in ['train', 'dev', 'test']:
 			logging.info('Loading context for %s set...'%(key))
@@ -70,15 +73,74 @@ class ContextReader(BaseReader):
 		# include item features
 		if self.item_meta_df is not None and self.include_item_features:
 			item_df = self.item_meta_df[['item_id']+self.item_feature_names]
-			self.item_features = item_df.set_index('item_id').to_dict(orient='index')
+			self.item_int_features, self.item_float_features = self._split_features(item_df, self.item_feature_names)
+			self.item_feature_matrix = self._feature_matrix(item_df, 'item_id', self.item_int_features, self.n_items,
+														   dtype=np.int64)
+			self.item_float_matrix = self._feature_matrix(item_df, 'item_id', self.item_float_features, self.n_items)
 			for f in self.item_feature_names:
 				self.feature_max[f] = max( self.feature_max.get(f,0), int(item_df[f].max())+1 )
 			logging.info('# Item Features: %d'%(item_df.shape[1]))
 		# include user features
 		if self.user_meta_df is not None and self.include_user_features:
-			user_df = self.user_meta_df[['user_id']+self.user_feature_names].set_index('user_id')
-			self.user_features = user_df.to_dict(orient='index')
+			user_df = self.user_meta_df[['user_id']+self.user_feature_names]
+			self.user_int_features, self.user_float_features = self._split_features(user_df, self.user_feature_names)
+			self.user_feature_matrix = self._feature_matrix(user_df, 'user_id', self.user_int_features, self.n_users,
+														   dtype=np.int64)
+			self.user_float_matrix = self._feature_matrix(user_df, 'user_id', self.user_float_features, self.n_users)
 			for f in self.user_feature_names:
 				self.feature_max[f] = max( self.feature_max.get(f,0), int(user_df[f].max())+1 )
 			logging.info('# User Features: %d'%(user_df.shape[1]))
 
+	@staticmethod
+	def _split_features(meta_df: pd.DataFrame, feature_names: list) -> tuple:
+		# integer and categorical (_c, _id) features are stored as int64, the other ones keep their float type
+		int_features = [f for f in feature_names if np.issubdtype(meta_df[f].dtype, np.integer)
+						or f.endswith('_c') or f.endswith('_id')]
+		return int_features, [f for f in feature_names if f not in int_features]
+
+	@staticmethod
+	def _feature_matrix(meta_df: pd.DataFrame, id_column: str, feature_names: list, n_ids: int,
+						dtype=None) -> np.ndarray:
+		"""
+		Dense id-indexed feature matrix, with one column per feature (in the order of feature_names) and zeros for ids
+		without features, of the given dtype (by default the common type of the features). None without features.
+		"""
+		if not len(feature_names):
+			return None
+		dtype = dtype if dtype is not None else np.result_type(*[meta_df[f].dtype for f in feature_names])
+		ids = meta_df[id_column].values.astype(np.int64)
+		matrix = np.zeros((max(n_ids, int(ids.max()) + 1 if len(ids) else 0), len(feature_names)), dtype=dtype)
+		matrix[ids] = meta_df[feature_names].to_numpy(dtype=dtype)
+		return matrix
+
+	@staticmethod
+	def _gather_features(matrices: list, feature_names: list, ids, prefix: str = '') -> dict:
+		# all the features of ids (an id or an array of ids of any shape) with a single fancy-index per matrix
+		features = dict()
+		for names, matrix in matrices:
+			if not len(names):
+				continue
+			values = matrix[ids]
+			for idx, f in enumerate(names):
+				features[f] = values[..., idx] if values.ndim > 1 else values[idx]
+		return {prefix + f: features[f] for f in feature_names}
+
+	def get_item_features(self, item_ids, prefix: str = '') -> dict:
+		"""
+		Item features of item_ids, with the same shape as item_ids: {prefix + feature name: values}
+		"""
+		if not len(self.item_feature_names):
+			return dict()
+		return self._gather_features([(self.item_int_features, self.item_feature_matrix),
+									  (self.item_float_features, self.item_float_matrix)],
+									 self.item_feature_names, item_ids, prefix)
+
+	def get_user_features(self, user_ids, prefix: str = '') -> dict:
+		"""
+		User features of user_ids, with the same shape as user_ids: {prefix + feature name: values}
+		"""
+		if not len(self.user_feature_names):
+			return dict()
+		return self._gather_features([(self.user_int_features, self.user_feature_matrix),
+									  (self.user_float_features, self.user_float_matrix)],
+									 self.user_feature_names, user_ids, prefix)
@@ -4,11 +4,13 @@ Jiayu Li 2023.05.20
 '''
 
 import logging
+import numpy as np
 import pandas as pd
 import os
 import sys
 
 from helpers.ContextReader import ContextReader
+from utils.ragged import HistoryStore
 
 class ContextSeqReader(ContextReader):
 	def __init__(self, args):
@@ -18,7 +20,9 @@ class ContextSeqReader(ContextReader):
 	def _append_his_info(self):
 		"""
 		Similar to SeqReader, but add situation context to each history interaction.
-		self.user_his: store user history sequence [(i1,t1, {situation 1}), (i1,t2, {situation 2}), ...]
+		self.user_his: HistoryStore of user history sequences (items and times)
+		self.user_his_situations: situation features of each history interaction, as a 2D array aligned with the items
+			of user_his (the window of a user in user_his is also the window of its situations)
 		"""
 		logging.info('Appending history info with history context...')
 		data_dfs = dict()
@@ -27,14 +31,12 @@ class ContextSeqReader(ContextReader):
 			data_dfs[key]['phase'] = key
 		sort_df = pd.concat([data_dfs[phase][['user_id','item_id','time','phase']+self.situation_feature_names] 
 					   for phase in ['train','dev','test']]).sort_values(by=['time', 'user_id'], kind='mergesort')
-		position = list()
-		self.user_his = dict()  # store the already seen sequence of each user
+		self.user_his, position = HistoryStore.build(
+			sort_df['user_id'].values, sort_df['item_id'].values, sort_df['time'].values, self.n_users)
+		# situation features of each history interaction, one row per entry of user_his (sharing its offsets)
 		situation_features = sort_df[self.situation_feature_names].to_numpy()
-		for idx, (uid, iid, t) in enumerate(zip(sort_df['user_id'], sort_df['item_id'], sort_df['time'])):
-			if uid not in self.user_his:
-				self.user_his[uid] = list()
-			position.append(len(self.user_his[uid]))
-			self.user_his[uid].append((iid, t, situation_features[idx]))
+		self.user_his_situations = np.empty_like(situation_features)
+		self.user_his_situations[self.user_his.offsets[sort_df['user_id'].values] + position] = situation_features
 		sort_df['position'] = position
 		for key in ['train', 'dev', 'test']:
 			self.data_df[key] = pd.merge(
@@ -0,0 +1,234 @@
+# -*- coding: UTF-8 -*-
+
+import os
+import gc
+import torch
+import logging
+import numpy as np
+from tqdm import tqdm
+from typing import Dict, List
+
+from utils import utils
+from utils.shuffle import CandidateShuffle, get_shuffle
+from models.BaseModel import BaseModel
+from helpers.BaseRunner import BaseRunner
+
+try:  # torch >= 2.0
+	from torch.func import functional_call, stack_module_state, vmap
+except ImportError:
+	try:  # torch 1.13 ships functorch, and the functional call of torch.nn.utils.stateless
+		from functorch import vmap
+		from torch.nn.utils.stateless import functional_call as _functional_call
+
+		def functional_call(module, params_and_buffers: tuple, args: tuple):
+			merged = dict()
+			for d in params_and_buffers:
+				merged.update(d)
+			return _functional_call(module, merged, args)
+
+		def stack_module_state(models: list) -> tuple:
+			params = {name: torch.stack([dict(m.named_parameters())[name].detach() for m in models]).requires_grad_()
+					  for name, _ in models[0].named_parameters()}
+			buffers = {name: torch.stack([dict(m.named_buffers())[name] for m in models])
+					   for name, _ in models[0].named_buffers()}
+			return params, buffers
+	except ImportError:
+		functional_call, stack_module_state, vmap = None, None, None
+
+
+class StackedEnsemble(object):
+	"""
+	Parameters (and buffers) of the replicas of a model stacked along a new first dimension.
+	The replicas run through torch.func.functional_call on the first replica (functorch on torch 1.13), vectorized by
+	vmap when the model supports it (one by one otherwise), so that one batch and one backward pass serve all of them.
+	"""
+	def __init__(self, replicas: List[BaseModel]):
+		self.base = replicas[0]
+		self.n_replicas = len(replicas)
+		self.params, self.buffers = stack_module_state(replicas)
+		self.vectorized = True
+
+	def param_groups(self) -> list:
+		# the optimizer groups of the model (e.g., no weight decay on biases), with stacked parameters
+		names = {id(p): name for name, p in self.base.named_parameters()}
+		groups = list()
+		for group in self.base.customize_parameters():
+			group = dict(group)
+			group['params'] = [self.params[names[id(p)]] for p in group['params']]
+			groups.append(group)
+		return groups
+
+	def losses(self, batch: dict, shuffle: CandidateShuffle) -> torch.Tensor:
+		"""
+		:return: the loss of each replica on the same batch, with shape [n_replicas]
+		"""
+		item_ids = batch['item_id']
+		feed_dict = dict(batch)
+		feed_dict['item_id'] = shuffle.shuffle(item_ids)  # the same candidate order for all the replicas
+
+		def replica_loss(params, buffers):
+			out_dict = functional_call(self.base, (params, buffers), (feed_dict,))
+			if out_dict['prediction'].shape == item_ids.shape:
+				out_dict['prediction'] = shuffle.restore(out_dict['prediction'])
+			return self.base.loss(out_dict)
+
+		if self.vectorized:
+			try:
+				return vmap(replica_loss, randomness='different')(self.params, self.buffers)
+			except (RuntimeError, NotImplementedError, ValueError) as e:
+				logging.warning('{} does not support vmap, replicas run one by one: {}'.format(
+					type(self.base).__name__, str(e).split('\n')[0]))
+				self.vectorized = False
+		return torch.stack([replica_loss({n: p[k] for n, p in self.params.items()},
+										 {n: b[k] for n, b in self.buffers.items()})
+							for k in range(self.n_replicas)])
+
+	def load_replica(self, model: BaseModel, k: int):
+		# copy the weights of replica k into the model, e.g., to evaluate or save it as a regular model
+		with torch.no_grad():
+			for name, p in model.named_parameters():
+				p.copy_(self.params[name][k])
+			for name, b in model.named_buffers():
+				if name in self.buffers:
+					b.copy_(self.buffers[name][k])
+
+
+class EnsembleRunner(BaseRunner):
+	"""
+	Train the replicas of a model with seeds random_seed, ..., random_seed + n_seeds - 1 at once (--n_seeds),
+	sharing the data pipeline and the batches. Each replica has its own early stop and best model, saved where the
+	run with its seed would save it, so that results come out per seed as if the runs were separate.
+	Only for models declaring `stackable` (no state other than parameters and buffers changes during training).
+	"""
+	def __init__(self, args):
+		super().__init__(args)
+		self.args = args  # to build the replicas
+		self.seeds = [args.random_seed + k for k in range(args.n_seeds)]
+		self.best_epochs = [None] * len(self.seeds)
+		if self._checkpoint_enabled() or self.async_eval > 0:
+			logging.warning('Checkpoints and asynchronous evaluation are not supported with n_seeds > 1')
+			self.ckpt_steps, self.ckpt_secs, self.async_eval = 0, 0, 0
+
+	def seed_path(self, path: str, seed: int) -> str:
+		"""
+		Path of a file named after the random seed (log, model), for another seed
+		"""
+		base_seed = self.seeds[0]
+		if seed == base_seed:
+			return path
+		tag = '__{}__'.format(base_seed)
+		if tag in path:
+			return path.replace(tag, '__{}__'.format(seed), 1)
+		root, ext = os.path.splitext(path)
+		return '{}-seed{}{}'.format(root, seed, ext)
+
+	def _build_replicas(self, model: BaseModel, corpus) -> StackedEnsemble:
+		replicas = [model]
+		for seed in self.seeds[1:]:
+			utils.init_seed(seed)  # initialized as in a run with this seed
+			replicas.append(model.__class__(self.args, corpus).to(model.device))
+		utils.init_seed(self.seeds[0])
+		ensemble = StackedEnsemble(replicas)
+		logging.info('Train {} replicas with seeds {}'.format(len(replicas), self.seeds))
+		return ensemble
+
+	def train(self, data_dict: Dict[str, BaseModel.Dataset]):
+		model = data_dict['train'].model
+		if not model.stackable or model.sampled_softmax:
+			raise ValueError('{} cannot train stacked replicas (n_seeds > 1)'.format(type(model).__name__))
+		ensemble = self._build_replicas(model, data_dict['train'].corpus)
+		optimizer = eval('torch.optim.{}'.format(self.optimizer_name))(
+			ensemble.param_groups(), lr=self.learning_rate, weight_decay=self.l2)
+		logging.info('Optimizer: ' + self.optimizer_name)
+
+		n_seeds = len(self.seeds)
+		main_metric_results, dev_results = [list() for _ in range(n_seeds)], [list() for _ in range(n_seeds)]
+		active = [True] * n_seeds
+		self._check_time(start=True)
+		try:
+			for epoch in range(self.epoch):
+				self._check_time()
+				gc.collect()
+				torch.cuda.empty_cache()
+				with self.timer.phase('fit'):
+					losses = self.fit_stacked(data_dict['train'], ensemble, optimizer, epoch=epoch + 1)
+				training_time = self._check_time()
+				if np.isnan(losses).all():
+					logging.info("Loss is Nan. Stop training at %d." % (epoch + 1))
+					break
+
+				for k, seed in enumerate(self.seeds):
+					if not active[k]:  # stopped replicas keep training with the others, but are not evaluated
+						continue
+					if np.isnan(losses[k]):
+						logging.info("[seed {}] Loss is Nan. Stop training at {}.".format(seed, epoch + 1))
+						active[k] = False
+						continue
+					ensemble.load_replica(model, k)
+					with self.timer.phase('evaluate'):
+						dev_result = self.evaluate(data_dict['dev'], [self.main_topk], self.metrics)
+						test_result = self.evaluate(data_dict['test'], self.topk[:1], self.metrics) \
+							if self.test_epoch > 0 and epoch % self.test_epoch == 0 else None
+					dev_results[k].append(dev_result)
+					main_metric_results[k].append(dev_result[self.main_metric])
+					logging_str = '[seed {}] Epoch {:<5} loss={:<.4f} [{:<3.1f} s]	dev=({})'.format(
+						seed, epoch + 1, losses[k], training_time, utils.format_metric(dev_result))
+					if test_result is not None:
+						logging_str += ' test=({})'.format(utils.format_metric(test_result))
+					logging_str += ' [{:<.1f} s]'.format(self._check_time())
+					if max(main_metric_results[k]) == main_metric_results[k][-1]:
+						model.save_model(self.seed_path(model.model_path, seed))
+						logging_str += ' *'
+					logging.info(logging_str)
+					if self.early_stop > 0 and self.eval_termination(main_metric_results[k]):
+						logging.info("[seed {}] Early stop at {} based on dev result.".format(seed, epoch + 1))
+						active[k] = False
+				self.timer.end_epoch(epoch + 1, self._profile_path('profile'))
+				if not any(active):
+					break
+
+		except KeyboardInterrupt:
+			logging.info("Early stop manually")
+			exit_here = input("Exit completely without evaluation? (y/n) (default n):")
+			if exit_here.lower().startswith('y'):
+				logging.info(os.linesep + '-' * 45 + ' END: ' + utils.get_time() + ' ' + '-' * 45)
+				exit(1)
+		self.timer.stop_profiler()
+		self.timer.export_trace(self._profile_path('trace'))
+
+		# Find the best dev result of each replica
+		self.train_time = self.time[1] - self.time[0]
+		for k, seed in enumerate(self.seeds):
+			if not len(main_metric_results[k]):
+				continue
+			best_epoch = main_metric_results[k].index(max(main_metric_results[k]))
+			self.best_epochs[k] = best_epoch + 1
+			logging.info(os.linesep + "[seed {}] Best Iter(dev)={:>5}\t dev=({}) [{:<.1f} s] ".format(
+				seed, best_epoch + 1, utils.format_metric(dev_results[k][best_epoch]), self.train_time))
+		self.best_epoch = self.best_epochs[0]
+		model.load_model()
+
+	def fit_stacked(self, dataset: BaseModel.Dataset, ensemble: StackedEnsemble, optimizer, epoch=-1) -> np.ndarray:
+		"""
+		One epoch of all the replicas on the same batches
+		:return: the mean loss of each replica
+		"""
+		model = dataset.model
+		dl = self._train_loader(dataset)
+
+		model.train()
+		loss_lst = list()
+		shuffle = get_shuffle(self.cand_shuffle, model)
+		for batch in tqdm(self.timer.iterate(dl, train=True), leave=False, desc='Epoch {:<3}'.format(epoch),
+						  ncols=100, mininterval=1):
+			with self.timer.phase('h2d'):
+				batch = utils.batch_to_gpu(batch, model.device)
+			optimizer.zero_grad()
+			with self.timer.phase('forward'):  # forward and loss of all the replicas
+				losses = ensemble.losses(batch, shuffle)
+			with self.timer.phase('backward'):
+				losses.sum().backward()  # replicas do not share parameters, so their gradients stay separate
+			with self.timer.phase('optimizer_step'):
+				optimizer.step()
+			loss_lst.append(losses.detach().cpu().data.numpy())
+		return np.mean(loss_lst, axis=0)
@@ -32,18 +32,7 @@ class ImpressionContextReader(ImpressionReader, ContextReader):
 		self.dataset = args.dataset
 		self._read_data()
 
-		self.train_clicked_set = dict()  # store the clicked item set of each user in training set
-		self.residual_clicked_set = dict()  # store the residual clicked item set of each user
-		for key in ['train', 'dev', 'test']:
-			df = self.data_df[key]
-			for uid, iid in zip(df['user_id'], df['item_id']):
-				if uid not in self.train_clicked_set:
-					self.train_clicked_set[uid] = set()
-					self.residual_clicked_set[uid] = set()
-				if key == 'train':
-					self.train_clicked_set[uid].add(iid)
-				else:
-					self.residual_clicked_set[uid].add(iid)
+		self._collect_clicked_set()
 		self.include_item_features = args.include_item_features
 		self.include_user_features = args.include_user_features
 		self.include_context_features = args.include_context_features
@@ -8,6 +8,7 @@ import sys
 
 from helpers.BaseReader import BaseReader
 from utils import utils
+from utils.ragged import RaggedArray
 
 class ImpressionReader(BaseReader):
 	"""
@@ -17,10 +18,13 @@ class ImpressionReader(BaseReader):
 	def parse_data_args(parser):
 		parser.add_argument('--impression_idkey', type=str, default='time',
                             help='The key for impression identification, [time, impression_id]')
+		parser.add_argument('--impression_chunk', type=int, default=1000000,
+                            help='Rows grouped into impressions at a time (0: whole splits at once), to bound memory.')
 		return BaseReader.parse_data_args(parser)
 	
 	def __init__(self, args):
 		self.impression_idkey = args.impression_idkey
+		self.impression_chunk = args.impression_chunk
 		super().__init__(args)
 		self._append_impression_info()
 
@@ -53,77 +57,66 @@ class ImpressionReader(BaseReader):
 		"""
 		Merge all positive items of a request based on the timestamp/impression_idkey, and get column 'pos_items' for self.data_df
 		Add impression info to data_df: neg_num, pos_num
+		Each impression is kept as its last row, with the sorted unique clicked (pos_items) and non-clicked (neg_items) items
 		"""
 		logging.info('Merging positive items by timestamp/impression_idkey...')
-		# train,val,test
-		mask = {'train':[],'dev':[],'test':[]}
-		for key in self.data_df.keys():
-			df=self.data_df[key].copy()
-			df['last_user_id'] = df['user_id'].shift(1)
-			df['last_'+self.impression_idkey] = df[self.impression_idkey].shift(1)
-
-			positive_items, negative_items = [], []
-			current_pos, current_neg = set(), set()
-			for uid, last_uid, ipid, last_ipid, iid, label in \
-					df[['user_id','last_user_id',self.impression_idkey,'last_'+self.impression_idkey,'item_id','label']].to_numpy():
-				if uid == last_uid and ipid == last_ipid:
-					positive_items.append([])
-					negative_items.append([])
-					mask[key].append(0)
-				else:
-					if len(current_pos):
-						positive_items.append(list(current_pos))
-						negative_items.append(list(current_neg))
-						mask[key].append(1)
-					else:
-						if len(current_neg):#impression with only neg items are dropped
-							positive_items.append([])
-							negative_items.append([])
-							mask[key].append(0)
-					current_pos, current_neg = set(), set()
-				if label:
-					current_pos = current_pos.union(set([iid]))
-				else:
-					current_neg = current_neg.union(set([iid]))
-			# last session
-			if len(current_pos):
-				positive_items.append(list(current_pos))
-				negative_items.append(list(current_neg))
-				mask[key].append(1)
-			else:
-				if len(current_neg):#impression with only neg items are dropped
-					positive_items.append([])
-					negative_items.append([])
-					mask[key].append(0)
-			self.data_df[key]['pos_items'] = positive_items
-			self.data_df[key]['neg_items'] = negative_items
-			self.data_df[key]=self.data_df[key][np.array(mask[key])==1]
-
-		logging.info('Appending neg_num & pos_num...')
-
-		neg_num_sum, pos_num_sum = 0,0
+		neg_num_sum, pos_num_sum = 0, 0
 		for key in ['train', 'dev', 'test']:
 			df = self.data_df[key]
-			neg_num = list()
-			pos_num = list()
-			for neg_items in df['neg_items']:
-				if 0 in neg_items:
-					neg_num.append(neg_items.index(0))
-				else:
-					neg_num.append(len(neg_items))
-			self.data_df[key]['neg_num']=neg_num
-			for pos_items in df['pos_items']:
-				if 0 in pos_items:
-					pos_num.append(pos_items.index(0))
-				else:
-					pos_num.append(len(pos_items))
-			self.data_df[key]['pos_num']=pos_num
-			self.data_df[key] = self.data_df[key].loc[self.data_df[key].neg_num>0].reset_index(drop=True) # Retain sessions with negative data only
-			neg_num_sum += sum(neg_num)
-			pos_num_sum += sum(pos_num)
-		neg_num_avg = neg_num_sum / sum([self.data_df[key].shape[0] for key in self.data_df])
-		pos_num_avg = pos_num_sum / sum([self.data_df[key].shape[0] for key in self.data_df])
-		
+			# rows are sorted by user and impression key in _read_data, so that an impression is a run of rows
+			starts = np.flatnonzero(self._impression_starts(df))
+			bounds, parts = [0], list()
+			while bounds[-1] < len(df):  # chunks end at impression boundaries
+				idx = np.searchsorted(starts, bounds[-1] + self.impression_chunk) if self.impression_chunk > 0 else len(starts)
+				bounds.append(starts[idx] if idx < len(starts) else len(df))
+			for begin, end in zip(bounds[:-1], bounds[1:]):
+				parts.append(self._group_impressions(df.iloc[begin:end]))
+			self.data_df[key] = pd.concat(parts).reset_index(drop=True) if len(parts) \
+				else self._group_impressions(df).reset_index(drop=True)
+			neg_num_sum += self.data_df[key]['neg_num'].sum()
+			pos_num_sum += self.data_df[key]['pos_num'].sum()
+		n_impressions = sum([self.data_df[key].shape[0] for key in self.data_df])
+		neg_num_avg = neg_num_sum / n_impressions
+		pos_num_avg = pos_num_sum / n_impressions
+
 		logging.info('train, dev, test request num: '+str(len(self.data_df['train']))+' '+str(len(self.data_df['dev']))+' '+str(len(self.data_df['test'])))
 		logging.info("Average positive items / impression = %.3f, negative items / impression = %.3f"%(
-			pos_num_avg,neg_num_avg))
\ No newline at end of file
+			pos_num_avg,neg_num_avg))
+
+	def _impression_starts(self, df: pd.DataFrame) -> np.ndarray:
+		# whether each row starts a new impression, i.e., differs from the previous row in user or impression key
+		uid, ipid = df['user_id'].values, df[self.impression_idkey].values
+		new_impression = np.ones(len(df), dtype=bool)
+		new_impression[1:] = (uid[1:] != uid[:-1]) | (ipid[1:] != ipid[:-1])
+		return new_impression
+
+	def _group_impressions(self, df: pd.DataFrame) -> pd.DataFrame:
+		"""
+		Impressions of a run of rows made of whole impressions, without a loop over rows:
+		positive and negative items of each impression are grouped into ragged arrays by segment id.
+		Impressions without clicks, and those without negative items, are dropped.
+		"""
+		new_impression = self._impression_starts(df)
+		segment = np.cumsum(new_impression) - 1
+		n_impressions = int(segment[-1]) + 1 if len(df) else 0
+		last_rows = np.append(np.flatnonzero(new_impression)[1:] - 1, len(df) - 1)[:n_impressions]
+		clicked = df['label'].values.astype(bool)
+		items = df['item_id'].values
+		pos = RaggedArray.from_groups(segment[clicked], items[clicked], n_impressions, unique=True)
+		neg = RaggedArray.from_groups(segment[~clicked], items[~clicked], n_impressions, unique=True)
+		pos_num, neg_num = self._count_items(pos), self._count_items(neg)
+		keep = np.flatnonzero((pos.lengths() > 0) & (neg_num > 0))  # retain sessions with clicks and negative data
+		result = df.iloc[last_rows[keep]].copy()
+		result['pos_items'] = pos.to_cells(keep)
+		result['neg_items'] = neg.to_cells(keep)
+		result['neg_num'] = neg_num[keep]
+		result['pos_num'] = pos_num[keep]
+		return result
+
+	@staticmethod
+	def _count_items(items: RaggedArray) -> np.ndarray:
+		# number of items before 0 (padding) in each row, where 0 can only come first as rows are sorted
+		num = items.lengths()
+		non_empty = np.flatnonzero(num > 0)
+		num[non_empty[items.values[items.offsets[non_empty]] == 0]] = 0
+		return num
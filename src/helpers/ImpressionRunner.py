@@ -8,7 +8,6 @@ import logging
 import numpy as np
 from time import time
 from tqdm import tqdm
-from torch.utils.data import DataLoader
 from typing import Dict, List
 
 from utils import utils
@@ -138,10 +137,15 @@ class ImpressionRunner(BaseRunner):
 		:return: result dict (key: metric@k)
 		"""
 		predictions = self.predict(data)
+		with self.timer.phase('metrics'):
+			return self._evaluate_predictions(data, predictions, topks, metrics, check_sort_idx, all)
+
+	def _evaluate_predictions(self, data: BaseModel.Dataset, predictions: np.ndarray, topks: list, metrics: list,
+							  check_sort_idx = 0, all = 0) -> Dict[str, float]:
 		if data.model.test_all:
 			rows, cols = list(), list()
 			for i, u in enumerate(data.data['user_id']):
-				clicked_items = [x[0] for x in data.corpus.user_his[u]]
+				clicked_items = data.corpus.user_his.pos.user_items(u)
 				# clicked_items = [data.data['item_id'][i]]
 				idx = list(np.ones_like(clicked_items) * i)
 				rows.extend(idx)
@@ -174,24 +178,29 @@ class ImpressionRunner(BaseRunner):
 		model = data.model
 		if model.optimizer is None:
 			model.optimizer = self._build_optimizer(model)
-		data.actions_before_epoch()  # must sample before multi thread start
+		dl = self._train_loader(data)
 
 		model.train()
 		loss_lst = list()
-		dl = DataLoader(data, batch_size = self.batch_size, shuffle = True, num_workers = self.num_workers,
-						collate_fn = data.collate_batch, pin_memory=self.pin_memory)
-		for batch in tqdm(dl, leave = False, desc = 'Epoch {:<3}'.format(epoch), ncols = 100, mininterval = 1):
-			batch = utils.batch_to_gpu(batch, model.device)
+		for batch in tqdm(self.timer.iterate(dl, train = True), leave = False, desc = 'Epoch {:<3}'.format(epoch),
+						  ncols = 100, mininterval = 1):
+			with self.timer.phase('h2d'):
+				batch = utils.batch_to_gpu(batch, model.device)
 			model.optimizer.zero_grad()
-			out_dict = model(batch)
-			max_pos_num = model.train_max_pos_item
-			pos_mask = 2*(torch.arange(max_pos_num)[None, :].to(model.device) < batch['pos_num'][:, None]).int()-1
-			neg_mask = (torch.arange(out_dict['prediction'].size(1) - max_pos_num)[None, :].to(model.device) < batch['neg_num'][:, None]).int() - 1
-			labels = torch.cat([pos_mask, neg_mask], dim = -1)
-			loss = model.loss(out_dict, labels)
+			with self.timer.phase('forward'):
+				out_dict = model(batch)
+			with self.timer.phase('loss'):
+				max_pos_num = model.train_max_pos_item
+				pos_mask = 2*(torch.arange(max_pos_num)[None, :].to(model.device) < batch['pos_num'][:, None]).int()-1
+				neg_mask = (torch.arange(out_dict['prediction'].size(1) - max_pos_num)[None, :].to(model.device) < batch['neg_num'][:, None]).int() - 1
+				labels = torch.cat([pos_mask, neg_mask], dim = -1)
+				loss = model.loss(out_dict, labels)
 			if loss.isnan() or loss.isinf() or out_dict['prediction'].isnan().any() or out_dict['prediction'].isinf().any():
 				logging.info("Loss is Nan. Stop training at %d."%(epoch + 1))
-			loss.backward()
-			model.optimizer.step()
+			with self.timer.phase('backward'):
+				loss.backward()
+			with self.timer.phase('optimizer_step'):
+				model.optimizer.step()
+			self._after_step(model)
 			loss_lst.append(loss.detach().cpu().data.numpy())
 		return np.mean(loss_lst).item()
@@ -8,6 +8,7 @@ import sys
 
 from helpers.ImpressionReader import ImpressionReader
 from utils import utils
+from utils.ragged import RaggedArray, ImpressionHistoryStore
 
 class ImpressionSeqReader(ImpressionReader):
 	
@@ -17,10 +18,9 @@ class ImpressionSeqReader(ImpressionReader):
 
 	def _append_his_info(self):
 		"""
-		self.user_his: store both positive and negative user history sequences 
-  			pos: [(i1,t1), (i1,t2), ...];
-     		neg: [(in1,tn1), (in2,tn2),...]
-		add the 'position' of each interaction in user_his to data_df
+		self.user_his: ImpressionHistoryStore of user history sequences, with items and times of each user in two CSR
+			layouts: user_his.pos for positive (clicked) items, user_his.neg for negative ones
+		add the 'position' (resp. 'neg_position') of each impression in the positive (resp. negative) history to data_df
 		"""
 		logging.info('Appending history info with corresponding impressions...')
 		data_dfs = dict()
@@ -35,22 +35,13 @@ class ImpressionSeqReader(ImpressionReader):
 			sort_columns = ['user_id', self.impression_idkey, 'time']
 		sort_df = pd.concat([data_dfs[phase][key_columns] 
 					   for phase in ['train','dev','test']]).sort_values(by=sort_columns, kind='mergesort')
-		position = list()
-		neg_position = list()
-		self.user_his = dict()  # store the already seen sequence of each user
-		for idx, (uid, pids, nids, t) in enumerate(zip(sort_df['user_id'], sort_df['pos_items'], sort_df['neg_items'], sort_df['time'])):
-			if uid not in self.user_his:
-				self.user_his[uid] = {'pos':list(),'neg':list()}
-			position.append(len(self.user_his[uid]['pos']))
-			neg_position.append(len(self.user_his[uid]['neg']))
-			for pid in pids:
-				self.user_his[uid]['pos'].append((pid, t))
-			for nid in nids:
-				self.user_his[uid]['neg'].append((nid, t))
+		self.user_his, position, neg_position = ImpressionHistoryStore.build(
+			sort_df['user_id'].values, RaggedArray.from_cells(sort_df['pos_items'].values),
+			RaggedArray.from_cells(sort_df['neg_items'].values), sort_df['time'].values, self.n_users)
 		sort_df['position'] = position
 		sort_df['neg_position'] = neg_position
 		for key in ['train', 'dev', 'test']:
 			self.data_df[key] = pd.merge(
 				left=self.data_df[key], right=sort_df.drop(columns=['phase','pos_items','neg_items']),
 				how='left', on=['user_id', self.impression_idkey])
-		del sort_df
\ No newline at end of file
+		del sort_df
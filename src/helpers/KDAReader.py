@@ -71,16 +71,19 @@ class KDAReader(KGReader):
                 for val, df in user_df.groupby(attr):
                     delta_t = [t for t in (df['time'].values[1:] - df['time'].values[:-1]) if t > 0]
                     self.interval_dict[attr].extend(delta_t)
-            # Natural item relations
-            for r_idx, relation in enumerate(self.item_relations):
-                for target_idx in range(1, len(iids))[::-1]:  # traverse tail item back-to-front in user history
-                    target_i, target_t = iids[target_idx], times[target_idx]
-                    for source_idx in range(target_idx)[::-1]:  # look forward from the tail item
-                        source_i, source_t = iids[source_idx], times[source_idx]
-                        delta_t = target_t - source_t
-                        if delta_t > 0 and (source_i, r_idx + 1, target_i) in self.triplet_set:
-                            self.interval_dict[relation].append(delta_t)
-                            break
+            # Natural item relations: the latest earlier source item related to each tail item
+            relation_ids = np.arange(1, len(self.item_relations) + 1)
+            chunk = max(1, (1 << 20) // (len(iids) * max(len(relation_ids), 1)))  # bound the [tail, relation, source] masks
+            for end in range(len(iids), 1, -chunk):  # traverse tail items back-to-front in user history
+                targets = np.arange(max(1, end - chunk), end)[::-1]
+                related = self.has_triplets(iids[None, None, :], relation_ids[None, :, None], iids[targets][:, None, None])
+                related &= (np.arange(len(iids))[None, :] < targets[:, None])[:, None, :]
+                related &= (times[None, :] < times[targets][:, None])[:, None, :]  # delta_t > 0
+                latest = len(iids) - 1 - np.argmax(related[..., ::-1], axis=-1)
+                found = related.any(axis=-1)
+                for r_idx, relation in enumerate(self.item_relations):
+                    self.interval_dict[relation].extend(
+                        (times[targets] - times[latest[:, r_idx]])[found[:, r_idx]].tolist())
 
         pickle.dump(self.interval_dict, open(self.interval_file, 'wb'))
 
@@ -1,7 +1,6 @@
 # -*- coding: UTF-8 -*-
 
 import os
-import pickle
 import argparse
 import logging
 import numpy as np
@@ -10,6 +9,7 @@ import pandas as pd
 
 from helpers.SeqReader import SeqReader
 from utils import utils
+from utils.ragged import RaggedArray
 
 
 class KGReader(SeqReader):
@@ -29,49 +29,82 @@ class KGReader(SeqReader):
         self._construct_kg()
 
     def _construct_kg(self):
+        """
+        self.relation_df: (head, relation, tail) triplets of item-item relations (list columns r_* of item_meta, in the
+            order of items, relations and lists), followed by attribute-based relations (columns i_*)
+        self.relation_tails: triplet index, i.e., RaggedArray whose row head * n_relations + relation holds the sorted
+            tails of the head through the relation (CSR neighbor lists, queried in batch by has_triplets)
+        """
         logging.info('Constructing relation triplets...')
-
-        self.triplet_set = set()
-        heads, relations, tails = [], [], []
-
-        self.item_relations = [r for r in self.item_meta_df.columns if r.startswith('r_')]
-        for idx in range(len(self.item_meta_df)):
-            head_item = self.item_meta_df['item_id'].values[idx]
-            for r_idx, r in enumerate(self.item_relations):
-                for tail_item in self.item_meta_df[r].values[idx]:
-                    heads.append(head_item)
-                    tails.append(tail_item)
-                    relations.append(r_idx + 1)  # idx 0 is reserved to be a virtual relation between items
-                    self.triplet_set.add((head_item, r_idx + 1, tail_item))
+        item_meta_df = self.item_meta_df.reset_index(drop=True)
+        triplet_dfs = list()
+
+        self.item_relations = [r for r in item_meta_df.columns if r.startswith('r_')]
+        for r_idx, r in enumerate(self.item_relations):
+            related_df = item_meta_df[['item_id', r]].explode(r).dropna()  # one row per tail, indexed by the head row
+            triplet_dfs.append(pd.DataFrame({
+                'head': related_df['item_id'].values,
+                'relation': r_idx + 1,  # idx 0 is reserved to be a virtual relation between items
+                'tail': related_df[r].values.astype(np.int64)
+            }, index=related_df.index))
+        if len(triplet_dfs):  # the tails of each item are listed relation by relation
+            triplet_dfs = [pd.concat(triplet_dfs).sort_index(kind='mergesort')]
         logging.info('Item-item relations:' + str(self.item_relations))
 
         self.attr_relations = list()
         if self.include_attr:
-            self.attr_relations = [r for r in self.item_meta_df.columns if r.startswith('i_')]
+            self.attr_relations = [r for r in item_meta_df.columns if r.startswith('i_')]
             self.attr_max, self.share_attr_dict = list(), dict()
             for r_idx, attr in enumerate(self.attr_relations):
                 base = self.n_items + np.sum(self.attr_max)  # base index of attribute entities
                 relation_idx = len(self.item_relations) + r_idx + 1  # index of the relation type
-                for item, val in zip(self.item_meta_df['item_id'], self.item_meta_df[attr]):
-                    if val != 0:  # the attribute is not NaN
-                        heads.append(item)
-                        tails.append(int(val + base))
-                        relations.append(relation_idx)
-                        self.triplet_set.add((item, relation_idx, int(val + base)))
-                for val, val_df in self.item_meta_df.groupby(attr):
+                values = item_meta_df[attr].values
+                has_value = values != 0  # the attribute is not NaN
+                triplet_dfs.append(pd.DataFrame({
+                    'head': item_meta_df['item_id'].values[has_value],
+                    'relation': relation_idx,
+                    'tail': (values[has_value] + base).astype(np.int64)
+                }))
+                for val, val_df in item_meta_df.groupby(attr):
                     self.share_attr_dict[int(val + base)] = val_df['item_id'].tolist()
-                self.attr_max.append(self.item_meta_df[attr].max() + 1)
+                self.attr_max.append(item_meta_df[attr].max() + 1)
             logging.info('Attribute-based relations:' + str(self.attr_relations))
 
         self.relations = self.item_relations + self.attr_relations
-        self.relation_df = pd.DataFrame()
-        self.relation_df['head'] = heads
-        self.relation_df['relation'] = relations
-        self.relation_df['tail'] = tails
+        self.relation_df = pd.concat(triplet_dfs, ignore_index=True) if len(triplet_dfs) \
+            else pd.DataFrame({'head': [], 'relation': [], 'tail': []}, dtype=np.int64)
+        self.relation_df = self.relation_df.astype(np.int64)
         self.n_relations = len(self.relations) + 1
         self.n_entities = pd.concat((self.relation_df['head'], self.relation_df['tail'])).max() + 1
+        self.relation_tails = RaggedArray.from_groups(
+            self.relation_df['head'].values * self.n_relations + self.relation_df['relation'].values,
+            self.relation_df['tail'].values, self.n_entities * self.n_relations, unique=True)
         logging.info('"# relation": {}, "# triplet": {}'.format(self.n_relations, len(self.relation_df)))
 
+    def has_triplets(self, heads, relations, tails) -> np.ndarray:
+        """
+        Batch test of whether (head, relation, tail) triplets exist in the KG, e.g., to reject sampled negatives.
+        Arguments are broadcast against each other, and the result has their broadcast shape.
+        """
+        heads, relations, tails = np.broadcast_arrays(np.asarray(heads, dtype=np.int64),
+                                                      np.asarray(relations, dtype=np.int64),
+                                                      np.asarray(tails, dtype=np.int64))
+        found = self.relation_tails.contains((heads * self.n_relations + relations).ravel(), tails.ravel())
+        return found.reshape(heads.shape)
+
+    def latest_related(self, history_items: np.ndarray, target_items: np.ndarray, relations: np.ndarray) -> np.ndarray:
+        """
+        For each target item and each relation r, the index of the latest item h in history_items such that the
+        triplet (h, r, target) exists, or -1 if there is none.
+        :return: array of shape [len(target_items), len(relations)]
+        """
+        history_items, target_items = np.asarray(history_items), np.asarray(target_items)
+        if not len(history_items):
+            return np.full((len(target_items), len(relations)), -1, dtype=np.int64)
+        related = self.has_triplets(history_items[None, None, :], np.asarray(relations)[None, :, None],
+                                    target_items[:, None, None])
+        latest = related.shape[-1] - 1 - np.argmax(related[..., ::-1], axis=-1)
+        return np.where(related.any(axis=-1), latest, -1)
 
 if __name__ == '__main__':
     logging.basicConfig(level=logging.INFO)
@@ -82,6 +115,6 @@ if __name__ == '__main__':
     args.path = '../../data/'
     corpus = KGReader(args)
 
-    corpus_path = os.path.join(args.path, args.dataset, 'KGReader.pkl')
+    corpus_path = os.path.join(args.path, args.dataset, 'KGReader')
     logging.info('Save corpus to {}'.format(corpus_path))
-    pickle.dump(corpus, open(corpus_path, 'wb'))
+    corpus.save_corpus(corpus_path)
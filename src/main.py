@@ -2,7 +2,7 @@
 
 import os
 import sys
-import pickle
+import json
 import logging
 import argparse
 import pandas as pd
@@ -35,9 +35,67 @@ def parse_global_args(parser):
 						help='To save the final validation and test results or not.')
 	parser.add_argument('--regenerate', type=int, default=0,
 						help='Whether to regenerate intermediate files')
+	parser.add_argument('--result_file', type=str, default='',
+						help='Save the final results (and timing) to this json file')
 	return parser
 
 
+def parse_args(argv=None):
+	"""
+	Resolve the model, reader and runner classes of a command line, and parse all their arguments
+	:return: init_args, args, model_name, reader_name, runner_name
+	"""
+	init_parser = argparse.ArgumentParser(description='Model')
+	init_parser.add_argument('--model_name', type=str, default='SASRec', help='Choose a model to run.')
+	init_parser.add_argument('--model_mode', type=str, default='', 
+							 help='Model mode(i.e., suffix), for context-aware models to select "CTR" or "TopK" Ranking task;\
+            						for general/seq models to select Normal (no suffix, model_mode="") or "Impression" setting;\
+                  					for rerankers to select "General" or "Sequential" Baseranker.')
+	init_args, init_extras = init_parser.parse_known_args(argv)
+	
+	model_name = eval('{0}.{0}{1}'.format(init_args.model_name,init_args.model_mode))
+	reader_name = eval('{0}.{0}'.format(model_name.reader))  # model chooses the reader
+	runner_name = eval('{0}.{0}'.format(model_name.runner))  # model chooses the runner
+
+	# Args
+	parser = argparse.ArgumentParser(description='')
+	parser = parse_global_args(parser)
+	parser = reader_name.parse_data_args(parser)
+	parser = runner_name.parse_runner_args(parser)
+	parser = model_name.parse_model_args(parser)
+	args, extras = parser.parse_known_args(argv)
+	if args.n_seeds > 1:  # several seeds trained at once
+		if model_name.runner != 'BaseRunner' or not model_name.stackable:
+			raise ValueError('{} does not support n_seeds > 1'.format(model_name.__name__))
+		if EnsembleRunner.vmap is None:
+			raise ValueError('n_seeds > 1 needs torch.func (torch>=2.0) or functorch (torch 1.13), '
+							 'not found in torch {}'.format(torch.__version__))
+		runner_name = EnsembleRunner.EnsembleRunner
+	
+	args.data_appendix = '' # save different version of data for, e.g., context-aware readers with different groups of context
+	if 'Context' in model_name.reader:
+		args.data_appendix = '_context%d%d%d'%(args.include_item_features,args.include_user_features,
+										args.include_situation_features)
+	return init_args, args, model_name, reader_name, runner_name
+
+
+def load_corpus(args, model_name, reader_name):
+	"""
+	Open the corpus cache of the reader, or read the dataset and save the cache
+	"""
+	corpus_path = os.path.join(args.path, args.dataset, model_name.reader+args.data_appendix)
+	corpus = None
+	if not args.regenerate:
+		corpus = reader_name.load_corpus(corpus_path, args)
+	if corpus is not None:
+		logging.info('Load corpus from {}'.format(corpus_path))
+	else:
+		corpus = reader_name(args)
+		logging.info('Save corpus to {}'.format(corpus_path))
+		corpus.save_corpus(corpus_path)
+	return corpus
+
+
 def main():
 	logging.info('-' * 45 + ' BEGIN: ' + utils.get_time() + ' ' + '-' * 45)
 	exclude = ['check_epoch', 'log_file', 'model_path', 'path', 'pin_memory', 'load',
@@ -55,14 +113,7 @@ def main():
 	logging.info('Device: {}'.format(args.device))
 
 	# Read data
-	corpus_path = os.path.join(args.path, args.dataset, model_name.reader+args.data_appendix+ '.pkl')
-	if not args.regenerate and os.path.exists(corpus_path):
-		logging.info('Load corpus from {}'.format(corpus_path))
-		corpus = pickle.load(open(corpus_path, 'rb'))
-	else:
-		corpus = reader_name(args)
-		logging.info('Save corpus to {}'.format(corpus_path))
-		pickle.dump(corpus, open(corpus_path, 'wb'))
+	corpus = load_corpus(args, model_name, reader_name)
 
 	# Define model
 	model = model_name(args, corpus).to(args.device)
@@ -78,19 +129,36 @@ def main():
 	# Run model
 	runner = runner_name(args)
 	logging.info('Test Before Training: ' + runner.print_res(data_dict['test']))
-	if args.load > 0:
-		model.load_model()
+	if args.load > 0:  # resume the full training state of an interrupted run if there is one, else the best model
+		if not (args.train > 0 and runner.load_checkpoint(model)):
+			model.load_model()
 	if args.train > 0:
 		runner.train(data_dict)
 
-	# Evaluate final results
-	eval_res = runner.print_res(data_dict['dev'])
-	logging.info(os.linesep + 'Dev  After Training: ' + eval_res)
-	eval_res = runner.print_res(data_dict['test'])
-	logging.info(os.linesep + 'Test After Training: ' + eval_res)
-	if args.save_final_results==1: # save the prediction results
-		save_rec_results(data_dict['dev'], runner, 100)
-		save_rec_results(data_dict['test'], runner, 100)
+	# Evaluate final results (of each seed when several seeds are trained at once)
+	seeds = runner.seeds if args.n_seeds > 1 else [args.random_seed]
+	results, save_appendix = list(), runner.save_appendix
+	for i, seed in enumerate(seeds):
+		if len(seeds) > 1:
+			model.load_model(runner.seed_path(model.model_path, seed))
+			runner.save_appendix = runner.seed_path(save_appendix, seed)
+			logging.info(os.linesep + 'Seed {}:'.format(seed))
+		dev_result = runner.evaluate(data_dict['dev'], runner.topk, runner.metrics)
+		logging.info(os.linesep + 'Dev  After Training: (' + utils.format_metric(dev_result) + ')')
+		test_result = runner.evaluate(data_dict['test'], runner.topk, runner.metrics)
+		logging.info(os.linesep + 'Test After Training: (' + utils.format_metric(test_result) + ')')
+		results.append({'seed': seed, 'dev': {k: float(v) for k, v in dev_result.items()},
+						'test': {k: float(v) for k, v in test_result.items()},
+						'best_iter': runner.best_epochs[i] if len(seeds) > 1 else runner.best_epoch,
+						'train_time': runner.train_time})
+		if args.save_final_results==1: # save the prediction results
+			save_rec_results(data_dict['dev'], runner, 100)
+			save_rec_results(data_dict['test'], runner, 100)
+	runner.save_appendix = save_appendix
+	if args.result_file != '':  # structured results, e.g., for exp.py
+		utils.check_dir(args.result_file)
+		with open(args.result_file, 'w') as f:
+			json.dump(results[0] if len(results) == 1 else {'seeds': results}, f)
 	model.actions_after_train()
 	logging.info(os.linesep + '-' * 45 + ' END: ' + utils.get_time() + ' ' + '-' * 45)
 
@@ -116,19 +184,11 @@ def save_rec_results(dataset, runner, topk):
 		rec_df.to_csv(result_path, sep=args.sep, index=False)
 	elif init_args.model_mode in ['TopK','']: # TopK Ranking task
 		logging.info('Saving top-{} recommendation results to: {}'.format(topk, result_path))
-		predictions = runner.predict(dataset)  # n_users, n_candidates
-		users, rec_items, rec_predictions = list(), list(), list()
-		for i in range(len(dataset)):
-			info = dataset[i]
-			users.append(info['user_id'])
-			item_scores = zip(info['item_id'], predictions[i])
-			sorted_lst = sorted(item_scores, key=lambda x: x[1], reverse=True)[:topk]
-			rec_items.append([x[0] for x in sorted_lst])
-			rec_predictions.append([x[1] for x in sorted_lst])
+		rec_items, rec_predictions = runner.recommend(dataset, topk)  # n_users, topk
 		rec_df = pd.DataFrame(columns=['user_id', 'rec_items', 'rec_predictions'])
-		rec_df['user_id'] = users
-		rec_df['rec_items'] = rec_items
-		rec_df['rec_predictions'] = rec_predictions
+		rec_df['user_id'] = dataset.data['user_id']
+		rec_df['rec_items'] = rec_items.tolist()
+		rec_df['rec_predictions'] = rec_predictions.tolist()
 		rec_df.to_csv(result_path, sep=args.sep, index=False)
 	elif init_args.model_mode in ['Impression','General','Sequential']: # List-wise reranking task: Impression is reranking task for general/seq baseranker. General/Sequential is reranking task for rerankers with general/sequential input.
 		logging.info('Saving all recommendation results to: {}'.format(result_path))
@@ -153,30 +213,7 @@ def save_rec_results(dataset, runner, topk):
 	logging.info("{} Prediction results saved!".format(dataset.phase))
 
 if __name__ == '__main__':
-	init_parser = argparse.ArgumentParser(description='Model')
-	init_parser.add_argument('--model_name', type=str, default='SASRec', help='Choose a model to run.')
-	init_parser.add_argument('--model_mode', type=str, default='', 
-							 help='Model mode(i.e., suffix), for context-aware models to select "CTR" or "TopK" Ranking task;\
-            						for general/seq models to select Normal (no suffix, model_mode="") or "Impression" setting;\
-                  					for rerankers to select "General" or "Sequential" Baseranker.')
-	init_args, init_extras = init_parser.parse_known_args()
-	
-	model_name = eval('{0}.{0}{1}'.format(init_args.model_name,init_args.model_mode))
-	reader_name = eval('{0}.{0}'.format(model_name.reader))  # model chooses the reader
-	runner_name = eval('{0}.{0}'.format(model_name.runner))  # model chooses the runner
-
-	# Args
-	parser = argparse.ArgumentParser(description='')
-	parser = parse_global_args(parser)
-	parser = reader_name.parse_data_args(parser)
-	parser = runner_name.parse_runner_args(parser)
-	parser = model_name.parse_model_args(parser)
-	args, extras = parser.parse_known_args()
-	
-	args.data_appendix = '' # save different version of data for, e.g., context-aware readers with different groups of context
-	if 'Context' in model_name.reader:
-		args.data_appendix = '_context%d%d%d'%(args.include_item_features,args.include_user_features,
-										args.include_situation_features)
+	init_args, args, model_name, reader_name, runner_name = parse_args()
 
 	# Logging configuration
 	log_args = [init_args.model_name+init_args.model_mode, args.dataset+args.data_appendix, str(args.random_seed)]
@@ -10,21 +10,27 @@ from torch.nn.utils.rnn import pad_sequence
 from typing import List
 
 from utils import utils
+from utils.ragged import RaggedArray, gather_padded
 from models.BaseModel import *
 
 def get_context_feature(feed_dict, index, corpus, data):
 	"""
-	Get context features for the feed_dict, including user, item, and situation context
+	Get context features for the feed_dict, including user, item (for a single item or an item list), and situation context
  	"""
-	for c in corpus.user_feature_names:
-		feed_dict[c] = corpus.user_features[feed_dict['user_id']][c]
+	feed_dict.update(corpus.get_user_features(feed_dict['user_id']))
 	for c in corpus.situation_feature_names:
 		feed_dict[c] = data[c][index]
-	for c in corpus.item_feature_names:
-		if type(feed_dict['item_id']) in [int, np.int32, np.int64]: # for a single item
-			feed_dict[c] = corpus.item_features[feed_dict['item_id']][c]
-		else: # for item list
-			feed_dict[c] = np.array([corpus.item_features[iid][c] for iid in feed_dict['item_id']])
+	feed_dict.update(corpus.get_item_features(feed_dict['item_id']))
+	return feed_dict
+
+def get_batch_context_feature(feed_dict, indices, dataset):
+	"""
+	Batch version of get_context_feature, where user and item ids are arrays of the batch
+	"""
+	feed_dict.update(dataset.corpus.get_user_features(feed_dict['user_id']))
+	for c in dataset.corpus.situation_feature_names:
+		feed_dict[c] = dataset._gather(c, indices)
+	feed_dict.update(dataset.corpus.get_item_features(feed_dict['item_id']))
 	return feed_dict
 
 class ContextModel(GeneralModel):
@@ -61,14 +67,16 @@ class ContextModel(GeneralModel):
 		return loss
 	
 	class Dataset(GeneralModel.Dataset):
-		def __init__(self, model, corpus, phase):
-			super().__init__(model, corpus, phase)
-
 		def _get_feed_dict(self, index):
 			feed_dict = super()._get_feed_dict(index)
 			feed_dict = get_context_feature(feed_dict, index, self.corpus, self.data)
 			return feed_dict
 
+		def _get_batch_feed_dict(self, indices):
+			feed_dict = super()._get_batch_feed_dict(indices)
+			feed_dict = get_batch_context_feature(feed_dict, indices, self)
+			return feed_dict
+
 
 class ContextCTRModel(CTRModel):
 	# context model for CTR prediction tasks
@@ -103,26 +111,37 @@ class ContextSeqModel(ContextModel):
 		self.add_historical_situations = args.add_historical_situations
 
 	class Dataset(SequentialModel.Dataset):
-		def __init__(self, model, corpus, phase):
-			super().__init__(model, corpus, phase)
-		
 		def _get_feed_dict(self, index):
 			# get item features, user features, and context features separately
 			feed_dict = super()._get_feed_dict(index)
-			pos = self.data['position'][index]
-			user_seq = self.corpus.user_his[feed_dict['user_id']][:pos]
-			if self.model.history_max > 0:
-				user_seq = user_seq[-self.model.history_max:]
 			feed_dict = get_context_feature(feed_dict, index, self.corpus, self.data)
-			for c in self.corpus.item_feature_names: # get historical item context features
-				feed_dict['history_'+c] = np.array([self.corpus.item_features[iid][c] for iid in feed_dict['history_items']])
+			# get historical item context features
+			feed_dict.update(self.corpus.get_item_features(feed_dict['history_items'], prefix='history_'))
 			if self.model.add_historical_situations: # get historical situation context features
+				window = self.corpus.user_his.window_slice(
+					feed_dict['user_id'], self.data['position'][index], self.model.history_max)
+				situations = self.corpus.user_his_situations[window]
 				for idx,c in enumerate(self.corpus.situation_feature_names):
-					feed_dict['history_'+c] = np.array([inter[-1][idx] for inter in user_seq])
+					feed_dict['history_'+c] = situations[:, idx]
 			feed_dict['history_item_id'] = feed_dict['history_items']
 			feed_dict.pop('history_items')
 			return feed_dict
 
+		def _get_batch_feed_dict(self, indices):
+			feed_dict = super()._get_batch_feed_dict(indices)
+			feed_dict = get_batch_context_feature(feed_dict, indices, self)
+			history_features = self.corpus.get_item_features(feed_dict['history_items'], prefix='history_')
+			for c, values in history_features.items(): # padded history items (0) have no features
+				feed_dict[c] = np.where(feed_dict['history_items'] > 0, values, 0)
+			if self.model.add_historical_situations: # windows aligned with the history items, padded with 0
+				starts, lengths = self.corpus.user_his.batch_window_bounds(
+					feed_dict['user_id'], self._gather('position', indices), self.model.history_max)
+				situations = gather_padded(self.corpus.user_his_situations, starts, lengths)
+				for idx,c in enumerate(self.corpus.situation_feature_names):
+					feed_dict['history_'+c] = situations[:, :, idx]
+			feed_dict['history_item_id'] = feed_dict.pop('history_items')
+			return feed_dict
+
 class ContextSeqCTRModel(ContextCTRModel):
 	reader = 'ContextSeqReader'
 	
@@ -144,23 +163,25 @@ class ContextSeqCTRModel(ContextCTRModel):
 			super().__init__(model, corpus, phase)
 			idx_select = np.array(self.data['position']) > 0  # history length must be non-zero
 			for key in self.data:
-				self.data[key] = np.array(self.data[key])[idx_select]
+				if isinstance(self.data[key], RaggedArray):
+					self.data[key] = self.data[key].subset(np.nonzero(idx_select)[0])
+				else:
+					self.data[key] = np.array(self.data[key])[idx_select]
 		
 		def _get_feed_dict(self, index):
 			feed_dict = super()._get_feed_dict(index)
 			pos = self.data['position'][index]
-			user_seq = self.corpus.user_his[feed_dict['user_id']][:pos]
-			if self.model.history_max > 0:
-				user_seq = user_seq[-self.model.history_max:]
 			# feed_dict = get_context_feature(feed_dict, index, self.corpus, self.data)
-			feed_dict['history_items'] = np.array([x[0] for x in user_seq])
-			feed_dict['history_times'] = np.array([x[1] for x in user_seq])
+			feed_dict['history_items'], feed_dict['history_times'] = self.corpus.user_his.window(
+				feed_dict['user_id'], pos, self.model.history_max)
 			feed_dict['lengths'] = len(feed_dict['history_items'])
-			for c in self.corpus.item_feature_names: # get historical item context features
-				feed_dict['history_'+c] = np.array([self.corpus.item_features[iid][c] for iid in feed_dict['history_items']])
+			# get historical item context features
+			feed_dict.update(self.corpus.get_item_features(feed_dict['history_items'], prefix='history_'))
 			if self.model.add_historical_situations: # get historical situation context features
+				situations = self.corpus.user_his_situations[
+					self.corpus.user_his.window_slice(feed_dict['user_id'], pos, self.model.history_max)]
 				for idx,c in enumerate(self.corpus.situation_feature_names):
-					feed_dict['history_'+c] = np.array([inter[-1][idx] for inter in user_seq])
+					feed_dict['history_'+c] = situations[:, idx]
 			feed_dict['history_item_id'] = feed_dict['history_items']
 			feed_dict.pop('history_items')
 			return feed_dict
@@ -179,6 +179,20 @@ class ImpressionModel(GeneralModel):
 				'neg_num': min(self.data['neg_num'][index],self.neg_len)
 			}
 			return feed_dict
+
+		def _get_batch_feed_dict(self, indices):
+			if self.phase != 'train' and self.model.test_all:
+				neg_items = np.tile(np.arange(1, self.corpus.n_items)[:self.neg_len], (len(indices), 1))
+			else:
+				neg_items = self._gather('neg_items', indices)[:, :self.neg_len]
+			feed_dict = {
+				'user_id': self._gather('user_id', indices),
+				'pos_items': self._gather('pos_items', indices)[:, :self.pos_len],
+				'neg_items': neg_items,
+				'pos_num': np.minimum(self._gather('pos_num', indices), self.pos_len),
+				'neg_num': np.minimum(self._gather('neg_num', indices), self.neg_len)
+			}
+			return feed_dict
 		
 		# Collate a batch according to the list of feed dicts
 		def collate_batch(self, feed_dicts: List[dict]):
@@ -237,17 +251,12 @@ class ImpressionSeqModel(ImpressionModel):
 		def _get_feed_dict(self, index):
 			feed_dict = ImpressionModel.Dataset._get_feed_dict(self,index)
 			
-			pos = self.data['position'][index]
-			neg_pos = self.data['neg_position'][index]
-			user_seq = self.corpus.user_his[feed_dict['user_id']]['pos'][:pos]#positive
-			neg_user_seq = self.corpus.user_his[feed_dict['user_id']]['neg'][:neg_pos]#negative
-			if self.model.history_max > 0:
-				user_seq = user_seq[-self.model.history_max:]
-				neg_user_seq = neg_user_seq[-self.model.history_max:]
-			feed_dict['history_items'] = np.array([x[0] for x in user_seq])
-			feed_dict['neg_history_items'] = np.array([x[0] for x in neg_user_seq])
-			feed_dict['history_times'] = np.array([x[1] for x in user_seq])
-			feed_dict['neg_history_times'] = np.array([x[1] for x in neg_user_seq])
+			# views of the latest history_max positive and negative items before the impression
+			user_his = self.corpus.user_his
+			feed_dict['history_items'], feed_dict['history_times'] = user_his.pos.window(
+				feed_dict['user_id'], self.data['position'][index], self.model.history_max)
+			feed_dict['neg_history_items'], feed_dict['neg_history_times'] = user_his.neg.window(
+				feed_dict['user_id'], self.data['neg_position'][index], self.model.history_max)
 			feed_dict['lengths'] = len(feed_dict['history_items'])
 			feed_dict['neg_lengths'] = len(feed_dict['neg_history_items'])
 			return feed_dict
@@ -11,11 +11,16 @@ from torch.nn.utils.rnn import pad_sequence
 from typing import List
 
 from utils import utils
+from utils import corpus_cache
+from utils.sampler import NegativeSampler
+from utils.ragged import RaggedArray, gather_padded
 from helpers.BaseReader import BaseReader
 
 class BaseModel(nn.Module):
 	reader, runner = None, None  # choose helpers in specific model classes
 	extra_log_args = []
+	permutation_invariant = False  # whether the score of a candidate never depends on its place in item_id
+	stackable = False  # whether replicas can be trained as a stacked ensemble (see helpers.EnsembleRunner)
 
 	@staticmethod
 	def parse_model_args(parser):
@@ -23,6 +28,8 @@ class BaseModel(nn.Module):
 							help='Model save path.')
 		parser.add_argument('--buffer', type=int, default=1,
 							help='Whether to buffer feed dicts for dev/test')
+		parser.add_argument('--batch_feed', type=int, default=0,
+							help='Whether to construct feed dicts of a whole batch at once (if the dataset supports it)')
 		return parser
 
 	@staticmethod
@@ -39,6 +46,7 @@ class BaseModel(nn.Module):
 		self.device = args.device
 		self.model_path = args.model_path
 		self.buffer = args.buffer
+		self.batch_feed = args.batch_feed
 		self.optimizer = None
 		self.check_list = list()  # observe tensors in check_list every check_epoch
 
@@ -102,8 +110,10 @@ class BaseModel(nn.Module):
 			self.phase = phase  # train / dev / test
 
 			self.buffer_dict = dict()
+			self.column_cache = dict()
+			self.batch_feed = model.batch_feed and self._batch_feed_implemented()
 			#self.data = utils.df_to_dict(corpus.data_df[phase])#this raise the VisibleDeprecationWarning: Creating an ndarray from ragged nested sequences warning
-			self.data = corpus.data_df[phase].to_dict('list')
+			self.data = corpus_cache.frame_columns(corpus.data_df[phase])
 			# ↑ DataFrame is not compatible with multi-thread operations
 
 		def __len__(self):
@@ -113,7 +123,9 @@ class BaseModel(nn.Module):
 			return len(self.data)
 
 		def __getitem__(self, index: int) -> dict:
-			if self.model.buffer and self.phase != 'train':
+			if self.batch_feed and not np.isscalar(index):  # the indices of a whole batch, see BaseRunner._data_loader
+				return self._get_batch_feed_dict(np.asarray(index))
+			if self.model.buffer and self.phase != 'train' and not self.batch_feed:
 				return self.buffer_dict[index]
 			return self._get_feed_dict(index)
 
@@ -121,9 +133,49 @@ class BaseModel(nn.Module):
 		def _get_feed_dict(self, index: int) -> dict:
 			pass
 
+		# Optional: construct input data for a whole batch, each value is stacked (and padded) along the first axis
+		def _get_batch_feed_dict(self, indices: np.ndarray) -> dict:
+			pass
+
+		@classmethod
+		def _batch_feed_implemented(cls) -> bool:
+			"""
+			The batch path is only taken when _get_batch_feed_dict is defined in the same class as (or a subclass of)
+			the ones defining _get_feed_dict and collate_batch, so that datasets customizing the per-instance path
+			keep working through the fallback.
+			"""
+			def owner(method):
+				return next(c for c in cls.__mro__ if method in c.__dict__)
+			batch_owner = owner('_get_batch_feed_dict')
+			return batch_owner is not BaseModel.Dataset and \
+				all(issubclass(batch_owner, owner(m)) for m in ['_get_feed_dict', 'collate_batch'])
+
+		def _gather(self, key: str, indices: np.ndarray) -> np.ndarray:
+			"""
+			Values of a data column for a batch. Lists in cells (e.g., neg_items) are right-padded with 0.
+			Columns kept as Python lists are converted once and cached until the column is replaced.
+			"""
+			column = self.data[key]
+			if isinstance(column, RaggedArray):  # list-value column of a loaded corpus cache
+				return column.pad(indices)
+			if not isinstance(column, np.ndarray) or column.dtype == object:
+				cached = self.column_cache.get(key)
+				if cached is None or cached[0] is not column:
+					array = None
+					if len(column) and isinstance(column[0], (list, tuple, np.ndarray)):
+						array = RaggedArray.from_cells(column)
+						if array is None:  # e.g., cells of float ids
+							dtype = next((np.asarray(c).dtype for c in column if len(c)), np.int64)
+							array = RaggedArray.from_lists(column, dtype=dtype)
+					cached = self.column_cache[key] = (column, array if array is not None else np.array(column))
+				column = cached[1]
+			if isinstance(column, RaggedArray):
+				return column.pad(indices)
+			return column[indices]
+
 		# Called after initialization
 		def prepare(self):
-			if self.model.buffer and self.phase != 'train':
+			if self.model.buffer and self.phase != 'train' and not self.batch_feed:
 				for i in tqdm(range(len(self)), leave=False, desc=('Prepare ' + self.phase)):
 					self.buffer_dict[i] = self._get_feed_dict(i)
 
@@ -131,8 +183,13 @@ class BaseModel(nn.Module):
 		def actions_before_epoch(self):
 			pass
 
-		# Collate a batch according to the list of feed dicts
+		# Collate a batch according to the list of feed dicts (or the feed dict of the batch from _get_batch_feed_dict)
 		def collate_batch(self, feed_dicts: List[dict]) -> dict:
+			if type(feed_dicts) is dict:
+				feed_dict = {k: torch.from_numpy(np.asarray(v)) for k, v in feed_dicts.items()}
+				feed_dict['batch_size'] = len(next(iter(feed_dicts.values())))
+				feed_dict['phase'] = self.phase
+				return feed_dict
 			feed_dict = dict()
 			for key in feed_dicts[0]:
 				if isinstance(feed_dicts[0][key], np.ndarray):
@@ -158,10 +215,18 @@ class GeneralModel(BaseModel):
 	def parse_model_args(parser):
 		parser.add_argument('--num_neg', type=int, default=1,
 							help='The number of negative items during training.')
+		parser.add_argument('--neg_dist', type=str, default='uniform',
+							help='Distribution of sampled negative items: uniform, pop (item popularity in the training set).')
 		parser.add_argument('--dropout', type=float, default=0,
 							help='Dropout probability for each deep layer')
 		parser.add_argument('--test_all', type=int, default=0,
 							help='Whether testing on all the items.')
+		parser.add_argument('--sampled_softmax', type=int, default=0,
+							help='Whether to train dot-product models by a softmax over in-batch positives and shared negatives.')
+		parser.add_argument('--shared_neg', type=int, default=0,
+							help='Number of negatives (drawn from neg_dist) shared by a batch in sampled softmax training.')
+		parser.add_argument('--logq', type=int, default=1,
+							help='Whether to correct sampled softmax logits by the log sampling probability of each item.')
 		return BaseModel.parse_model_args(parser)
 
 	def __init__(self, args, corpus):
@@ -169,8 +234,77 @@ class GeneralModel(BaseModel):
 		self.user_num = corpus.n_users
 		self.item_num = corpus.n_items
 		self.num_neg = args.num_neg
+		self.neg_dist = args.neg_dist
 		self.dropout = args.dropout
 		self.test_all = args.test_all
+		# score the whole item table instead of candidate id lists when testing on all the items
+		self.full_ranking = self.test_all and type(self).full_ranking_vectors is not GeneralModel.full_ranking_vectors
+		# sampled softmax replaces the default BPR loss of dot-product models
+		self.sampled_softmax = args.sampled_softmax and type(self).loss in [GeneralModel.loss, SequentialModel.loss] \
+			and type(self).full_ranking_vectors is not GeneralModel.full_ranking_vectors
+		if args.sampled_softmax and not self.sampled_softmax:
+			logging.warning('{} has a custom loss or no dot-product head, sampled_softmax is ignored'.format(
+				type(self).__name__))
+		self.shared_neg = args.shared_neg
+		self.logq = args.logq
+		if self.sampled_softmax:
+			# in-batch positives follow the training popularity, shared negatives follow neg_dist
+			item_counts = np.bincount(corpus.data_df['train']['item_id'].values, minlength=self.item_num)
+			item_pop = item_counts / item_counts.sum()
+			pool_prob = item_pop if self.neg_dist == 'pop' else np.full(self.item_num, 1. / (self.item_num - 1))
+			self.register_buffer('log_pop', torch.from_numpy(np.log(item_pop + 1e-12)).float(), persistent=False)
+			self.register_buffer('log_pool', torch.from_numpy(np.log(pool_prob + 1e-12)).float(), persistent=False)
+
+	def full_ranking_vectors(self, feed_dict: dict) -> tuple:
+		"""
+		Implemented by models with a user/item dot-product head.
+		:return: user representations of the batch [batch_size, emb_size] (or [batch_size, n_interests, emb_size],
+				 scored by the best interest), and the table of all item vectors [n_items, emb_size]
+		"""
+		pass
+
+	def full_predict(self, feed_dict: dict, chunk_size: int = 0) -> torch.Tensor:
+		"""
+		Scores of all the items [batch_size, n_items]: the user representation is computed once,
+		and then multiplied with the item table chunk by chunk (all at once if chunk_size <= 0).
+		"""
+		u_vectors, i_table = self.full_ranking_vectors(feed_dict)
+		chunk_size = chunk_size if chunk_size > 0 else len(i_table)
+		scores = list()
+		for start in range(0, len(i_table), chunk_size):
+			chunk_scores = torch.matmul(u_vectors, i_table[start:start + chunk_size].t())
+			if u_vectors.dim() == 3:  # multiple interests
+				chunk_scores = chunk_scores.max(dim=1)[0]
+			scores.append(chunk_scores)
+		return torch.cat(scores, dim=1)
+
+	def _sampled_softmax_inputs(self, feed_dict: dict) -> tuple:
+		# user representations, their target items, and the table of all item vectors
+		u_vectors, i_table = self.full_ranking_vectors(feed_dict)
+		return u_vectors, feed_dict['item_id'][:, 0], i_table
+
+	def sampled_softmax_loss(self, feed_dict: dict) -> torch.Tensor:
+		"""
+		Softmax cross entropy of each positive against the other positives of the batch and the negatives shared by
+		the batch (feed_dict['shared_items']), all scored by a single [B, D] x [D, B + P] matmul.
+		With logq, logits are corrected by the log expected count of each candidate in the pool it comes from,
+		and candidates equal to the target of a row (accidental hits) are masked out for that row.
+		"""
+		u_vectors, targets, i_table = self._sampled_softmax_inputs(feed_dict)
+		shared_items = feed_dict.get('shared_items', targets[:0])
+		candidates = torch.cat([targets, shared_items])
+		logits = torch.matmul(u_vectors, i_table[candidates].t())  # [B, B + P]
+		if u_vectors.dim() == 3:  # multiple interests
+			logits = logits.max(dim=1)[0]
+		if self.logq:
+			log_q = torch.cat([self.log_pop[targets] + np.log(len(targets)),
+							   self.log_pool[shared_items] + np.log(max(len(shared_items), 1))])
+			logits = logits - log_q[None, :]
+		batch_range = torch.arange(len(targets), device=logits.device)
+		hits = candidates[None, :] == targets[:, None]
+		hits[batch_range, batch_range] = False
+		logits = logits.masked_fill(hits, -np.inf)
+		return F.cross_entropy(logits, batch_range)
 
 	def loss(self, out_dict: dict) -> torch.Tensor:
 		"""
@@ -189,9 +323,20 @@ class GeneralModel(BaseModel):
 		return loss
 
 	class Dataset(BaseModel.Dataset):
+		def __init__(self, model, corpus, phase):
+			super().__init__(model, corpus, phase)
+			self.neg_sampler = None
+			if self.phase == 'train':
+				item_counts = None
+				if model.neg_dist == 'pop':
+					item_counts = np.bincount(corpus.data_df['train']['item_id'].values, minlength=corpus.n_items)
+				self.neg_sampler = NegativeSampler(corpus.n_items, distribution=model.neg_dist, counts=item_counts)
+
 		def _get_feed_dict(self, index):
 			user_id, target_item = self.data['user_id'][index], self.data['item_id'][index]
-			if self.phase != 'train' and self.model.test_all:
+			if self.phase != 'train' and self.model.full_ranking:
+				neg_items = np.zeros(0, dtype=int)  # all the items are scored by full_predict
+			elif self.phase != 'train' and self.model.test_all:
 				neg_items = np.arange(1, self.corpus.n_items)
 			else:
 				neg_items = self.data['neg_items'][index]
@@ -202,16 +347,27 @@ class GeneralModel(BaseModel):
 			}
 			return feed_dict
 
+		def _get_batch_feed_dict(self, indices):
+			user_ids, target_items = self._gather('user_id', indices), self._gather('item_id', indices)
+			if self.phase != 'train' and self.model.full_ranking:
+				neg_items = np.zeros((len(indices), 0), dtype=int)
+			elif self.phase != 'train' and self.model.test_all:
+				neg_items = np.tile(np.arange(1, self.corpus.n_items), (len(indices), 1))
+			else:
+				neg_items = self._gather('neg_items', indices)
+			item_ids = np.concatenate([target_items[:, None], neg_items], axis=1).astype(int)
+			feed_dict = {
+				'user_id': user_ids,
+				'item_id': item_ids
+			}
+			return feed_dict
+
 		# Sample negative items for all the instances
 		def actions_before_epoch(self):
-			neg_items = np.random.randint(1, self.corpus.n_items, size=(len(self), self.model.num_neg))
-			for i, u in enumerate(self.data['user_id']):
-				clicked_set = self.corpus.train_clicked_set[u]  # neg items are possible to appear in dev/test set
-				# clicked_set = self.corpus.clicked_set[u]  # neg items will not include dev/test set
-				for j in range(self.model.num_neg):
-					while neg_items[i][j] in clicked_set:
-						neg_items[i][j] = np.random.randint(1, self.corpus.n_items)
-			self.data['neg_items'] = neg_items
+			# neg items are possible to appear in dev/test set (only training clicks are excluded)
+			num_neg = 0 if self.model.sampled_softmax else self.model.num_neg  # negatives are shared by the batch
+			self.data['neg_items'] = self.neg_sampler.sample(
+				self.data['user_id'], num_neg, self.corpus.train_clicked_set)
 
 class SequentialModel(GeneralModel):
 	reader = 'SeqReader'
@@ -220,30 +376,137 @@ class SequentialModel(GeneralModel):
 	def parse_model_args(parser):
 		parser.add_argument('--history_max', type=int, default=20,
 							help='Maximum length of history.')
+		parser.add_argument('--seq_train', type=int, default=0,
+							help='Whether to train causal encoders on user windows with a loss at every position.')
 		return GeneralModel.parse_model_args(parser)
 
 	def __init__(self, args, corpus):
 		super().__init__(args, corpus)
 		self.history_max = args.history_max
+		# one forward pass over a window of the history supervises all its positions
+		self.seq_train = args.seq_train and type(self).sequence_vectors is not SequentialModel.sequence_vectors
+		if args.seq_train and not self.seq_train:
+			logging.warning('{} has no causal sequence encoder, seq_train is ignored'.format(type(self).__name__))
+
+	def sequence_vectors(self, feed_dict: dict) -> tuple:
+		"""
+		Implemented by models with a causal encoder and a user/item dot-product head.
+		:return: user representations after each prefix of the history [batch_size, history_max, emb_size]
+				 (the vector at position t only depends on the items up to t), and the table of all item vectors
+		"""
+		pass
+
+	def seq_forward(self, feed_dict: dict) -> dict:
+		"""
+		Scores of the candidates of every position: item_id is [batch_size, history_max, n_candidates],
+		where the target of position t is the history item at t + 1.
+		"""
+		seq_vectors, i_table = self.sequence_vectors(feed_dict)
+		prediction = (seq_vectors[:, :, None, :] * i_table[feed_dict['item_id']]).sum(-1)
+		len_range = torch.arange(prediction.shape[1], device=prediction.device)
+		valid = len_range[None, :] < feed_dict['lengths'][:, None]
+		return {'prediction': prediction, 'valid': valid}
+
+	def _sampled_softmax_inputs(self, feed_dict: dict) -> tuple:
+		if not self.seq_train or feed_dict['item_id'].dim() == 2:
+			return super()._sampled_softmax_inputs(feed_dict)
+		seq_vectors, i_table = self.sequence_vectors(feed_dict)
+		len_range = torch.arange(seq_vectors.shape[1], device=seq_vectors.device)
+		valid = len_range[None, :] < feed_dict['lengths'][:, None]
+		return seq_vectors[valid], feed_dict['item_id'][:, :, 0][valid], i_table
+
+	def loss(self, out_dict: dict) -> torch.Tensor:
+		if out_dict['prediction'].dim() == 3:  # seq-to-seq training, each valid position is an instance
+			out_dict = dict(out_dict, prediction=out_dict['prediction'][out_dict['valid']])
+		return super().loss(out_dict)
 
 	class Dataset(GeneralModel.Dataset):
 		def __init__(self, model, corpus, phase):
 			super().__init__(model, corpus, phase)
 			idx_select = np.array(self.data['position']) > 0  # history length must be non-zero
 			for key in self.data:
-				self.data[key] = np.array(self.data[key],dtype=object)[idx_select].tolist()
+				if isinstance(self.data[key], RaggedArray):
+					self.data[key] = self.data[key].subset(np.nonzero(idx_select)[0])
+				else:
+					self.data[key] = np.array(self.data[key],dtype=object)[idx_select].tolist()
+			self.seq_train = phase == 'train' and getattr(model, 'seq_train', False)
+			if self.seq_train:
+				self.data = self._user_windows(np.array(self.data['user_id'], dtype=np.int64),
+											   np.array(self.data['position'], dtype=np.int64))
+				self.window_offsets = np.concatenate([[0], np.cumsum(self.data['lengths'])]).astype(np.int64)
+
+		def _user_windows(self, user_ids: np.ndarray, positions: np.ndarray) -> dict:
+			"""
+			Split the training targets of each user into windows of at most history_max consecutive positions
+			(aligned to the latest one). Window i covers the targets at positions [position - lengths, position),
+			its input is the history items one step before.
+			"""
+			order = np.lexsort((positions, user_ids))
+			user_ids, positions = user_ids[order], positions[order]
+			new_run = np.ones(len(user_ids), dtype=bool)
+			new_run[1:] = (user_ids[1:] != user_ids[:-1]) | (positions[1:] != positions[:-1] + 1)
+			run_id = np.cumsum(new_run) - 1
+			run_last = np.append(np.where(new_run)[0][1:] - 1, len(user_ids) - 1)
+			from_end = run_last[run_id] - np.arange(len(user_ids))
+			window_len = self.model.history_max if self.model.history_max > 0 else len(user_ids) + 1
+			new_window = new_run | (from_end % window_len == window_len - 1)
+			window_last = np.append(np.where(new_window)[0][1:] - 1, len(user_ids) - 1)
+			return {
+				'user_id': user_ids[window_last],
+				'position': positions[window_last] + 1,
+				'lengths': np.diff(np.append(np.where(new_window)[0], len(user_ids)))
+			}
 
 		def _get_feed_dict(self, index):
-			feed_dict = super()._get_feed_dict(index)
-			pos = self.data['position'][index]
-			user_seq = self.corpus.user_his[feed_dict['user_id']][:pos]
-			if self.model.history_max > 0:
-				user_seq = user_seq[-self.model.history_max:]
-			feed_dict['history_items'] = np.array([x[0] for x in user_seq])
-			feed_dict['history_times'] = np.array([x[1] for x in user_seq])
-			feed_dict['lengths'] = len(feed_dict['history_items'])
+			if not self.seq_train:
+				feed_dict = super()._get_feed_dict(index)
+				pos = self.data['position'][index]
+				feed_dict['history_items'], feed_dict['history_times'] = self.corpus.user_his.window(
+					feed_dict['user_id'], pos, self.model.history_max)
+				feed_dict['lengths'] = len(feed_dict['history_items'])
+				return feed_dict
+			user_id, pos, length = self.data['user_id'][index], self.data['position'][index], self.data['lengths'][index]
+			history_items, history_times = self.corpus.user_his.window(user_id, pos - 1, length)
+			target_items = self.corpus.user_his.window(user_id, pos, length)[0]
+			neg_items = self.neg_items[self.window_offsets[index]:self.window_offsets[index + 1]]
+			feed_dict = {
+				'user_id': user_id,
+				'item_id': np.concatenate([target_items[:, None], neg_items], axis=1).astype(int),
+				'history_items': history_items,
+				'history_times': history_times,
+				'lengths': length
+			}
+			return feed_dict
+
+		def _get_batch_feed_dict(self, indices):
+			if not self.seq_train:
+				feed_dict = super()._get_batch_feed_dict(indices)
+				pos = self._gather('position', indices)
+				feed_dict['history_items'], feed_dict['history_times'], feed_dict['lengths'] = \
+					self.corpus.user_his.batch_window(feed_dict['user_id'], pos, self.model.history_max)
+				return feed_dict
+			user_ids, lengths = self.data['user_id'][indices], self.data['lengths'][indices]
+			user_his = self.corpus.user_his
+			starts = user_his.offsets[user_ids] + self.data['position'][indices] - lengths
+			target_items = gather_padded(user_his.items, starts, lengths)
+			neg_items = gather_padded(self.neg_items, self.window_offsets[indices], lengths)
+			feed_dict = {
+				'user_id': user_ids,
+				'item_id': np.concatenate([target_items[:, :, None], neg_items], axis=2).astype(int),
+				'history_items': gather_padded(user_his.items, starts - 1, lengths),
+				'history_times': gather_padded(user_his.times, starts - 1, lengths),
+				'lengths': lengths
+			}
 			return feed_dict
 
+		def actions_before_epoch(self):
+			if not self.seq_train:
+				return super().actions_before_epoch()
+			# negatives of every position in the windows, one row per target
+			users = np.repeat(self.data['user_id'], self.data['lengths'])
+			num_neg = 0 if self.model.sampled_softmax else self.model.num_neg
+			self.neg_items = self.neg_sampler.sample(users, num_neg, self.corpus.train_clicked_set)
+
 class CTRModel(GeneralModel):
 	reader, runner = 'BaseReader', 'CTRRunner'
 
@@ -2,9 +2,14 @@ import torch
 import numpy as np
 import torch.nn.functional as F
 from typing import List
+import os
 import yaml
 import copy
+import shutil
+import hashlib
+import argparse
 
+from utils import corpus_cache
 from models.BaseModel import *
 from models.BaseImpressionModel import *
 from models.general import *
@@ -50,37 +55,155 @@ class RerankModel(ImpressionModel):
 				yaml.load(f.read(), Loader=yaml.FullLoader)
 			)
 		#load ranker from model and get self.ranker_emb_size
+		model_name = eval('{0}.{0}Impression'.format(self.ranker_name))
 		ranker_args = copy.deepcopy(args)
+		ranker_defaults = model_name.parse_model_args(argparse.ArgumentParser()).parse_known_args([])[0]
+		for k, v in vars(ranker_defaults).items():  # ranker arguments given neither in the config nor in args
+			if not hasattr(ranker_args, k):
+				setattr(ranker_args, k, v)
 		for k, v in ranker_config_dict.items():
 			if k != 'history_max':
 				setattr(ranker_args, k, v)
-		model_name = eval('{0}.{0}Impression'.format(self.ranker_name))
 		self.ranker = model_name(ranker_args, corpus)
 		self.ranker.device = ranker_args.device
 		self.ranker.apply(self.ranker.init_weights)
 		self.ranker.to(self.device)
 		self.ranker_emb_size = ranker_args.emb_size
 		self.ranker.load_model(model_path)
+		self.ranker_model_path = model_path
 		if not self.tuneranker:
 			for param in self.ranker.parameters():
 				param.requires_grad = False
 
-	class Dataset(ImpressionModel.Dataset):		
+	def _padding_mask(self, feed_dict: dict) -> torch.Tensor:
+		device = feed_dict['pos_num'].device
+		pos_mask = torch.arange(0, self.train_max_pos_item, device = device).type_as(feed_dict['pos_num']).unsqueeze(0).expand(feed_dict['batch_size'], self.train_max_pos_item).lt(feed_dict['pos_num'].unsqueeze(1))
+		neg_mask = torch.arange(0, self.train_max_neg_item, device = device).type_as(feed_dict['neg_num']).unsqueeze(0).expand(feed_dict['batch_size'], self.train_max_neg_item).lt(feed_dict['neg_num'].unsqueeze(1))
+		return ~torch.cat([pos_mask, neg_mask],dim = 1)
+
+	def _ranker_outputs(self, feed_dict: dict) -> dict:
+		out_dict = dict()
+		predict_dict = self.ranker(utils.batch_to_gpu(feed_dict, self.device)) # pos+pad+neg+pad
+		all_mask = ~self._padding_mask(feed_dict)
+		out_dict['scores'] = torch.where(all_mask == 1, predict_dict['prediction'],-np.inf * torch.ones_like(predict_dict['prediction'])) # [batch(or num_sequence),n_candidate]
+		_,temp = out_dict['scores'].sort(dim = 1, descending = True)
+		_,out_dict['position'] = temp.sort(dim = 1)
+		out_dict['u_v'] = predict_dict['u_v'] # [batch(or num_sequence),ranker_embedding_len]
+		out_dict['i_v'] = predict_dict['i_v'] # [batch(or num_sequence),ranker_embedding_len]
+		return out_dict
+
+	def _ranker_tables(self) -> dict:
+		# whole ranker tables needed at collate time besides the per-impression outputs
+		return dict()
+
+	def ranker_feed(self, feed_dict: dict, ranker_cache: dict = None) -> dict:
+		"""
+		Ranker outputs of a collated batch, read from the precomputed arrays if given (rows are selected by
+		feed_dict['index']), or else computed by running the ranker.
+		"""
+		index = feed_dict.pop('index')
+		if ranker_cache is None:
+			out_dict = self._ranker_outputs(feed_dict)
+		else:
+			index = index.numpy()
+			out_dict = {key: torch.from_numpy(ranker_cache[key][index]) for key in ['scores', 'position', 'u_v', 'i_v']}
+		out_dict['padding_mask'] = self._padding_mask(feed_dict)
+		return out_dict
+
+	def ranker_cache_dir(self, dataset) -> str:
+		"""
+		Where the ranker outputs of a dataset are stored: keyed by the hash of the ranker checkpoint and of the
+		corpus (raw data files and the reader options grouping impressions), and by the candidate/history lengths
+		that decide the shapes of the arrays.
+		"""
+		md5 = hashlib.md5()
+		with open(self.ranker_model_path, 'rb') as f:
+			for block in iter(lambda: f.read(1 << 20), b''):
+				md5.update(block)
+		corpus = dataset.corpus
+		corpus_key = [corpus_cache.CACHE_VERSION, corpus_cache.data_version(corpus.prefix, corpus.dataset),
+					  type(corpus).__name__, getattr(corpus, 'impression_idkey', ''),
+					  getattr(corpus, 'impression_chunk', 0)]
+		md5.update('|'.join(str(k) for k in corpus_key).encode('utf-8'))
+		name = '{}-{}-pos{}-neg{}-his{}'.format(type(self).__name__, dataset.phase, dataset.pos_len, dataset.neg_len,
+												 getattr(self, 'history_max', 0))
+		return os.path.join(dataset.corpus.prefix, dataset.corpus.dataset, 'RankerCache',
+							'{}-{}'.format(self.ranker_name, md5.hexdigest()), name)
+
+	def precompute_ranker_outputs(self, dataset, batch_size: int = 256) -> dict:
+		"""
+		Score all the impressions of a dataset once with the frozen ranker (in eval mode). The outputs are saved
+		as .npy files and memory-mapped, so they are shared by DataLoader workers and reused by later runs.
+		:return: dict of read-only arrays, the first axis of per-impression outputs is the instance index
+		"""
+		cache_dir = self.ranker_cache_dir(dataset)
+		if os.path.exists(cache_dir):
+			arrays = self._load_ranker_cache(cache_dir)
+			if 'scores' in arrays and len(arrays['scores']) == len(dataset):
+				return arrays
+			logging.warning('Ranker outputs in {} do not match the {} set, recompute them'.format(
+				cache_dir, dataset.phase))
+			del arrays
+			shutil.rmtree(cache_dir, ignore_errors=True)
+		if not os.path.exists(cache_dir):
+			logging.info('Precompute ranker outputs of {} set to {}'.format(dataset.phase, cache_dir))
+			tmp_dir = '{}.tmp{}'.format(cache_dir, os.getpid())
+			os.makedirs(tmp_dir, exist_ok=True)
+			arrays, was_training = dict(), self.ranker.training
+			self.ranker.eval()
+			with torch.no_grad():
+				for start in tqdm(range(0, len(dataset), batch_size), leave=False, ncols=100, mininterval=1,
+								  desc='Rank ' + dataset.phase):
+					indices = range(start, min(start + batch_size, len(dataset)))
+					feed_dict = dataset.collate_batch([dataset._get_feed_dict(i) for i in indices])
+					for key in ['scores', 'position', 'u_v', 'i_v']:
+						value = feed_dict[key].cpu().numpy()
+						if key not in arrays:
+							arrays[key] = np.lib.format.open_memmap(os.path.join(tmp_dir, key + '.npy'), mode='w+',
+								dtype=value.dtype, shape=(len(dataset),) + value.shape[1:])
+						arrays[key][start:start + len(value)] = value
+				for key, value in self._ranker_tables().items():
+					np.save(os.path.join(tmp_dir, key + '.npy'), value.cpu().numpy())
+			self.ranker.train(was_training)
+			for array in arrays.values():
+				array.flush()
+			del arrays
+			os.makedirs(os.path.dirname(cache_dir), exist_ok=True)
+			try:
+				os.rename(tmp_dir, cache_dir)  # a half-written cache is never visible
+			except OSError:  # written by a concurrent run in the meantime
+				shutil.rmtree(tmp_dir)
+		return self._load_ranker_cache(cache_dir)
+
+	@staticmethod
+	def _load_ranker_cache(cache_dir: str) -> dict:
+		return {name[:-len('.npy')]: np.load(os.path.join(cache_dir, name), mmap_mode='r')
+				for name in os.listdir(cache_dir) if name.endswith('.npy')}
+
+	class Dataset(ImpressionModel.Dataset):
+		def __init__(self, model, corpus, phase: str):
+			super().__init__(model, corpus, phase)
+			self.ranker_cache = None
+
+		def prepare(self):
+			super().prepare()
+			if not self.model.tuneranker:  # the frozen ranker is only run once for each impression
+				self.ranker_cache = self.model.precompute_ranker_outputs(self)
+
+		def _get_feed_dict(self, index):
+			feed_dict = super()._get_feed_dict(index)
+			feed_dict['index'] = index
+			return feed_dict
+
+		def _get_batch_feed_dict(self, indices):
+			feed_dict = super()._get_batch_feed_dict(indices)
+			feed_dict['index'] = indices
+			return feed_dict
+
 		# Collate a batch according to the list of feed dicts
 		def collate_batch(self, feed_dicts: List[dict]) -> dict: # feed_dicts are a batch of dicts
 			feed_dict = super().collate_batch(feed_dicts)
-			feed_dict['batch_size'] = len(feed_dicts)
-			predict_dict = self.model.ranker(utils.batch_to_gpu(feed_dict, self.model.device)) # pos+pad+neg+pad
-			feed_dict['scores'] = predict_dict['prediction'] # [batch(or num_sequence),n_candidate]
-			pos_mask = torch.arange(0, self.model.train_max_pos_item, device = self.model.device).type_as(feed_dict['pos_num']).unsqueeze(0).expand(feed_dict['batch_size'], self.model.train_max_pos_item).lt(feed_dict['pos_num'].unsqueeze(1))
-			neg_mask = torch.arange(0, self.model.train_max_neg_item, device = self.model.device).type_as(feed_dict['neg_num']).unsqueeze(0).expand(feed_dict['batch_size'], self.model.train_max_neg_item).lt(feed_dict['neg_num'].unsqueeze(1))
-			all_mask = torch.cat([pos_mask, neg_mask],dim = 1)
-			feed_dict['padding_mask'] = ~all_mask
-			feed_dict['scores'] = torch.where(all_mask == 1, feed_dict['scores'],-np.inf * torch.ones_like(feed_dict['scores']))
-			_,temp = feed_dict['scores'].sort(dim = 1, descending = True)
-			_,feed_dict['position'] = temp.sort(dim = 1)
-			feed_dict['u_v'] = predict_dict['u_v'] # [batch(or num_sequence),ranker_embedding_len]
-			feed_dict['i_v'] = predict_dict['i_v'] # [batch(or num_sequence),ranker_embedding_len]
+			feed_dict.update(self.model.ranker_feed(feed_dict, self.ranker_cache))
 			return feed_dict
 
 class RerankSeqModel(RerankModel):
@@ -106,28 +229,41 @@ class RerankSeqModel(RerankModel):
 		super().__init__(args, corpus)
 		self.history_max = args.history_max
 	
-	class Dataset(ImpressionSeqModel.Dataset):		
+	def _ranker_tables(self) -> dict:
+		return {'his_table': self._history_table()}
+
+	def _history_table(self) -> torch.Tensor:
+		# ranker embeddings of all the items, looked up for the history items
+		if 'LightGCN' in self.ranker_name:
+			return self.ranker.encoder.embedding_dict['item_emb']
+		return self.ranker.i_embeddings.weight
+
+	def ranker_feed(self, feed_dict: dict, ranker_cache: dict = None) -> dict:
+		out_dict = super().ranker_feed(feed_dict, ranker_cache)
+		#modeling user history, need all history item vector
+		if ranker_cache is None:
+			out_dict['his_v'] = self._history_table()[feed_dict['history_items'].to(self.device),:]
+		else:
+			out_dict['his_v'] = torch.from_numpy(ranker_cache['his_table'][feed_dict['history_items'].numpy()])
+		return out_dict
+
+	class Dataset(ImpressionSeqModel.Dataset):
+		def __init__(self, model, corpus, phase: str):
+			super().__init__(model, corpus, phase)
+			self.ranker_cache = None
+
+		def prepare(self):
+			super().prepare()
+			if not self.model.tuneranker:
+				self.ranker_cache = self.model.precompute_ranker_outputs(self)
+
+		def _get_feed_dict(self, index):
+			feed_dict = super()._get_feed_dict(index)
+			feed_dict['index'] = index
+			return feed_dict
+
 		# Collate a batch according to the list of feed dicts
 		def collate_batch(self, feed_dicts: List[dict]) -> dict: # feed_dicts are a batch of dicts
 			feed_dict = super().collate_batch(feed_dicts)
-			feed_dict['batch_size'] = len(feed_dicts)
-			predict_dict = self.model.ranker(utils.batch_to_gpu(feed_dict, self.model.device)) # pos+pad+neg+pad
-			feed_dict['scores'] = predict_dict['prediction'] # [batch(or num_sequence),n_candidate]
-			pos_mask = torch.arange(0, self.model.train_max_pos_item, device = self.model.device).type_as(feed_dict['pos_num']).unsqueeze(0).expand(feed_dict['batch_size'], self.model.train_max_pos_item).lt(feed_dict['pos_num'].unsqueeze(1))
-			neg_mask = torch.arange(0, self.model.train_max_neg_item, device = self.model.device).type_as(feed_dict['neg_num']).unsqueeze(0).expand(feed_dict['batch_size'], self.model.train_max_neg_item).lt(feed_dict['neg_num'].unsqueeze(1))
-			all_mask = torch.cat([pos_mask, neg_mask],dim = 1)
-			feed_dict['padding_mask'] = ~all_mask
-			feed_dict['scores'] = torch.where(all_mask == 1, feed_dict['scores'],-np.inf * torch.ones_like(feed_dict['scores']))
-			_,temp = feed_dict['scores'].sort(dim = 1, descending = True)
-			_,feed_dict['position'] = temp.sort(dim = 1)
-			feed_dict['u_v'] = predict_dict['u_v'] # [batch(or num_sequence),ranker_embedding_len]
-			feed_dict['i_v'] = predict_dict['i_v'] # [batch(or num_sequence),ranker_embedding_len]
-
-			#modeling user history, need all history item vector
-			ranker = self.model.ranker
-			if 'LightGCN' in self.model.ranker_name:
-				all_his_its = ranker.encoder.embedding_dict['item_emb'][feed_dict['history_items'].to(self.model.device),:]
-			else:
-				all_his_its = ranker.i_embeddings(feed_dict['history_items'].to(self.model.device))
-			feed_dict['his_v']=all_his_its
-			return feed_dict
\ No newline at end of file
+			feed_dict.update(self.model.ranker_feed(feed_dict, self.ranker_cache))
+			return feed_dict
@@ -12,12 +12,13 @@ Implementation reference: DIEN and FuxiCTR
 
 import torch
 import torch.nn as nn
-import numpy as np
 import pandas as pd
 
 from models.BaseContextModel import ContextSeqModel, ContextSeqCTRModel
 from models.context_seq.DIN import DINBase
 from utils.layers import MLP_Block
+from utils.ragged import RaggedArray
+from utils.sampler import NegativeSampler
 
 class DIENBase(DINBase):
     @staticmethod
@@ -197,21 +198,15 @@ class DIENBase(DINBase):
                 if self.model.history_max > 0:
                     user_neg_seq = user_neg_seq[-self.model.history_max:]
                 feed_dict['history_neg_item_id'] = user_neg_seq 
-                for c in self.corpus.item_feature_names:
-                    feed_dict['history_neg_'+c] = np.array([self.corpus.item_features[iid][c] if iid in self.corpus.item_features else 0
-                                             for iid in feed_dict['history_neg_item_id']])
+                feed_dict.update(self.corpus.get_item_features(feed_dict['history_neg_item_id'], prefix='history_neg_'))
             return feed_dict
 
         def actions_before_epoch_dien(self):
             if self.model.alpha_aux>0:
-                neg_history = dict() # user: negative history
-                for u, his in self.corpus.user_his.items():
-                    neg_history[u] = np.random.randint(1, self.corpus.n_items,
-                                        size=(len(his)))
-                    for i,(pos, neg) in enumerate(zip(his, neg_history[u])):
-                        while pos[0] == neg:
-                            neg = np.random.randint(1, self.corpus.n_items)
-                        neg_history[u][i] = neg
+                # negative history aligned with the history store, each differs from the clicked item at its position
+                user_his = self.corpus.user_his
+                neg_items = NegativeSampler(self.corpus.n_items).sample_distinct(user_his.items)
+                neg_history = RaggedArray(user_his.offsets, neg_items) # user: negative history
                 self.data['neg_user_his'] = neg_history    
 
 class DIENTopK(ContextSeqModel, DIENBase):
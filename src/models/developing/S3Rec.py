@@ -119,8 +119,8 @@ class S3Rec(SequentialModel):
             if self.pre_train:
                 self.long_seq = list()
                 item_seq, seq_len = list(), list()
-                for seq in self.corpus.user_his.values():
-                    instance = [x[0] for x in seq]
+                for uid in range(len(self.corpus.user_his)):
+                    instance = self.corpus.user_his.user_items(uid).tolist()
                     self.long_seq.extend(instance)
                     for i in range((len(instance) - 1) // self.model.max_his + 1):
                         start = i * self.model.max_his
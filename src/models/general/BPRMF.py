@@ -47,6 +47,8 @@ class BPRMFBase(object):
 class BPRMF(GeneralModel, BPRMFBase):
 	reader = 'BaseReader'
 	runner = 'BaseRunner'
+	permutation_invariant = True
+	stackable = True
 	extra_log_args = ['emb_size', 'batch_size']
 
 	@staticmethod
@@ -62,6 +64,9 @@ class BPRMF(GeneralModel, BPRMFBase):
 		out_dict =  BPRMFBase.forward(self, feed_dict)
 		return {'prediction': out_dict['prediction']}
 
+	def full_ranking_vectors(self, feed_dict):
+		return self.u_embeddings(feed_dict['user_id']), self.i_embeddings.weight
+
 class BPRMFImpression(ImpressionModel, BPRMFBase):
 	reader = 'ImpressionReader'
 	runner = 'ImpressionRunner'
@@ -112,4 +112,4 @@ class BUIR(GeneralModel):
     class Dataset(GeneralModel.Dataset):
         # No need to sample negative items
         def actions_before_epoch(self):
-            self.data['neg_items'] = [[] for _ in range(len(self))]
+            self.data['neg_items'] = np.zeros((len(self), 0), dtype=int)
@@ -21,6 +21,7 @@ import numpy as np
 import pandas as pd
 
 from utils import utils
+from utils.sampler import NegativeSampler
 from models.BaseModel import GeneralModel
 from helpers.KGReader import KGReader
 
@@ -112,18 +113,24 @@ class CFKG(GeneralModel):
             return feed_dict
 
         def actions_before_epoch(self):
-            for i in range(len(self)):
-                head, tail, relation = self.data['head'][i], self.data['tail'][i], self.data['relation'][i]
-                self.neg_tails[i] = np.random.randint(1, self.corpus.n_items)
-                if relation == 0:  # "buy" relation
-                    self.neg_heads[i] = np.random.randint(1, self.corpus.n_users)
-                    while self.neg_tails[i] in self.corpus.train_clicked_set[head]:
-                        self.neg_tails[i] = np.random.randint(1, self.corpus.n_items)
-                    while tail in self.corpus.train_clicked_set[self.neg_heads[i]]:
-                        self.neg_heads[i] = np.random.randint(1, self.corpus.n_users)
-                else:
-                    self.neg_heads[i] = np.random.randint(1, self.corpus.n_entities)
-                    while (head, relation, self.neg_tails[i]) in self.corpus.triplet_set:
-                        self.neg_tails[i] = np.random.randint(1, self.corpus.n_entities)
-                    while (self.neg_heads[i], relation, tail) in self.corpus.triplet_set:
-                        self.neg_heads[i] = np.random.randint(1, self.corpus.n_entities)
+            heads, tails, relations = self.data['head'], self.data['tail'], self.data['relation']
+            buy = relations == 0  # "buy" relation
+            user_sampler = NegativeSampler(self.corpus.n_users)
+            item_sampler = NegativeSampler(self.corpus.n_items)
+            entity_sampler = NegativeSampler(self.corpus.n_entities)
+            neg_tails = item_sampler.draw(len(self))
+            neg_heads = np.where(buy, user_sampler.draw(len(self)), entity_sampler.draw(len(self)))
+
+            clicked_set = self.corpus.train_clicked_set
+            buy_heads, buy_tails = heads[buy], tails[buy]
+            neg_tails[buy] = item_sampler.resample(
+                neg_tails[buy], lambda idx, v: clicked_set.contains(buy_heads[idx], v))
+            neg_heads[buy] = user_sampler.resample(
+                neg_heads[buy], lambda idx, v: clicked_set.contains(v, buy_tails[idx]))
+
+            kg_heads, kg_tails, kg_relations = heads[~buy], tails[~buy], relations[~buy]
+            neg_tails[~buy] = entity_sampler.resample(
+                neg_tails[~buy], lambda idx, v: self.corpus.has_triplets(kg_heads[idx], kg_relations[idx], v))
+            neg_heads[~buy] = entity_sampler.resample(
+                neg_heads[~buy], lambda idx, v: self.corpus.has_triplets(v, kg_relations[idx], kg_tails[idx]))
+            self.neg_heads, self.neg_tails = neg_heads, neg_tails
@@ -2,11 +2,14 @@
 # @Author  : Chenyang Wang
 # @Email   : THUwangcy@gmail.com
 
+import os
+import logging
 import torch
 import numpy as np
 import torch.nn as nn
 import scipy.sparse as sp
 
+from utils import corpus_cache
 from models.BaseModel import GeneralModel
 from models.BaseImpressionModel import ImpressionModel
 
@@ -17,50 +20,63 @@ class LightGCNBase(object):
 							help='Size of embedding vectors.')
 		parser.add_argument('--n_layers', type=int, default=3,
 							help='Number of LightGCN layers.')
+		parser.add_argument('--fanout', type=int, default=0,
+							help='Max sampled neighbors per node and hop in training (0: propagate on the full graph).')
 		return parser
 	
 	@staticmethod
 	def build_adjmat(user_count, item_count, train_mat, selfloop_flag=False):
-		R = sp.dok_matrix((user_count, item_count), dtype=np.float32)
-		for user in train_mat:
-			for item in train_mat[user]:
-				R[user, item] = 1
-		R = R.tolil()
-
-		adj_mat = sp.dok_matrix((user_count + item_count, user_count + item_count), dtype=np.float32)
-		adj_mat = adj_mat.tolil()
-
-		adj_mat[:user_count, user_count:] = R
-		adj_mat[user_count:, :user_count] = R.T
-		adj_mat = adj_mat.todok()
-
-		def normalized_adj_single(adj):
-			# D^-1/2 * A * D^-1/2
-			rowsum = np.array(adj.sum(1)) + 1e-10
-
-			d_inv_sqrt = np.power(rowsum, -0.5).flatten()
-			d_inv_sqrt[np.isinf(d_inv_sqrt)] = 0.
-			d_mat_inv_sqrt = sp.diags(d_inv_sqrt)
-
-			bi_lap = d_mat_inv_sqrt.dot(adj).dot(d_mat_inv_sqrt)
-			return bi_lap.tocoo()
-
+		"""
+		Symmetrically normalized bipartite adjacency D^-1/2 * A * D^-1/2 (CSR), built from the COO form of train_mat
+		(a user-indexed RaggedArray with unique items in each row) without any Python loop.
+		"""
+		n_nodes = user_count + item_count
+		users, items = train_mat.row_ids(), np.asarray(train_mat.values, dtype=np.int64) + user_count
+		rows, cols = np.concatenate([users, items]), np.concatenate([items, users])
 		if selfloop_flag:
-			norm_adj_mat = normalized_adj_single(adj_mat + sp.eye(adj_mat.shape[0]))
-		else:
-			norm_adj_mat = normalized_adj_single(adj_mat)
+			loops = np.arange(n_nodes)
+			rows, cols = np.concatenate([rows, loops]), np.concatenate([cols, loops])
+		rowsum = np.bincount(rows, minlength=n_nodes) + 1e-10
+		d_inv_sqrt = np.power(rowsum, -0.5)
+		values = (d_inv_sqrt[rows] * d_inv_sqrt[cols]).astype(np.float32)
+		return sp.csr_matrix((values, (rows, cols)), shape=(n_nodes, n_nodes))
 
-		return norm_adj_mat.tocsr()
+	@staticmethod
+	def load_adjmat(corpus, selfloop_flag=False):
+		"""
+		Normalized adjacency cached next to the corpus, keyed by the data version and the self-loop flag
+		"""
+		version = corpus_cache.data_version(corpus.prefix, corpus.dataset)
+		cache_path = os.path.join(corpus.prefix, corpus.dataset, 'LightGCN-adj-{}-{}-{}.npz'.format(
+			type(corpus).__name__, version, int(selfloop_flag)))
+		if os.path.exists(cache_path):
+			return sp.load_npz(cache_path)
+		norm_adj = LightGCNBase.build_adjmat(corpus.n_users, corpus.n_items, corpus.train_clicked_set, selfloop_flag)
+		tmp_path = '{}.tmp{}.npz'.format(cache_path[:-len('.npz')], os.getpid())
+		sp.save_npz(tmp_path, norm_adj, compressed=False)
+		os.replace(tmp_path, cache_path)  # concurrent runs never see a half-written file
+		logging.info('Save normalized adjacency to {}'.format(cache_path))
+		return norm_adj
 
 	def _base_init(self, args, corpus):
 		self.emb_size = args.emb_size
 		self.n_layers = args.n_layers
-		self.norm_adj = self.build_adjmat(corpus.n_users, corpus.n_items, corpus.train_clicked_set)
+		self.fanout = args.fanout
+		self.norm_adj = self.load_adjmat(corpus)
 		self._base_define_params()
 		self.apply(self.init_weights)
 	
 	def _base_define_params(self):	
-		self.encoder = LGCNEncoder(self.user_num, self.item_num, self.emb_size, self.norm_adj, self.n_layers)
+		self.encoder = LGCNEncoder(self.user_num, self.item_num, self.emb_size, self.norm_adj, self.n_layers,
+								   sparse_csr=self.device.type == 'cpu', fanout=self.fanout)
+
+	def get_embedding_tables(self):
+		"""
+		Propagated user and item embedding tables as numpy arrays, e.g., to be exported for retrieval
+		"""
+		with torch.no_grad():
+			user_all_embeddings, item_all_embeddings = self.encoder.propagate()
+		return user_all_embeddings.cpu().numpy(), item_all_embeddings.cpu().numpy()
 
 	def forward(self, feed_dict):
 		self.check_list = []
@@ -75,6 +91,7 @@ class LightGCNBase(object):
 class LightGCN(GeneralModel, LightGCNBase):
 	reader = 'BaseReader'
 	runner = 'BaseRunner'
+	permutation_invariant = True
 	extra_log_args = ['emb_size', 'n_layers', 'batch_size']
 
 	@staticmethod
@@ -89,6 +106,10 @@ class LightGCN(GeneralModel, LightGCNBase):
 	def forward(self, feed_dict):
 		out_dict = LightGCNBase.forward(self, feed_dict)
 		return {'prediction': out_dict['prediction']}
+
+	def full_ranking_vectors(self, feed_dict):
+		user_all_embeddings, item_all_embeddings = self.encoder.propagate()
+		return user_all_embeddings[feed_dict['user_id'], :], item_all_embeddings
 	
 class LightGCNImpression(ImpressionModel, LightGCNBase):
 	reader = 'ImpressionReader'
@@ -108,16 +129,29 @@ class LightGCNImpression(ImpressionModel, LightGCNBase):
 		return LightGCNBase.forward(self, feed_dict)
 
 class LGCNEncoder(nn.Module):
-	def __init__(self, user_count, item_count, emb_size, norm_adj, n_layers=3):
+	def __init__(self, user_count, item_count, emb_size, norm_adj, n_layers=3, sparse_csr=False, fanout=0):
 		super(LGCNEncoder, self).__init__()
 		self.user_count = user_count
 		self.item_count = item_count
 		self.emb_size = emb_size
 		self.layers = [emb_size] * n_layers
 		self.norm_adj = norm_adj
+		self.fanout = fanout  # > 0: train on the sampled receptive field of each batch
 
 		self.embedding_dict = self._init_model()
-		self.sparse_norm_adj = self._convert_sp_mat_to_sp_tensor(self.norm_adj).cuda()
+		# a non-persistent buffer follows model.to(device) and is kept out of the saved state dict;
+		# CSR is the fast SpMM layout on CPU, COO is kept on GPU
+		self.register_buffer('sparse_norm_adj', self._convert_sp_mat_to_sp_tensor(self.norm_adj, sparse_csr),
+							 persistent=False)
+		self.cache, self.cache_version = None, None  # propagated embeddings reused in eval mode
+
+	def train(self, mode=True):
+		self.cache = None  # parameters are going to be updated (or eval starts with fresh weights)
+		return super().train(mode)
+
+	def _param_version(self) -> tuple:
+		# in-place updates (optimizer steps, load_state_dict) bump the version counter of a parameter
+		return tuple(p._version for p in self.embedding_dict.values())
 
 	def _init_model(self):
 		initializer = nn.init.xavier_uniform_
@@ -128,13 +162,24 @@ class LGCNEncoder(nn.Module):
 		return embedding_dict
 
 	@staticmethod
-	def _convert_sp_mat_to_sp_tensor(X):
+	def _convert_sp_mat_to_sp_tensor(X, sparse_csr=False):
+		if sparse_csr:
+			csr = X.tocsr()
+			return torch.sparse_csr_tensor(torch.from_numpy(csr.indptr.astype(np.int64)),
+										   torch.from_numpy(csr.indices.astype(np.int64)),
+										   torch.from_numpy(csr.data).float(), size=csr.shape)
 		coo = X.tocoo()
-		i = torch.LongTensor([coo.row, coo.col])
+		i = torch.from_numpy(np.vstack([coo.row, coo.col]).astype(np.int64))
 		v = torch.from_numpy(coo.data).float()
-		return torch.sparse.FloatTensor(i, v, coo.shape)
+		return torch.sparse_coo_tensor(i, v, coo.shape).coalesce()
 
-	def forward(self, users, items):
+	def propagate(self):
+		"""
+		Final embeddings of all the users and items (mean of the propagated layers).
+		In eval mode they are computed once and cached until train() is called or the parameters change.
+		"""
+		if not self.training and self.cache is not None and self.cache_version == self._param_version():
+			return self.cache
 		ego_embeddings = torch.cat([self.embedding_dict['user_emb'], self.embedding_dict['item_emb']], 0)
 		all_embeddings = [ego_embeddings]
 
@@ -147,7 +192,70 @@ class LGCNEncoder(nn.Module):
 
 		user_all_embeddings = all_embeddings[:self.user_count, :]
 		item_all_embeddings = all_embeddings[self.user_count:, :]
+		if not self.training:
+			self.cache = (user_all_embeddings.detach(), item_all_embeddings.detach())
+			self.cache_version = self._param_version()
+			return self.cache
+		return user_all_embeddings, item_all_embeddings
+
+	def sample_subgraph(self, seeds: np.ndarray):
+		"""
+		Sampled k-hop receptive field of the seed nodes (users first, then items shifted by user_count).
+		Every node within n_layers - 1 hops keeps all its edges if its degree is at most fanout, otherwise fanout
+		edges drawn with replacement and reweighted by degree / fanout, so that each layer stays an unbiased
+		estimate of the full propagation.
+		:return: sorted global ids of the subgraph nodes, and the (row, col, weight) edges in local ids
+		"""
+		indptr, indices, data = self.norm_adj.indptr, self.norm_adj.indices, self.norm_adj.data
+		nodes = frontier = np.unique(seeds)
+		rows, cols, weights = list(), list(), list()
+		for _ in range(len(self.layers)):
+			starts = indptr[frontier].astype(np.int64)
+			degrees = indptr[frontier + 1].astype(np.int64) - starts  # only the frontier, not the whole graph
+			full = degrees <= self.fanout
+			# all the edges of small-degree nodes
+			lengths = degrees[full]
+			row = np.repeat(frontier[full], lengths)
+			pos = np.arange(lengths.sum()) + np.repeat(starts[full] - (np.cumsum(lengths) - lengths), lengths)
+			rows += [row]
+			cols += [indices[pos]]
+			weights += [data[pos]]
+			# fanout edges of the others
+			row = np.repeat(frontier[~full], self.fanout)
+			pos = np.repeat(starts[~full], self.fanout) + \
+				(np.random.rand(len(row)) * np.repeat(degrees[~full], self.fanout)).astype(np.int64)
+			rows += [row]
+			cols += [indices[pos]]
+			weights += [data[pos] * np.repeat(degrees[~full], self.fanout) / self.fanout]
+			frontier = np.setdiff1d(np.concatenate(cols[-2:]), nodes)
+			nodes = np.union1d(nodes, frontier)
+		rows, cols, weights = np.concatenate(rows), np.concatenate(cols), np.concatenate(weights)
+		return nodes, np.searchsorted(nodes, rows), np.searchsorted(nodes, cols), weights.astype(np.float32)
 
+	def _sampled_forward(self, users, items):
+		seeds = np.concatenate([users.cpu().numpy().reshape(-1), items.cpu().numpy().reshape(-1) + self.user_count])
+		nodes, rows, cols, weights = self.sample_subgraph(seeds)
+		device = self.embedding_dict['user_emb'].device
+		sub_adj = torch.sparse_coo_tensor(torch.from_numpy(np.vstack([rows, cols])), torch.from_numpy(weights),
+										  (len(nodes), len(nodes))).coalesce().to(device)
+		n_sub_users = int(np.searchsorted(nodes, self.user_count))
+		node_ids = torch.from_numpy(nodes).to(device)
+		ego_embeddings = torch.cat([self.embedding_dict['user_emb'][node_ids[:n_sub_users]],
+									self.embedding_dict['item_emb'][node_ids[n_sub_users:] - self.user_count]], 0)
+		all_embeddings = [ego_embeddings]
+		for k in range(len(self.layers)):
+			ego_embeddings = torch.sparse.mm(sub_adj, ego_embeddings)
+			all_embeddings += [ego_embeddings]
+		all_embeddings = torch.mean(torch.stack(all_embeddings, dim=1), dim=1)
+
+		user_index = torch.searchsorted(node_ids, users)
+		item_index = torch.searchsorted(node_ids, items + self.user_count)
+		return all_embeddings[user_index, :], all_embeddings[item_index, :]
+
+	def forward(self, users, items):
+		if self.training and self.fanout > 0:  # evaluation always propagates on the full graph
+			return self._sampled_forward(users, items)
+		user_all_embeddings, item_all_embeddings = self.propagate()
 		user_embeddings = user_all_embeddings[users, :]
 		item_embeddings = item_all_embeddings[items, :]
 
@@ -22,6 +22,7 @@ from models.BaseModel import GeneralModel
 class NeuMF(GeneralModel):
     reader = 'BaseReader'
     runner = 'BaseRunner'
+    stackable = True
     extra_log_args = ['emb_size', 'layers']
 
     @staticmethod
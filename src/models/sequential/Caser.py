@@ -67,10 +67,8 @@ class Caser(SequentialModel):
         self.out = nn.Linear(self.emb_size * 2, self.emb_size)
 
 
-    def forward(self, feed_dict):
-        self.check_list = []
+    def _user_vector(self, feed_dict):
         u_ids = feed_dict['user_id']
-        i_ids = feed_dict['item_id']  # [batch_size, -1]
         history = feed_dict['history_items']  # [batch_size, history_max]
         batch_size, seq_len = history.shape
 
@@ -96,8 +94,17 @@ class Caser(SequentialModel):
         # Fully-connected Layers
         user_vector = self.u_embeddings(u_ids)
         z = self.fc(torch.cat([out_v, out_h], 1)).relu()
-        his_vector = self.out(torch.cat([z, user_vector], 1))
+        return self.out(torch.cat([z, user_vector], 1))
+
+    def forward(self, feed_dict):
+        self.check_list = []
+        i_ids = feed_dict['item_id']  # [batch_size, -1]
+        batch_size = feed_dict['batch_size']
+        his_vector = self._user_vector(feed_dict)
 
         i_vectors = self.i_embeddings(i_ids)
         prediction = (his_vector[:, None, :] * i_vectors).sum(-1)
-        return {'prediction': prediction.view(batch_size, -1)}
\ No newline at end of file
+        return {'prediction': prediction.view(batch_size, -1)}
+
+    def full_ranking_vectors(self, feed_dict):
+        return self._user_vector(feed_dict), self.i_embeddings.weight
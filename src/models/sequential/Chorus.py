@@ -20,6 +20,7 @@ import torch.distributions
 import numpy as np
 
 from utils import utils
+from utils.sampler import NegativeSampler
 from models.BaseModel import SequentialModel
 
 
@@ -227,29 +228,23 @@ class Chorus(SequentialModel):
                 user_id, time = self.data['user_id'][index], self.data['time'][index]
                 history_item, history_time = feed_dict['history_items'], feed_dict['history_times']
                 category_id = [self.item2cate[x] for x in feed_dict['item_id']]
-                relational_interval = list()
-                for i, target_item in enumerate(feed_dict['item_id']):
-                    interval = np.ones(self.model.relation_num, dtype=float) * -1
-                    # relational intervals
-                    for r_idx in range(1, self.model.relation_num):
-                        for j in range(len(history_item))[::-1]:
-                            if (history_item[j], r_idx, target_item) in self.corpus.triplet_set:
-                                interval[r_idx] = (time - history_time[j]) / self.model.time_scalar
-                                break
-                    relational_interval.append(interval)
+                # relational intervals (the first dimension of the virtual relation is kept as -1)
+                latest = self.corpus.latest_related(
+                    history_item, feed_dict['item_id'], np.arange(1, self.model.relation_num))
+                intervals = (time - np.asarray(history_time)[latest]) / self.model.time_scalar
+                relational_interval = np.full((len(latest), self.model.relation_num), -1, dtype=np.float32)
+                relational_interval[:, 1:] = np.where(latest >= 0, intervals, -1)
                 feed_dict['category_id'] = np.array(category_id)
-                feed_dict['relational_interval'] = np.array(relational_interval, dtype=np.float32)
+                feed_dict['relational_interval'] = relational_interval
             return feed_dict
 
         def actions_before_epoch(self):
             if self.kg_train:  # sample negative heads and tails for the KG embedding task
-                for i in range(len(self)):
-                    head, tail, relation = self.data['head'][i], self.data['tail'][i], self.data['relation'][i]
-                    self.neg_tails[i] = np.random.randint(1, self.corpus.n_items)
-                    self.neg_heads[i] = np.random.randint(1, self.corpus.n_items)
-                    while (head, relation, self.neg_tails[i]) in self.corpus.triplet_set:
-                        self.neg_tails[i] = np.random.randint(1, self.corpus.n_items)
-                    while (self.neg_heads[i], relation, tail) in self.corpus.triplet_set:
-                        self.neg_heads[i] = np.random.randint(1, self.corpus.n_items)
+                heads, tails, relations = self.data['head'], self.data['tail'], self.data['relation']
+                sampler = NegativeSampler(self.corpus.n_items)
+                self.neg_tails = sampler.resample(sampler.draw(len(self)), lambda idx, v: self.corpus.has_triplets(
+                    heads[idx], relations[idx], v))
+                self.neg_heads = sampler.resample(sampler.draw(len(self)), lambda idx, v: self.corpus.has_triplets(
+                    v, relations[idx], tails[idx]))
             else:
                 super().actions_before_epoch()
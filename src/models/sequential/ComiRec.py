@@ -54,9 +54,7 @@ class ComiRec(SequentialModel):
         self.W1 = nn.Linear(self.emb_size, self.attn_size)
         self.W2 = nn.Linear(self.attn_size, self.K)
 
-    def forward(self, feed_dict):
-        self.check_list = []
-        i_ids = feed_dict['item_id']  # [batch_size, -1]
+    def _interest_vectors(self, feed_dict):
         history = feed_dict['history_items']  # [batch_size, history_max]
         lengths = feed_dict['lengths']  # [batch_size]
         batch_size, seq_len = history.shape
@@ -78,6 +76,13 @@ class ComiRec(SequentialModel):
         attn_score = (attn_score - attn_score.max()).softmax(dim=-1)
         attn_score = attn_score.masked_fill(torch.isnan(attn_score), 0)
         interest_vectors = (his_vectors[:, None, :, :] * attn_score[:, :, :, None]).sum(-2)  # bsz, K, emb
+        return interest_vectors
+
+    def forward(self, feed_dict):
+        self.check_list = []
+        i_ids = feed_dict['item_id']  # [batch_size, -1]
+        batch_size = feed_dict['batch_size']
+        interest_vectors = self._interest_vectors(feed_dict)
 
         i_vectors = self.i_embeddings(i_ids)
         if feed_dict['phase'] == 'train':
@@ -91,3 +96,6 @@ class ComiRec(SequentialModel):
             prediction = prediction.max(-1)[0]  # bsz, -1
 
         return {'prediction': prediction.view(batch_size, -1)}
+
+    def full_ranking_vectors(self, feed_dict):
+        return self._interest_vectors(feed_dict), self.i_embeddings.weight  # scored by the best interest
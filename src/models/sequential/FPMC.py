@@ -64,7 +64,7 @@ class FPMC(SequentialModel):
                 neg_items = self.data['neg_items'][index]
             item_ids = np.concatenate([[target_item], neg_items]).astype(int)
             pos = self.data['position'][index]
-            last_item_id = self.corpus.user_his[user_id][pos - 1][0]
+            last_item_id = self.corpus.user_his.user_items(user_id)[pos - 1]
             feed_dict = {
                 'user_id': user_id,
                 'item_id': item_ids,
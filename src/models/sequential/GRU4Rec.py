@@ -38,9 +38,7 @@ class GRU4RecBase(object):
 		# self.pred_embeddings = nn.Embedding(self.item_num, self.hidden_size)
 		self.out = nn.Linear(self.hidden_size, self.emb_size)
 
-	def forward(self, feed_dict):
-		self.check_list = []
-		i_ids = feed_dict['item_id']  # [batch_size, -1]
+	def _user_vector(self, feed_dict):
 		history = feed_dict['history_items']  # [batch_size, history_max]
 		lengths = feed_dict['lengths']  # [batch_size]
 
@@ -58,11 +56,27 @@ class GRU4RecBase(object):
 		# Unsort
 		unsort_idx = torch.topk(sort_idx, k=len(lengths), largest=False)[1]
 		rnn_vector = hidden[-1].index_select(dim=0, index=unsort_idx)
+		return self.out(rnn_vector)
+
+	def _sequence_vectors(self, feed_dict):
+		history = feed_dict['history_items']  # [batch_size, history_max]
+		lengths = feed_dict['lengths']  # [batch_size]
+
+		# the GRU only reads the history from left to right, so the output at each step encodes the prefix
+		history_packed = torch.nn.utils.rnn.pack_padded_sequence(
+			self.i_embeddings(history), lengths.cpu(), batch_first=True, enforce_sorted=False)
+		output, _ = self.rnn(history_packed, None)
+		output, _ = torch.nn.utils.rnn.pad_packed_sequence(output, batch_first=True, total_length=history.shape[1])
+		return self.out(output)
+
+	def forward(self, feed_dict):
+		self.check_list = []
+		i_ids = feed_dict['item_id']  # [batch_size, -1]
+		rnn_vector = self._user_vector(feed_dict)
 
 		# Predicts
 		# pred_vectors = self.pred_embeddings(i_ids)
 		pred_vectors = self.i_embeddings(i_ids)
-		rnn_vector = self.out(rnn_vector)
 		prediction = (rnn_vector[:, None, :] * pred_vectors).sum(-1)
 		
 		u_v = rnn_vector.repeat(1,i_ids.shape[1]).view(i_ids.shape[0],i_ids.shape[1],-1)
@@ -74,6 +88,8 @@ class GRU4RecBase(object):
 class GRU4Rec(SequentialModel, GRU4RecBase):
 	reader = 'SeqReader'
 	runner = 'BaseRunner'
+	permutation_invariant = True
+	stackable = True
 	extra_log_args = ['emb_size', 'hidden_size']
 
 	@staticmethod
@@ -86,8 +102,16 @@ class GRU4Rec(SequentialModel, GRU4RecBase):
 		self._base_init(args, corpus)
 
 	def forward(self, feed_dict):
+		if self.seq_train and feed_dict['phase'] == 'train':
+			return self.seq_forward(feed_dict)
 		out_dict = GRU4RecBase.forward(self, feed_dict)
 		return {'prediction': out_dict['prediction']}
+
+	def full_ranking_vectors(self, feed_dict):
+		return self._user_vector(feed_dict), self.i_embeddings.weight
+
+	def sequence_vectors(self, feed_dict):
+		return self._sequence_vectors(feed_dict), self.i_embeddings.weight
 	
 class GRU4RecImpression(ImpressionSeqModel, GRU4RecBase):
 	reader = 'ImpressionSeqReader'
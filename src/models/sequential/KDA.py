@@ -17,6 +17,7 @@ import numpy as np
 import pandas as pd
 
 from utils import layers
+from utils.sampler import NegativeSampler
 from models.BaseModel import SequentialModel
 from helpers.KDAReader import KDAReader
 
@@ -242,24 +243,24 @@ class KDA(SequentialModel):
             self.kg_data = self.generate_kg_data()
             heads, tails = self.kg_data['head'].values, self.kg_data['tail'].values
             relations, vals = self.kg_data['relation'].values, self.kg_data['value'].values
-            self.neg_heads = np.random.randint(1, self.corpus.n_items, size=(len(self.kg_data), self.model.num_neg))
-            self.neg_tails = np.random.randint(1, self.corpus.n_items, size=(len(self.kg_data), self.model.num_neg))
-            for i in range(len(self.kg_data)):
-                item_item_relation = (tails[i] <= self.corpus.n_items)
-                for j in range(self.model.num_neg):
-                    if np.random.rand() < self.model.neg_head_p:  # sample negative head
-                        tail = tails[i] if item_item_relation else vals[i]
-                        while (self.neg_heads[i][j], relations[i], tail) in self.corpus.triplet_set:
-                            self.neg_heads[i][j] = np.random.randint(1, self.corpus.n_items)
-                        self.neg_tails[i][j] = tails[i]
-                    else:  # sample negative tail
-                        head = heads[i] if item_item_relation else self.neg_tails[i][j]
-                        tail = self.neg_tails[i][j] if item_item_relation else vals[i]
-                        while (head, relations[i], tail) in self.corpus.triplet_set:
-                            self.neg_tails[i][j] = np.random.randint(1, self.corpus.n_items)
-                            head = heads[i] if item_item_relation else self.neg_tails[i][j]
-                            tail = self.neg_tails[i][j] if item_item_relation else vals[i]
-                        self.neg_heads[i][j] = heads[i]
+            shape = (len(self.kg_data), self.model.num_neg)
+            item_item_relation = np.repeat(tails <= self.corpus.n_items, self.model.num_neg)
+            head_mask = np.random.rand(*shape).reshape(-1) < self.model.neg_head_p  # sample negative head
+            heads, tails = np.repeat(heads, self.model.num_neg), np.repeat(tails, self.model.num_neg)
+            relations, vals = np.repeat(relations, self.model.num_neg), np.repeat(vals, self.model.num_neg)
+            # the candidate is the head of the triplet to check, except for negative tails of item-item relations
+            cand_head = head_mask | ~item_item_relation
+            fixed = np.where(cand_head, np.where(item_item_relation, tails, vals), heads)
+
+            def collide(idx, cand):
+                triplet_heads = np.where(cand_head[idx], cand, fixed[idx])
+                triplet_tails = np.where(cand_head[idx], fixed[idx], cand)
+                return self.corpus.has_triplets(triplet_heads, relations[idx], triplet_tails)
+
+            sampler = NegativeSampler(self.corpus.n_items)
+            neg_items = sampler.resample(sampler.draw(shape[0] * shape[1]), collide)
+            self.neg_heads = np.where(head_mask, neg_items, heads).reshape(shape)
+            self.neg_tails = np.where(head_mask, tails, neg_items).reshape(shape)
 
 
 class RelationalDynamicAggregation(nn.Module):
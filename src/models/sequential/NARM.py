@@ -49,14 +49,11 @@ class NARM(SequentialModel):
         self.attention_out = nn.Linear(self.attention_size, 1, bias=False)
         self.out = nn.Linear(2 * self.hidden_size, self.emb_size, bias=False)
 
-    def forward(self, feed_dict):
-        self.check_list = []
-        i_ids = feed_dict['item_id']  # [batch_size, -1]
+    def _user_vector(self, feed_dict):
         history = feed_dict['history_items']  # [batch_size, history_max]
         lengths = feed_dict['lengths']  # [batch_size]
 
         # Embedding Layer
-        i_vectors = self.i_embeddings(i_ids)
         his_vectors = self.i_embeddings(history)
 
         # Encoding Layer
@@ -78,7 +75,17 @@ class NARM(SequentialModel):
         attention_value = attention_value.masked_fill(mask == 0, 0)
         c_l = (attention_value * output_l).sum(1)
 
+        return self.out(torch.cat((hidden_g, c_l), dim=1))
+
+    def forward(self, feed_dict):
+        self.check_list = []
+        i_ids = feed_dict['item_id']  # [batch_size, -1]
+        i_vectors = self.i_embeddings(i_ids)
+        pred_vector = self._user_vector(feed_dict)
+
         # Prediction Layer
-        pred_vector = self.out(torch.cat((hidden_g, c_l), dim=1))
         prediction = (pred_vector[:, None, :] * i_vectors).sum(dim=-1)
         return {'prediction': prediction.view(feed_dict['batch_size'], -1)}
+
+    def full_ranking_vectors(self, feed_dict):
+        return self._user_vector(feed_dict), self.i_embeddings.weight
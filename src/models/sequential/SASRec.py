@@ -48,9 +48,7 @@ class SASRecBase(object):
 			for _ in range(self.num_layers)
 		])
 
-	def forward(self, feed_dict):
-		self.check_list = []
-		i_ids = feed_dict['item_id']  # [batch_size, -1]
+	def _sequence_vectors(self, feed_dict):
 		history = feed_dict['history_items']  # [batch_size, history_max]
 		lengths = feed_dict['lengths']  # [batch_size]
 		batch_size, seq_len = history.shape
@@ -72,10 +70,21 @@ class SASRecBase(object):
 		for block in self.transformer_block:
 			his_vectors = block(his_vectors, attn_mask)
 		his_vectors = his_vectors * valid_his[:, :, None].float()
+		return his_vectors
 
-		his_vector = his_vectors[torch.arange(batch_size), (lengths - 1).long(), :]
+	def _user_vector(self, feed_dict):
+		his_vectors = self._sequence_vectors(feed_dict)
+		lengths = feed_dict['lengths']  # [batch_size]
+		his_vector = his_vectors[torch.arange(his_vectors.shape[0]), (lengths - 1).long(), :]
 		# his_vector = his_vectors.sum(1) / lengths[:, None].float()
 		# ↑ average pooling is shown to be more effective than the most recent embedding
+		return his_vector
+
+	def forward(self, feed_dict):
+		self.check_list = []
+		i_ids = feed_dict['item_id']  # [batch_size, -1]
+		batch_size = feed_dict['batch_size']
+		his_vector = self._user_vector(feed_dict)
 
 		i_vectors = self.i_embeddings(i_ids)
 		prediction = (his_vector[:, None, :] * i_vectors).sum(-1)
@@ -89,6 +98,8 @@ class SASRecBase(object):
 class SASRec(SequentialModel, SASRecBase):
 	reader = 'SeqReader'
 	runner = 'BaseRunner'
+	permutation_invariant = True
+	stackable = True
 	extra_log_args = ['emb_size', 'num_layers', 'num_heads']
 
 	@staticmethod
@@ -101,8 +112,16 @@ class SASRec(SequentialModel, SASRecBase):
 		self._base_init(args, corpus)
 
 	def forward(self, feed_dict):
+		if self.seq_train and feed_dict['phase'] == 'train':
+			return self.seq_forward(feed_dict)
 		out_dict = SASRecBase.forward(self, feed_dict)
 		return {'prediction': out_dict['prediction']}
+
+	def full_ranking_vectors(self, feed_dict):
+		return self._user_vector(feed_dict), self.i_embeddings.weight
+
+	def sequence_vectors(self, feed_dict):
+		return self._sequence_vectors(feed_dict), self.i_embeddings.weight
 	
 class SASRecImpression(ImpressionSeqModel, SASRecBase):
 	reader = 'ImpressionSeqReader'
@@ -97,20 +97,13 @@ class SLRCPlus(SequentialModel):
             # Collect time information related to the target item:
             # - re-consuming time gaps
             # - time intervals w.r.t. recent relational interactions
-            relational_interval = list()
-            for i, target_item in enumerate(feed_dict['item_id']):
-                interval = np.ones(self.model.relation_num, dtype=float) * -1  # -1 if not existing
-                # the first dimension for re-consuming time gaps
-                for j in range(len(history_item))[::-1]:
-                    if history_item[j] == target_item:
-                        interval[0] = (time - history_time[j]) / self.model.time_scalar
-                        break
-                # the rest for relational time intervals
-                for r_idx in range(1, self.model.relation_num):
-                    for j in range(len(history_item))[::-1]:
-                        if (history_item[j], r_idx, target_item) in self.corpus.triplet_set:
-                            interval[r_idx] = (time - history_time[j]) / self.model.time_scalar
-                            break
-                relational_interval.append(interval)
-            feed_dict['relational_interval'] = np.array(relational_interval, dtype=np.float32)
+            target_items = np.asarray(feed_dict['item_id'])
+            # the first dimension for re-consuming time gaps (the latest consumption of the target item)
+            consumed = target_items[:, None] == np.asarray(history_item)[None, :]
+            latest = np.where(consumed.any(axis=1), len(history_item) - 1 - np.argmax(consumed[:, ::-1], axis=1), -1)
+            # the rest for relational time intervals
+            latest = np.concatenate([latest[:, None], self.corpus.latest_related(
+                history_item, target_items, np.arange(1, self.model.relation_num))], axis=1)
+            intervals = (time - np.asarray(history_time)[latest]) / self.model.time_scalar
+            feed_dict['relational_interval'] = np.where(latest >= 0, intervals, -1).astype(np.float32)  # -1 if not existing
             return feed_dict
@@ -143,6 +143,14 @@ class TiMiRec(SequentialModel):
 
         return out_dict
 
+    def full_ranking_vectors(self, feed_dict):
+        history, lengths = feed_dict['history_items'], feed_dict['lengths']
+        interest_vectors = self.interest_extractor(history, lengths)  # bsz, K, emb
+        if self.stage == 'finetune':
+            pred_intent = self.proj(self.interest_predictor(history, lengths))  # bsz, K
+            interest_vectors = (interest_vectors * pred_intent.softmax(-1)[:, :, None]).sum(-2)  # bsz, emb
+        return interest_vectors, self.interest_extractor.i_embeddings.weight
+
     def loss(self, out_dict: dict):
         if self.stage == 'pretrain':  # pretrain
             loss = super().loss(out_dict)
@@ -67,9 +67,7 @@ class TiSASRec(SequentialModel):
             for _ in range(self.num_layers)
         ])
 
-    def forward(self, feed_dict):
-        self.check_list = []
-        i_ids = feed_dict['item_id']  # [batch_size, -1]
+    def _sequence_vectors(self, feed_dict):
         i_history = feed_dict['history_items']  # [batch_size, history_max]
         t_history = feed_dict['history_times']  # [batch_size, history_max]
         user_min_t = feed_dict['user_min_intervals']  # [batch_size]
@@ -97,6 +95,16 @@ class TiSASRec(SequentialModel):
         for block in self.transformer_block:
             his_vectors = block(his_vectors, pos_k, pos_v, inter_k, inter_v, attn_mask)
         his_vectors = his_vectors * valid_his[:, :, None].float()
+        return his_vectors
+
+    def forward(self, feed_dict):
+        self.check_list = []
+        if self.seq_train and feed_dict['phase'] == 'train':
+            return self.seq_forward(feed_dict)
+        i_ids = feed_dict['item_id']  # [batch_size, -1]
+        lengths = feed_dict['lengths']  # [batch_size]
+        batch_size = i_ids.shape[0]
+        his_vectors = self._sequence_vectors(feed_dict)
 
         his_vector = his_vectors[torch.arange(batch_size), lengths - 1, :]
         # his_vector = his_vectors.sum(1) / lengths[:, None].float()
@@ -106,6 +114,9 @@ class TiSASRec(SequentialModel):
         prediction = (his_vector[:, None, :] * i_vectors).sum(-1)
         return {'prediction': prediction.view(batch_size, -1)}
 
+    def sequence_vectors(self, feed_dict):
+        return self._sequence_vectors(feed_dict), self.i_embeddings.weight
+
     class Dataset(SequentialModel.Dataset):
         def _get_feed_dict(self, index):
             feed_dict = super()._get_feed_dict(index)
@@ -0,0 +1,277 @@
+# -*- coding: UTF-8 -*-
+
+import os
+import json
+import math
+import shlex
+import random
+import argparse
+import itertools
+import threading
+import traceback
+import pandas as pd
+from typing import List
+from concurrent.futures import ThreadPoolExecutor
+
+from exp import make_slots, run_job, prepare_corpus
+
+
+# Successive-halving hyper-parameter search: all the configurations train for a few epochs, only the best 1/eta of
+# them are promoted to the next rung, where they resume from their checkpoints and train longer, and so on.
+# Example:
+#   python search.py --base_cmd "python main.py --model_name BPRMF --dataset Grocery_and_Gourmet_Food" \
+#       --space '{"lr": [1e-3, 5e-4, 1e-4], "l2": {"log_uniform": [1e-8, 1e-4]}, "emb_size": [32, 64]}' \
+#       --sampler random --n_trials 27 --min_epochs 5 --eta 3 --max_epochs 45 --n_jobs 4
+# Search space values are either lists of candidates, or distributions for random sampling:
+#   {"uniform": [low, high]}, {"log_uniform": [low, high]}, {"int": [low, high]} (both ends included).
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Search')
+    parser.add_argument('--base_cmd', type=str, required=True,
+                        help='Command shared by all the trials (python main.py --model_name ... --dataset ...).')
+    parser.add_argument('--space', type=str, required=True,
+                        help='Search space as json, or a json file: {argument: [values] or distribution}.')
+    parser.add_argument('--sampler', type=str, default='grid',
+                        help='grid (all the combinations of lists) or random.')
+    parser.add_argument('--n_trials', type=int, default=0,
+                        help='Number of sampled configurations (0: the whole grid; required by random sampling).')
+    parser.add_argument('--min_epochs', type=int, default=5,
+                        help='Epochs of the first rung.')
+    parser.add_argument('--eta', type=int, default=3,
+                        help='Each rung keeps the best 1/eta of the trials and trains them eta times longer.')
+    parser.add_argument('--max_epochs', type=int, default=200,
+                        help='Epochs of the last rung.')
+    parser.add_argument('--main_metric', type=str, default='',
+                        help='Dev metric to rank the trials (default: the main metric of the runner).')
+    parser.add_argument('--out_dir', type=str, default='../log/search/',
+                        help='Logs, models and results of the trials; rerunning the search resumes from it.')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Random seed of the sampler.')
+    parser.add_argument('--gpu', type=str, default='0',
+                        help='Set CUDA_VISIBLE_DEVICES (comma-separated GPUs are assigned to concurrent trials in turn)')
+    parser.add_argument('--n_jobs', type=int, default=1,
+                        help='Number of concurrent trials (0: as many as the available cores allow with --threads).')
+    parser.add_argument('--threads', type=int, default=0,
+                        help='CPU threads (and pinned cores) of each trial (0: available cores / n_jobs).')
+    parser.add_argument('--retries', type=int, default=1,
+                        help='Times to retry a failed trial.')
+    parser.add_argument('--ckpt_secs', type=int, default=600,
+                        help='Checkpoint interval of the trials in seconds (checkpoints are also saved after each epoch).')
+    return parser.parse_args()
+
+
+def load_space(space: str) -> dict:
+    if os.path.isfile(space):
+        with open(space) as f:
+            return json.load(f)
+    return json.loads(space)
+
+
+def sample_value(dist, rng: random.Random):
+    if isinstance(dist, list):
+        return rng.choice(dist)
+    if not isinstance(dist, dict) or len(dist) != 1:
+        raise ValueError('Unknown search space entry: {}'.format(dist))
+    kind, (low, high) = list(dist.items())[0]
+    if kind == 'uniform':
+        return rng.uniform(low, high)
+    if kind == 'log_uniform':
+        return float('{:.3g}'.format(math.exp(rng.uniform(math.log(low), math.log(high)))))
+    if kind == 'int':
+        return rng.randint(low, high)
+    raise ValueError('Unknown distribution: {}'.format(kind))
+
+
+def sample_configs(space: dict, sampler: str, n_trials: int, seed: int) -> List[dict]:
+    rng = random.Random(seed)
+    keys = sorted(space.keys())
+    if sampler == 'grid':
+        if any(not isinstance(space[k], list) for k in keys):
+            raise ValueError('Grid search needs lists of values')
+        configs = [dict(zip(keys, values)) for values in itertools.product(*[space[k] for k in keys])]
+        if 0 < n_trials < len(configs):
+            configs = rng.sample(configs, n_trials)
+        return configs
+    if sampler == 'random':
+        if n_trials <= 0:
+            raise ValueError('Random search needs --n_trials')
+        return [{k: sample_value(space[k], rng) for k in keys} for _ in range(n_trials)]
+    raise ValueError('Unknown sampler: {}'.format(sampler))
+
+
+def check_space(base_cmd: str, space: dict):
+    # the arguments of the space must be known by the model, reader or runner of the base command
+    try:
+        import main  # models (and torch) are only imported here
+        tokens = shlex.split(base_cmd)
+        main_idx = [i for i, t in enumerate(tokens) if t.endswith('main.py')][0]
+        _, args, _, _, _ = main.parse_args(tokens[main_idx + 1:])
+    except Exception:
+        traceback.print_exc()
+        print('Skip the check of the search space')
+        return
+    unknown = [k for k in space if not hasattr(args, k)]
+    if len(unknown):
+        raise ValueError('Unknown arguments in the search space: {}'.format(unknown))
+
+
+def rung_epochs(min_epochs: int, eta: int, max_epochs: int) -> List[int]:
+    epochs = [min_epochs]
+    while epochs[-1] * eta < max_epochs:
+        epochs.append(epochs[-1] * eta)
+    if epochs[-1] < max_epochs:
+        epochs.append(max_epochs)
+    return epochs
+
+
+class Search(object):
+    """
+    State of the search saved in out_dir/search.json after each trial, so that an interrupted search resumes:
+    trials already evaluated at a rung are not run again.
+    """
+    def __init__(self, out_dir: str):
+        self.path = os.path.join(out_dir, 'search.json')
+        self.trials = list()
+        self.lock = threading.Lock()
+        if os.path.isfile(self.path):
+            with open(self.path) as f:
+                self.trials = json.load(f)['trials']
+
+    def save(self):
+        with self.lock:
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump({'trials': self.trials}, f, indent=1)
+            os.replace(tmp_path, self.path)
+
+    def to_frame(self) -> pd.DataFrame:
+        rows = list()
+        for trial in self.trials:
+            row = {'Trial': trial['id'], 'Status': trial['status']}
+            row.update(trial['params'])
+            for r in trial['rungs']:
+                row['dev@{}'.format(r['epochs'])] = r['metric']
+            rows.append(row)
+        frame = pd.DataFrame(rows)
+        # test results of the last rung reached by each trial
+        frame['Test'] = [','.join('{}:{:<.4f}'.format(k, v) for k, v in t['rungs'][-1]['test'].items())
+                         if len(t['rungs']) else '' for t in self.trials]
+        return frame
+
+
+def trial_command(base_cmd: str, trial: dict, out_dir: str, epochs: int, gpu: str, ckpt_secs: int) -> str:
+    command = base_cmd
+    for key, value in trial['params'].items():
+        command += ' --{} {}'.format(key, shlex.quote(str(value)))
+    # own log, model and checkpoint for each trial (default names only tell apart the logged arguments)
+    prefix = os.path.join(out_dir, 'trials', trial['id'])
+    command += ' --epoch {} --log_file {} --model_path {} --ckpt_secs {} --save_final_results 0'.format(
+        epochs, shlex.quote(prefix + '.txt'), shlex.quote(prefix + '.pt'), ckpt_secs)
+    if command.find(' --gpu ') == -1:
+        command += ' --gpu ' + gpu
+    if os.path.isfile(prefix + '.ckpt'):  # resume from the previous rung (or from a failed attempt)
+        command += ' --load 1'
+    return command
+
+
+def extend_trial(trial: dict, out_dir: str):
+    # a finished run keeps its last training state aside (.final.ckpt), put it back to resume it for a longer rung
+    prefix = os.path.join(out_dir, 'trials', trial['id'])
+    if os.path.isfile(prefix + '.final.ckpt') and not os.path.isfile(prefix + '.ckpt'):
+        os.replace(prefix + '.final.ckpt', prefix + '.ckpt')
+
+
+def main():
+    args = parse_args()
+    os.makedirs(os.path.join(args.out_dir, 'trials'), exist_ok=True)
+    search = Search(args.out_dir)
+    space = load_space(args.space)
+    if not len(search.trials):
+        check_space(args.base_cmd, space)
+        for i, params in enumerate(sample_configs(space, args.sampler, args.n_trials, args.seed)):
+            search.trials.append({'id': 'trial{:03d}'.format(i), 'params': params, 'status': 'running', 'rungs': []})
+        search.save()
+        prepare_corpus([args.base_cmd])
+    print('{} trials'.format(len(search.trials)))
+
+    if args.main_metric == '':  # the main metric of the runner, i.e., the first of the dev results by default
+        tokens = shlex.split(args.base_cmd)
+        if '--main_metric' in tokens:
+            args.main_metric = tokens[tokens.index('--main_metric') + 1]
+    rungs = rung_epochs(args.min_epochs, args.eta, args.max_epochs)
+    slots = make_slots(args.n_jobs, args.threads, args.gpu)
+    free_slots = list(range(len(slots)))
+    slot_lock = threading.Lock()
+
+    def run_trial(trial: dict, r: int):
+        with slot_lock:
+            slot_id = free_slots.pop()
+        slot = slots[slot_id]
+        try:
+            gpu = slot.gpu if slot.gpu is not None else args.gpu
+            result_file = os.path.join(args.out_dir, 'trials', '{}-rung{}.json'.format(trial['id'], r))
+            result = None
+            extend_trial(trial, args.out_dir)
+            for attempt in range(1 + args.retries):
+                command = trial_command(args.base_cmd, trial, args.out_dir, rungs[r], gpu, args.ckpt_secs)
+                print('[slot {}] rung {} ({} epochs): {}'.format(slot_id, r, rungs[r], command))
+                try:
+                    info = run_job(command, slot, result_file)
+                    if info['returncode'] == 0 and os.path.isfile(result_file):
+                        with open(result_file) as f:
+                            result = json.load(f)
+                        if 'seeds' in result:  # stacked seeds (--n_seeds): ranked by the first one
+                            result = result['seeds'][0]
+                        break
+                    print('Failed: {}{}{}'.format(command, os.linesep, os.linesep.join(info['output_tail'])))
+                except Exception:
+                    traceback.print_exc()
+            if result is None:
+                trial['status'] = 'failed'
+                return
+            metric = args.main_metric if args.main_metric != '' else list(result['dev'].keys())[0]
+            trial['rungs'].append({'rung': r, 'epochs': rungs[r], 'metric': result['dev'][metric],
+                                   'best_iter': result['best_iter'], 'train_time': result['train_time'],
+                                   'dev': result['dev'], 'test': result['test']})
+            print('{} rung {}: {}={:.4f}'.format(trial['id'], r, metric, result['dev'][metric]))
+        finally:
+            search.save()
+            with slot_lock:
+                free_slots.append(slot_id)
+
+    # Successive halving: run a rung for all the surviving trials, then keep the best 1/eta of them
+    for trial in search.trials:
+        if trial['status'] == 'failed':  # retried when the search resumes
+            trial['status'] = 'running'
+    survivors = list(search.trials)
+    for r in range(len(rungs)):
+        todo = [t for t in survivors if len(t['rungs']) <= r and t['status'] == 'running']
+        print('Rung {}: {} epochs, {} trials ({} to run)'.format(r, rungs[r], len(survivors), len(todo)))
+        with ThreadPoolExecutor(max_workers=len(slots)) as pool:
+            for future in [pool.submit(run_trial, trial, r) for trial in todo]:
+                future.result()
+        survivors = [t for t in survivors if t['status'] != 'failed' and len(t['rungs']) > r]
+        survivors.sort(key=lambda t: t['rungs'][r]['metric'], reverse=True)
+        if r == len(rungs) - 1:
+            break
+        n_keep = max(1, len(survivors) // args.eta)
+        for trial in survivors[n_keep:]:
+            if trial['status'] == 'running':
+                trial['status'] = 'pruned@{}'.format(rungs[r])
+        survivors = survivors[:n_keep]
+        search.save()
+    for trial in survivors:
+        trial['status'] = 'done'
+    search.save()
+
+    frame = search.to_frame()
+    frame.to_csv(os.path.join(args.out_dir, 'search.csv'), index=False)
+    if len(survivors):
+        best = survivors[0]
+        print('Best trial: {} {} dev={} test={}'.format(
+            best['id'], best['params'], best['rungs'][-1]['metric'], best['rungs'][-1]['test']))
+        print('Model: {}'.format(os.path.join(args.out_dir, 'trials', best['id'] + '.pt')))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+# -*- coding: UTF-8 -*-
+
+"""
+Dev/test evaluation in a background process, overlapped with the training of the next epochs.
+
+After each epoch, the trainer copies its weights into one of max_lag + 1 snapshot slots in shared memory and hands
+the slot to the evaluator process, which loads it into its own copy of the model. The trainer only waits for results
+when max_lag snapshots are still pending, so that a slot is never overwritten before its result has been consumed.
+A spawned evaluator (the case of GPU training) reopens the memory-mapped corpus cache by path (see
+BaseReader.__reduce_ex__); only the columns of the dev/test datasets are copied into it.
+"""
+
+import copy
+import queue
+import signal
+import logging
+import traceback
+import torch
+import torch.multiprocessing as mp
+
+from utils.profiling import PhaseTimer
+
+
+def _evaluation_loop(runner, model, data_dict, slots, requests, results):
+	signal.signal(signal.SIGINT, signal.SIG_IGN)  # interruptions are handled by the trainer
+	try:
+		model.to(model.device)
+		for dataset in data_dict.values():
+			dataset.model = model
+		while True:
+			request = requests.get()
+			if request is None:
+				break
+			epoch, slot, test = request
+			model.load_state_dict(slots[slot])
+			runner._check_time(start=True)
+			dev_result = runner.evaluate(data_dict['dev'], [runner.main_topk], runner.metrics)
+			test_result = runner.evaluate(data_dict['test'], runner.topk[:1], runner.metrics) if test else None
+			results.put((epoch, dev_result, test_result, runner._check_time()))
+	except Exception:
+		results.put((None, traceback.format_exc(), None, None))
+
+
+class AsyncEvaluator(object):
+	def __init__(self, runner, model, data_dict: dict, max_lag: int = 1):
+		"""
+		:param runner: provides evaluate(), a copy of it runs in the evaluator process
+		:param data_dict: datasets of the dev and test phases
+		:param max_lag: number of epochs the results may lag behind training
+		"""
+		self.max_lag = max_lag
+		self.slots = [{k: v.detach().to('cpu', copy=True).share_memory_() if torch.is_tensor(v) else v
+					   for k, v in model.state_dict().items()} for _ in range(max_lag + 1)]
+		self.pending = dict()  # epoch -> (slot, info given to submit)
+
+		runner = copy.copy(runner)
+		runner.ckpt_writer, runner.resume_state = None, None
+		runner.timer = PhaseTimer()  # the phases of the evaluator are not part of the trainer's timeline
+		data_dict = {phase: data_dict[phase] for phase in ['dev', 'test']}
+		if model.device.type == 'cpu' and 'fork' in mp.get_all_start_methods():
+			# the forked process gets copy-on-write views of the model and the corpus
+			context, eval_model = mp.get_context('fork'), model
+			self._start(context, runner, eval_model, data_dict)
+		else:
+			# CUDA cannot be forked: a CPU copy of the model is sent to the new process instead of the trained one
+			context = mp.get_context('spawn')
+			optimizer, model.optimizer = model.optimizer, None
+			eval_model = copy.deepcopy(model).cpu()
+			model.optimizer = optimizer
+			train_models = {phase: dataset.model for phase, dataset in data_dict.items()}
+			for dataset in data_dict.values():
+				dataset.model = None
+			try:
+				self._start(context, runner, eval_model, data_dict)
+			finally:
+				for phase, dataset in data_dict.items():
+					dataset.model = train_models[phase]
+
+	def _start(self, context, runner, model, data_dict):
+		self.requests, self.results = context.Queue(), context.Queue()
+		# not a daemon: the evaluator may start DataLoader workers itself
+		self.process = context.Process(target=_evaluation_loop, name='AsyncEvaluator',
+									   args=(runner, model, data_dict, self.slots, self.requests, self.results))
+		self.process.start()
+
+	def submit(self, epoch: int, model, test: bool, info=None):
+		"""
+		Snapshot the current weights of the model to evaluate them as the result of epoch
+		:param test: also evaluate the test set
+		:param info: anything to get back with the result, e.g., the training loss
+		"""
+		slot = epoch % len(self.slots)
+		assert all(s != slot for s, _ in self.pending.values()), 'too many pending evaluations'
+		with torch.no_grad():
+			for k, v in model.state_dict().items():
+				if torch.is_tensor(v):
+					self.slots[slot][k].copy_(v)
+		self.pending[epoch] = (slot, info)
+		self.requests.put((epoch, slot, test))
+
+	def _get(self, block: bool):
+		while True:
+			try:
+				epoch, dev_result, test_result, eval_time = self.results.get(timeout=1 if block else 0.01)
+			except queue.Empty:
+				if not self.process.is_alive():
+					raise RuntimeError('The evaluation process exited with code {}'.format(self.process.exitcode))
+				if block:
+					continue
+				return None
+			if epoch is None:
+				raise RuntimeError('Evaluation failed in the background process:\n' + dev_result)
+			slot, info = self.pending.pop(epoch)
+			return epoch, info, dev_result, test_result, eval_time, self.slots[slot]
+
+	def collect(self, max_pending: int = None) -> list:
+		"""
+		Results ready so far, in the order of epochs, waiting for the oldest ones until at most max_pending
+		evaluations are left (max_lag by default, 0 to wait for all of them).
+		Each result is (epoch, info, dev_result, test_result, evaluation time, weights snapshot), and the snapshot
+		stays valid until the next call of submit.
+		"""
+		max_pending = self.max_lag if max_pending is None else max_pending
+		ready = list()
+		while len(self.pending) > max_pending:
+			ready.append(self._get(block=True))
+		while len(self.pending):
+			result = self._get(block=False)
+			if result is None:
+				break
+			ready.append(result)
+		return ready
+
+	def close(self):
+		if self.process.is_alive():
+			self.requests.put(None)
+			self.process.join(timeout=5 if not len(self.pending) else 0)
+		if self.process.is_alive():  # evaluations left behind, e.g., after early stop
+			self.process.terminate()
+			self.process.join()
+		self.pending.clear()
+		logging.debug('Evaluation process closed')
@@ -0,0 +1,110 @@
+# -*- coding: UTF-8 -*-
+
+"""
+Full training-state checkpoints (weights, optimizer, progress, RNG states), written by a background thread.
+
+The training loop only pays for a copy of the tensors to CPU memory; serialization and disk writes happen
+on the writer thread. Files are written aside and renamed, so the previous checkpoint stays valid until the
+new one is complete.
+"""
+
+import os
+import random
+import logging
+import threading
+import numpy as np
+import torch
+
+
+def to_cpu(obj):
+	# detached CPU copies of all the tensors in a (nested) state dict, so that training can go on meanwhile
+	if torch.is_tensor(obj):
+		return obj.detach().to('cpu', copy=True)
+	if isinstance(obj, dict):
+		return type(obj)((k, to_cpu(v)) for k, v in obj.items())
+	if isinstance(obj, (list, tuple)):
+		return type(obj)(to_cpu(v) for v in obj)
+	return obj
+
+
+def get_rng_state() -> dict:
+	state = {
+		'python': random.getstate(),
+		'numpy': np.random.get_state(),
+		'torch': torch.get_rng_state(),
+	}
+	if torch.cuda.is_available():
+		state['cuda'] = torch.cuda.get_rng_state_all()
+	return state
+
+
+def set_rng_state(state: dict):
+	random.setstate(state['python'])
+	np.random.set_state(state['numpy'])
+	torch.set_rng_state(state['torch'])
+	if 'cuda' in state and torch.cuda.is_available():
+		torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def atomic_save(state: dict, path: str):
+	tmp_path = '{}.tmp{}'.format(path, os.getpid())
+	torch.save(state, tmp_path)
+	os.replace(tmp_path, path)
+
+
+def load(path: str, map_location='cpu'):
+	"""
+	Read a checkpoint written by CheckpointWriter (None if it does not exist)
+	"""
+	if not os.path.exists(path):
+		return None
+	try:  # RNG states are not plain tensors, which newer torch versions refuse to unpickle by default
+		return torch.load(path, map_location=map_location, weights_only=False)
+	except TypeError:  # torch < 1.13
+		return torch.load(path, map_location=map_location)
+
+
+class CheckpointWriter(object):
+	"""
+	Background writer keeping at most one pending checkpoint: if a new one is submitted before the previous one
+	is written, only the latest is kept (it supersedes the older state anyway).
+	"""
+	def __init__(self):
+		self._cond = threading.Condition()
+		self._pending = None
+		self._busy = False
+		self._thread = threading.Thread(target=self._run, name='CheckpointWriter', daemon=True)
+		self._thread.start()
+
+	def submit(self, path: str, state: dict):
+		"""
+		:param state: must not share tensors with the training loop (see to_cpu)
+		"""
+		with self._cond:
+			self._pending = (path, state)
+			self._cond.notify_all()
+
+	def wait(self):
+		# block until every submitted checkpoint is on disk
+		with self._cond:
+			while self._pending is not None or self._busy:
+				self._cond.wait()
+
+	def _run(self):
+		while True:
+			with self._cond:
+				while self._pending is None:
+					self._cond.wait()
+				(path, state), self._pending = self._pending, None
+				self._busy = True
+			try:
+				dir_path = os.path.dirname(path)
+				if dir_path:
+					os.makedirs(dir_path, exist_ok=True)
+				atomic_save(state, path)
+			except Exception:
+				logging.exception('Failed to write checkpoint {}'.format(path))
+			finally:
+				with self._cond:
+					self._busy = False
+					self._cond.notify_all()
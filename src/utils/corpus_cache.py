@@ -0,0 +1,235 @@
+# -*- coding: UTF-8 -*-
+
+"""
+Columnar on-disk format of a reader (corpus) object.
+
+A corpus is saved as a directory with a small `manifest.json` and one `.npy` file per array
+(DataFrame columns, ragged arrays, numpy attributes). Arrays are opened with `mmap_mode='r'`,
+so loading is near-instant and DataLoader workers share the same pages instead of copying them.
+Attributes that have no columnar form yet (e.g., nested dicts) are pickled into `objects.pkl`.
+List-value DataFrame columns (e.g., neg_items) are stored as ragged integer arrays (offsets + values), and loaded
+as RaggedArray in the `ragged_columns` attrs of the frame instead of a column of cells (see frame_columns).
+Objects made of arrays (e.g., utils.ragged.RaggedArray) declare them in `array_fields` to be stored column by column.
+"""
+
+import os
+import json
+import shutil
+import pickle
+import hashlib
+import importlib
+import logging
+import numpy as np
+import pandas as pd
+
+from utils.ragged import RaggedArray
+
+CACHE_VERSION = 3
+MANIFEST_FILE = 'manifest.json'
+OBJECT_FILE = 'objects.pkl'
+SOURCE_ATTR = '_cache_source'  # (cache_dir, version) of the cache a corpus was saved to or loaded from
+
+
+def data_version(prefix: str, dataset: str) -> str:
+	"""
+	Signature of the raw files of a dataset, used to detect stale caches.
+	"""
+	dataset_dir = os.path.join(prefix, dataset)
+	signature = list()
+	for name in sorted(os.listdir(dataset_dir)):
+		file_path = os.path.join(dataset_dir, name)
+		if os.path.isfile(file_path) and name.endswith('.csv'):
+			stat = os.stat(file_path)
+			signature.append('{}:{}:{}'.format(name, stat.st_size, int(stat.st_mtime)))
+	return hashlib.md5('|'.join(signature).encode('utf-8')).hexdigest()
+
+
+def read_manifest(cache_dir: str):
+	manifest_path = os.path.join(cache_dir, MANIFEST_FILE)
+	if not os.path.exists(manifest_path):
+		return None
+	with open(manifest_path, 'r') as f:
+		return json.load(f)
+
+
+def _to_json(value):
+	# convert numpy scalars and check that the value can be kept in the manifest
+	if isinstance(value, np.generic):
+		value = value.item()
+	if value is None or type(value) in [bool, int, float, str]:
+		return value
+	if type(value) in [list, tuple]:
+		return [_to_json(v) for v in value]
+	if type(value) is dict and all(type(k) is str for k in value):
+		return {k: _to_json(v) for k, v in value.items()}
+	raise TypeError
+
+
+def _save_array(arr: np.ndarray, dir_path: str, name: str) -> dict:
+	arr = np.asarray(arr)
+	file_name = name + '.npy'
+	np.save(os.path.join(dir_path, file_name), arr, allow_pickle=arr.dtype == object)
+	return {'file': file_name, 'object': bool(arr.dtype == object)}
+
+
+def _load_array(dir_path: str, info: dict, mmap: bool) -> np.ndarray:
+	file_path = os.path.join(dir_path, info['file'])
+	if info['object']:  # object arrays cannot be memory-mapped
+		return np.load(file_path, allow_pickle=True)
+	return np.load(file_path, mmap_mode='r' if mmap else None)
+
+
+def _save_arrays(container, dir_path: str, name: str) -> dict:
+	info = {'class': [type(container).__module__, type(container).__name__], 'fields': dict()}
+	for field in container.array_fields:
+		info['fields'][field] = _save_array(getattr(container, field), dir_path, '{}.{}'.format(name, field))
+	return info
+
+
+def _load_arrays(dir_path: str, info: dict, mmap: bool):
+	container_class = getattr(importlib.import_module(info['class'][0]), info['class'][1])
+	container = container_class.__new__(container_class)
+	for field, file_info in info['fields'].items():
+		setattr(container, field, _load_array(dir_path, file_info, mmap))
+	return container
+
+
+def _save_column(column: np.ndarray, dir_path: str, name: str) -> dict:
+	if column.dtype == object:  # list-value columns are stored as ragged integer arrays
+		ragged = RaggedArray.from_cells(column)
+		if ragged is not None:
+			return {'ragged': _save_arrays(ragged, dir_path, name)}
+	return _save_array(column, dir_path, name)
+
+
+def _load_column(dir_path: str, info: dict, mmap: bool):
+	if 'ragged' in info:  # rows are views of the (memory-mapped) values, no text is parsed again
+		return _load_arrays(dir_path, info['ragged'], mmap)
+	return _load_array(dir_path, info, mmap)
+
+
+def _save_frame(df: pd.DataFrame, dir_path: str, name: str) -> dict:
+	info = {'columns': [str(c) for c in df.columns], 'files': list()}
+	for idx, col in enumerate(df.columns):
+		info['files'].append(_save_column(df[col].to_numpy(), dir_path, '{}.{}'.format(name, idx)))
+	info['index'] = None
+	if not isinstance(df.index, pd.RangeIndex) or df.index.start != 0 or df.index.step != 1:
+		info['index'] = _save_array(df.index.to_numpy(), dir_path, name + '.index')
+	return info
+
+
+def _load_frame(dir_path: str, info: dict, mmap: bool) -> pd.DataFrame:
+	columns, ragged_columns = dict(), dict()
+	for col, file_info in zip(info['columns'], info['files']):
+		column = _load_column(dir_path, file_info, mmap)
+		if isinstance(column, RaggedArray):  # building a cell per row would take a Python loop over the rows
+			ragged_columns[col] = column
+		else:
+			columns[col] = column
+	index = _load_array(dir_path, info['index'], mmap) if info['index'] is not None else None
+	frame = pd.DataFrame(columns, index=index, columns=[c for c in info['columns'] if c in columns], copy=False)
+	frame.attrs['ragged_columns'] = ragged_columns
+	return frame
+
+
+def frame_columns(df: pd.DataFrame) -> dict:
+	"""
+	Columns of a corpus DataFrame as a dict of lists, where the list-value columns of a loaded cache are RaggedArray
+	(indexed by row like the lists of cells of a freshly read corpus)
+	"""
+	columns = df.to_dict('list')
+	columns.update(df.attrs.get('ragged_columns', dict()))
+	return columns
+
+
+def save(corpus, cache_dir: str, version: str = ''):
+	"""
+	Write all attributes of the corpus into cache_dir. The directory is written aside and then
+	renamed, so an interrupted save never leaves a half-written cache behind.
+	"""
+	tmp_dir = '{}.tmp{}'.format(cache_dir.rstrip(os.sep), os.getpid())
+	if os.path.exists(tmp_dir):
+		shutil.rmtree(tmp_dir)
+	os.makedirs(tmp_dir)
+
+	attributes, objects = dict(), dict()
+	for name, value in corpus.__dict__.items():
+		if name == SOURCE_ATTR:
+			continue
+		if hasattr(value, 'array_fields'):  # e.g., RaggedArray and HistoryStore
+			attributes[name] = {'kind': 'arrays', 'data': _save_arrays(value, tmp_dir, name)}
+		elif isinstance(value, np.ndarray) and value.dtype != object:
+			attributes[name] = {'kind': 'array', 'data': _save_array(value, tmp_dir, name)}
+		elif isinstance(value, pd.DataFrame):
+			attributes[name] = {'kind': 'frame', 'data': _save_frame(value, tmp_dir, name)}
+		elif type(value) is dict and len(value) and all(isinstance(v, pd.DataFrame) for v in value.values()):
+			attributes[name] = {'kind': 'frame_dict', 'data': {
+				k: _save_frame(df, tmp_dir, '{}.{}'.format(name, k)) for k, df in value.items()}}
+		else:
+			try:
+				attributes[name] = {'kind': 'json', 'data': _to_json(value)}
+			except TypeError:
+				attributes[name] = {'kind': 'object'}
+				objects[name] = value
+	if len(objects):
+		with open(os.path.join(tmp_dir, OBJECT_FILE), 'wb') as f:
+			pickle.dump(objects, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+	manifest = {
+		'version': CACHE_VERSION,
+		'reader': type(corpus).__name__,
+		'data_version': version,
+		'attributes': attributes,
+	}
+	with open(os.path.join(tmp_dir, MANIFEST_FILE), 'w') as f:
+		json.dump(manifest, f, indent=1)
+	if os.path.exists(cache_dir):
+		shutil.rmtree(cache_dir)
+	os.rename(tmp_dir, cache_dir)
+	setattr(corpus, SOURCE_ATTR, (cache_dir, version))
+
+
+def load(reader_class, cache_dir: str, version: str = '', mmap: bool = True):
+	"""
+	Open a corpus saved by `save`. Return None if the cache does not exist or is out of date.
+	"""
+	manifest = read_manifest(cache_dir)
+	if manifest is None:
+		return None
+	if manifest['version'] != CACHE_VERSION or manifest['reader'] != reader_class.__name__ \
+			or manifest['data_version'] != version:
+		logging.info('Corpus cache {} is out of date'.format(cache_dir))
+		return None
+
+	objects = dict()
+	if any(info['kind'] == 'object' for info in manifest['attributes'].values()):
+		with open(os.path.join(cache_dir, OBJECT_FILE), 'rb') as f:
+			objects = pickle.load(f)
+	corpus = reader_class.__new__(reader_class)
+	for name, info in manifest['attributes'].items():
+		kind = info['kind']
+		if kind == 'arrays':
+			value = _load_arrays(cache_dir, info['data'], mmap)
+		elif kind == 'array':
+			value = _load_array(cache_dir, info['data'], mmap)
+		elif kind == 'frame':
+			value = _load_frame(cache_dir, info['data'], mmap)
+		elif kind == 'frame_dict':
+			value = {k: _load_frame(cache_dir, v, mmap) for k, v in info['data'].items()}
+		elif kind == 'json':
+			value = info['data']
+		else:
+			value = objects[name]
+		setattr(corpus, name, value)
+	setattr(corpus, SOURCE_ATTR, (cache_dir, version))
+	return corpus
+
+
+def reopen(reader_class, cache_dir: str, version: str = ''):
+	"""
+	Load a corpus pickled by reference to its cache (see BaseReader.__reduce_ex__), e.g., in a spawned process
+	"""
+	corpus = load(reader_class, cache_dir, version)
+	if corpus is None:
+		raise RuntimeError('Corpus cache {} changed or disappeared, cannot reopen it'.format(cache_dir))
+	return corpus
@@ -0,0 +1,184 @@
+# -*- coding: UTF-8 -*-
+
+"""
+Wall-clock instrumentation of the phases of training and evaluation (data loading, host-to-device copies, forward,
+loss, backward, optimizer steps, prediction, metrics), to tell data-bound runs from compute-bound ones.
+
+PhaseTimer accumulates per-epoch totals, exported as a JSON summary, and records every phase as a complete event of
+the Chrome trace format (chrome://tracing or https://ui.perfetto.dev). A range of training steps can also be captured
+with torch.profiler, where the phases show up as labeled ranges.
+"""
+
+import os
+import json
+import logging
+import threading
+from time import perf_counter
+import torch
+
+
+class _NullPhase(object):
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		return False
+
+
+_NULL_PHASE = _NullPhase()
+
+
+class _Phase(object):
+	def __init__(self, timer, name: str):
+		self.timer, self.name = timer, name
+		self.label = None
+
+	def __enter__(self):
+		if self.timer.profiler is not None:
+			self.label = torch.profiler.record_function(self.name)
+			self.label.__enter__()
+		self.start = perf_counter()
+		return self
+
+	def __exit__(self, *exc):
+		if self.timer.sync_cuda:  # kernels are asynchronous: wait for them to charge their time to this phase
+			torch.cuda.synchronize()
+		self.timer.record(self.name, self.start, perf_counter())
+		if self.label is not None:
+			self.label.__exit__(*exc)
+		return False
+
+
+class _TimedIterable(object):
+	# times each next() of an iterable (e.g., waiting for a DataLoader), and keeps its length for tqdm
+	def __init__(self, timer, iterable, name: str, train: bool):
+		self.timer, self.iterable, self.name, self.train = timer, iterable, name, train
+
+	def __len__(self):
+		return len(self.iterable)
+
+	def __iter__(self):
+		iterator = iter(self.iterable)
+		while True:
+			start = perf_counter()
+			try:
+				item = next(iterator)
+			except StopIteration:
+				return
+			self.timer.record(self.name, start, perf_counter())
+			if self.train:
+				self.timer.step()
+			yield item
+
+
+class PhaseTimer(object):
+	def __init__(self, enabled: bool = False, profile_steps: str = '', torch_trace_path: str = None,
+				 max_trace_events: int = 1000000):
+		"""
+		:param enabled: when disabled, phase() and iterate() cost (almost) nothing
+		:param profile_steps: 'start-end', range of training steps (counted from 0 over all epochs, end excluded)
+							  captured with torch.profiler into torch_trace_path
+		:param max_trace_events: the Chrome trace stops recording beyond, while per-epoch totals stay complete
+		"""
+		self.enabled = enabled
+		self.sync_cuda = False
+		self.max_trace_events = max_trace_events
+		self.totals, self.counts = dict(), dict()
+		self.summaries, self.events = list(), list()
+		self.origin = perf_counter()
+		self.pid = os.getpid()
+
+		self.profile_range = None
+		if len(profile_steps):
+			start, end = [int(x) for x in profile_steps.split('-')]
+			self.profile_range = (start, end)
+		self.torch_trace_path = torch_trace_path
+		self.profiler = None
+		self.global_step = -1
+
+	def phase(self, name: str):
+		"""
+		Context manager timing a phase, e.g., `with timer.phase('backward'): loss.backward()`
+		"""
+		return _Phase(self, name) if self.enabled or self.profiler is not None else _NULL_PHASE
+
+	def iterate(self, iterable, name: str = 'loader_wait', train: bool = False):
+		"""
+		Wrap an iterable to time the wait for each of its items.
+		:param train: items are training steps, which drive the torch.profiler capture
+		"""
+		if not self.enabled and not (train and self.profile_range is not None):
+			return iterable
+		return _TimedIterable(self, iterable, name, train)
+
+	def record(self, name: str, start: float, end: float):
+		if not self.enabled:
+			return
+		self.totals[name] = self.totals.get(name, 0.) + end - start
+		self.counts[name] = self.counts.get(name, 0) + 1
+		if len(self.events) < self.max_trace_events:
+			self.events.append({
+				'name': name, 'cat': 'phase', 'ph': 'X', 'pid': self.pid, 'tid': threading.get_ident(),
+				'ts': (start - self.origin) * 1e6, 'dur': (end - start) * 1e6
+			})
+			if len(self.events) == self.max_trace_events:
+				logging.warning('Trace truncated after {} events'.format(self.max_trace_events))
+
+	def step(self):
+		# beginning of a training step: start/stop the torch.profiler capture at the edges of profile_range
+		self.global_step += 1
+		if self.profile_range is None:
+			return
+		start, end = self.profile_range
+		if self.global_step == start and self.profiler is None:
+			activities = [torch.profiler.ProfilerActivity.CPU]
+			if torch.cuda.is_available():
+				activities.append(torch.profiler.ProfilerActivity.CUDA)
+			self.profiler = torch.profiler.profile(activities=activities)
+			self.profiler.__enter__()
+		elif self.global_step == end and self.profiler is not None:
+			self.stop_profiler()
+
+	def stop_profiler(self):
+		if self.profiler is None:
+			return
+		self.profiler.__exit__(None, None, None)
+		if self.torch_trace_path is not None:
+			self.profiler.export_chrome_trace(self.torch_trace_path)
+			logging.info('torch.profiler trace of steps {}-{} saved to {}'.format(
+				self.profile_range[0], self.global_step, self.torch_trace_path))
+		self.profiler = None
+
+	def end_epoch(self, epoch: int, summary_path: str = None) -> dict:
+		"""
+		Close the totals of an epoch, and rewrite the JSON summary (one entry per epoch) if a path is given.
+		"""
+		if not self.enabled:
+			return dict()
+		phases = {name: {'total_s': round(total, 6), 'count': self.counts[name],
+						 'mean_ms': round(total / self.counts[name] * 1e3, 4)}
+				  for name, total in sorted(self.totals.items(), key=lambda x: -x[1])}
+		summary = {'epoch': epoch, 'phases': phases}
+		if 'fit' in self.totals and self.totals['fit'] > 0:
+			# a large share of the fit spent waiting for batches means the run is data-bound
+			summary['loader_wait_share'] = round(self.totals.get('loader_wait', 0.) / self.totals['fit'], 4)
+		self.summaries.append(summary)
+		self.totals, self.counts = dict(), dict()
+		if summary_path is not None:
+			self._dump({'epochs': self.summaries}, summary_path)
+		return summary
+
+	def export_trace(self, trace_path: str):
+		if not self.enabled:
+			return
+		self._dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, trace_path)
+		logging.info('Phase trace saved to ' + trace_path)
+
+	@staticmethod
+	def _dump(obj, path: str):
+		dir_path = os.path.dirname(path)
+		if dir_path:
+			os.makedirs(dir_path, exist_ok=True)
+		with open(path + '.tmp', 'w') as f:
+			json.dump(obj, f)
+		os.replace(path + '.tmp', path)
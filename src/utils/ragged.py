@@ -0,0 +1,281 @@
+# -*- coding: UTF-8 -*-
+
+import warnings
+import numpy as np
+import pandas as pd
+
+KEY_BASE = np.int64(1 << 32)  # (row, value) pairs are packed into row * KEY_BASE + value
+
+
+def gather_padded(values: np.ndarray, starts: np.ndarray, lengths: np.ndarray, pad_value=0) -> np.ndarray:
+	"""
+	Gather the segments values[starts[k]:starts[k]+lengths[k]] into a dense matrix right-padded with pad_value
+	(the same layout as pad_sequence with batch_first=True), with a single fancy indexing.
+	Rows of 2D values (e.g., several features per entry) are gathered into a [batch, length, n_features] array.
+	"""
+	values = np.asarray(values)
+	width = int(lengths.max()) if len(lengths) else 0
+	cols = np.arange(width)
+	mask = cols[None, :] < lengths[:, None]
+	out = values[np.where(mask, starts[:, None] + cols[None, :], 0)] if len(values) \
+		else np.zeros((len(lengths), width) + values.shape[1:], dtype=values.dtype)
+	out[~mask] = pad_value
+	return out
+
+
+class RaggedArray(object):
+	"""
+	Rows of variable length stored in CSR layout: row i is values[offsets[i]:offsets[i+1]].
+	Rows are returned as numpy views, so a memory-mapped ragged array is never copied on access.
+	"""
+	array_fields = ('offsets', 'values')  # arrays saved by utils.corpus_cache
+
+	def __init__(self, offsets: np.ndarray, values: np.ndarray):
+		self.offsets = offsets
+		self.values = values
+
+	@classmethod
+	def from_groups(cls, keys: np.ndarray, values: np.ndarray, n_rows: int,
+					sort_values=False, unique=False) -> 'RaggedArray':
+		"""
+		Group values by integer row keys without a Python loop.
+		:param keys: row index of each value
+		:param values: values to be grouped (kept in their input order within a row by default)
+		:param n_rows: total number of rows, rows without any value are empty
+		:param sort_values: sort the values inside each row (required by membership tests)
+		:param unique: drop duplicated values inside each row (implies sort_values)
+		"""
+		keys, values = np.asarray(keys, dtype=np.int64), np.asarray(values)
+		if sort_values or unique:
+			order = np.lexsort((values, keys))
+		else:
+			order = np.argsort(keys, kind='stable')
+		keys, values = keys[order], values[order]
+		if unique and len(keys):
+			keep = np.ones(len(keys), dtype=bool)
+			keep[1:] = (keys[1:] != keys[:-1]) | (values[1:] != values[:-1])
+			keys, values = keys[keep], values[keep]
+		counts = np.bincount(keys, minlength=n_rows)
+		return cls(np.concatenate([[0], np.cumsum(counts)]).astype(np.int64), values)
+
+	@classmethod
+	def from_lists(cls, rows, dtype=np.int64) -> 'RaggedArray':
+		lengths = np.fromiter((len(r) for r in rows), dtype=np.int64, count=len(rows))
+		values = np.fromiter((v for r in rows for v in r), dtype=dtype, count=lengths.sum())
+		return cls(np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64), values)
+
+	@classmethod
+	def from_cells(cls, cells):
+		"""
+		Convert a column whose cells are lists/arrays of integers, return None for any other column.
+		"""
+		if not all(type(c) in [list, tuple, np.ndarray] for c in cells):
+			return None
+		rows = [np.asarray(c) for c in cells if len(c)]
+		if any(r.ndim != 1 or r.dtype.kind not in 'iu' for r in rows):  # e.g., nested lists, floats or strings
+			return None
+		lengths = np.fromiter((len(c) for c in cells), dtype=np.int64, count=len(cells))
+		values = np.concatenate(rows).astype(np.int64) if len(rows) else np.zeros(0, dtype=np.int64)
+		return cls(np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64), values)
+
+	@classmethod
+	def from_text(cls, cells):
+		"""
+		Fast parser of list cells written as text, e.g., '[1, 2, 3]', which avoids eval() on each cell.
+		All list bodies are joined and parsed by numpy at once.
+		Return None if some cell is not a flat list of integers (the caller should fall back to eval).
+		"""
+		text = pd.Series(cells, dtype=object).astype(str).str.strip()
+		if not len(text) or not (text.str.startswith('[') & text.str.endswith(']')).all():
+			return None
+		body = text.str.slice(1, -1).str.strip()
+		lengths = np.where(body.str.len() > 0, body.str.count(',') + 1, 0).astype(np.int64)
+		joined = ','.join(body[lengths > 0])
+		try:
+			with warnings.catch_warnings():
+				warnings.simplefilter('ignore', DeprecationWarning)
+				values = np.fromstring(joined, dtype=np.int64, sep=',') if len(joined) else np.zeros(0, dtype=np.int64)
+		except ValueError:
+			return None
+		if len(values) != lengths.sum():  # unmatched data, e.g., floats, strings or nested lists
+			return None
+		return cls(np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64), values)
+
+	def __len__(self) -> int:
+		return len(self.offsets) - 1
+
+	def __getitem__(self, index: int) -> np.ndarray:
+		return self.values[self.offsets[index]:self.offsets[index + 1]]
+
+	def __iter__(self):
+		for i in range(len(self)):
+			yield self[i]
+
+	def lengths(self) -> np.ndarray:
+		return np.diff(self.offsets)
+
+	def row_ids(self) -> np.ndarray:
+		# row index of every entry in values, i.e., the COO form of the ragged array
+		return np.repeat(np.arange(len(self)), self.lengths())
+
+	def take(self, rows: np.ndarray):
+		"""
+		COO form of the given rows: for each value, the position of its row in `rows`, and the values themselves
+		"""
+		rows = np.asarray(rows, dtype=np.int64)
+		starts = self.offsets[rows]
+		lengths = self.offsets[rows + 1] - starts
+		row_index = np.repeat(np.arange(len(rows)), lengths)
+		positions = np.arange(lengths.sum()) + np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+		return row_index, self.values[positions]
+
+	def subset(self, rows: np.ndarray) -> 'RaggedArray':
+		# new ragged array made of the given rows
+		rows = np.asarray(rows, dtype=np.int64)
+		lengths = self.offsets[rows + 1] - self.offsets[rows]
+		return RaggedArray(np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64), self.take(rows)[1])
+
+	def contains(self, rows: np.ndarray, values: np.ndarray) -> np.ndarray:
+		"""
+		Batch membership test: whether values[k] appears in row rows[k].
+		Rows must be sorted (see from_groups), so that (row, value) pairs packed into int64 keys are sorted as well.
+		"""
+		keys = getattr(self, '_keys', None)
+		if keys is None:
+			keys = self._keys = self.row_ids() * KEY_BASE + self.values
+		query = np.asarray(rows, dtype=np.int64) * KEY_BASE + np.asarray(values, dtype=np.int64)
+		pos = np.searchsorted(keys, query)
+		return keys[np.minimum(pos, len(keys) - 1)] == query if len(keys) else np.zeros(len(query), dtype=bool)
+
+	def pad(self, rows: np.ndarray = None, pad_value=0) -> np.ndarray:
+		"""
+		Dense matrix of the given rows (all rows by default), right-padded to the longest one.
+		"""
+		rows = np.arange(len(self)) if rows is None else np.asarray(rows, dtype=np.int64)
+		starts = self.offsets[rows]
+		return gather_padded(self.values, starts, self.offsets[rows + 1] - starts, pad_value)
+
+	def tolist(self) -> list:
+		return [row.tolist() for row in self]
+
+	def to_cells(self, rows: np.ndarray = None) -> np.ndarray:
+		# object array whose cells are views of the given rows (all rows by default), e.g., to be a DataFrame column
+		rows = np.arange(len(self)) if rows is None else np.asarray(rows, dtype=np.int64)
+		cells = np.empty(len(rows), dtype=object)
+		values = self.values
+		for i, (start, end) in enumerate(zip(self.offsets[rows].tolist(), self.offsets[rows + 1].tolist())):
+			cells[i] = values[start:end]
+		return cells
+
+
+class HistoryStore(object):
+	"""
+	Interaction histories of all users in chronological order, stored in CSR layout:
+	the history of user u is items[offsets[u]:offsets[u+1]], with times aligned to items.
+	"""
+	array_fields = ('offsets', 'items', 'times')
+
+	def __init__(self, offsets: np.ndarray, items: np.ndarray, times: np.ndarray):
+		self.offsets = offsets
+		self.items = items
+		self.times = times
+
+	@classmethod
+	def build(cls, user_ids: np.ndarray, item_ids: np.ndarray, times: np.ndarray, n_users: int):
+		"""
+		Group interactions (already in chronological order) by user with a stable sort.
+		:return: the history store, and the position of each interaction in the history of its user
+		"""
+		user_ids = np.asarray(user_ids, dtype=np.int64)
+		order = np.argsort(user_ids, kind='stable')
+		offsets = np.concatenate([[0], np.cumsum(np.bincount(user_ids, minlength=n_users))]).astype(np.int64)
+		position = np.empty(len(user_ids), dtype=np.int64)
+		position[order] = np.arange(len(user_ids)) - offsets[user_ids[order]]
+		return cls(offsets, np.asarray(item_ids)[order], np.asarray(times)[order]), position
+
+	def __len__(self) -> int:
+		return len(self.offsets) - 1
+
+	def user_items(self, uid: int) -> np.ndarray:
+		return self.items[self.offsets[uid]:self.offsets[uid + 1]]
+
+	def user_times(self, uid: int) -> np.ndarray:
+		return self.times[self.offsets[uid]:self.offsets[uid + 1]]
+
+	def window_slice(self, uid: int, pos: int, max_len: int = 0) -> slice:
+		"""
+		Slice of the (at most max_len) latest entries before the position pos of user uid, in items, times and any
+		other array aligned with them
+		"""
+		end = self.offsets[uid] + pos
+		start = self.offsets[uid] if max_len <= 0 else max(self.offsets[uid], end - max_len)
+		return slice(start, end)
+
+	def window(self, uid: int, pos: int, max_len: int = 0):
+		"""
+		Views of the (at most max_len) latest items and times before the position pos of user uid
+		"""
+		window = self.window_slice(uid, pos, max_len)
+		return self.items[window], self.times[window]
+
+	def batch_window_bounds(self, uids: np.ndarray, pos: np.ndarray, max_len: int = 0):
+		"""
+		Batch version of window_slice: the start and the length of each window
+		"""
+		uids, pos = np.asarray(uids, dtype=np.int64), np.asarray(pos, dtype=np.int64)
+		end = self.offsets[uids] + pos
+		start = self.offsets[uids] if max_len <= 0 else np.maximum(self.offsets[uids], end - max_len)
+		return start, end - start
+
+	def batch_window(self, uids: np.ndarray, pos: np.ndarray, max_len: int = 0):
+		"""
+		Batch version of window: padded matrices of history items and times, and the history lengths
+		"""
+		start, lengths = self.batch_window_bounds(uids, pos, max_len)
+		return gather_padded(self.items, start, lengths), gather_padded(self.times, start, lengths), lengths
+
+
+class ImpressionHistoryStore(object):
+	"""
+	Positive (clicked) and negative (non-clicked) impression histories of all users, as two CSR layouts sharing
+	nothing but the user index: pos_items[pos_offsets[u]:pos_offsets[u+1]] (resp. neg_*), with times aligned to items.
+	"""
+	array_fields = ('pos_offsets', 'pos_items', 'pos_times', 'neg_offsets', 'neg_items', 'neg_times')
+
+	def __init__(self, pos: HistoryStore, neg: HistoryStore):
+		self.pos_offsets, self.pos_items, self.pos_times = pos.offsets, pos.items, pos.times
+		self.neg_offsets, self.neg_items, self.neg_times = neg.offsets, neg.items, neg.times
+
+	@classmethod
+	def build(cls, user_ids: np.ndarray, pos_items: RaggedArray, neg_items: RaggedArray, times: np.ndarray,
+			  n_users: int):
+		"""
+		Spread the items of impressions (already in chronological order) over the histories of their users.
+		:param pos_items: clicked items of each impression, neg_items: the other ones
+		:return: the history store, and the positions of each impression in the positive and negative histories of
+				 its user (i.e., the number of items of the user before it)
+		"""
+		user_ids, times = np.asarray(user_ids, dtype=np.int64), np.asarray(times)
+		stores, positions = list(), list()
+		for items in [pos_items, neg_items]:
+			lengths = items.lengths()
+			store, _ = HistoryStore.build(np.repeat(user_ids, lengths), items.values, np.repeat(times, lengths), n_users)
+			# the items of an impression start where the items of the previous impressions of its user end
+			order = np.argsort(user_ids, kind='stable')
+			ends = np.cumsum(lengths[order])
+			position = np.empty(len(user_ids), dtype=np.int64)
+			position[order] = ends - lengths[order] - store.offsets[user_ids[order]]
+			stores.append(store)
+			positions.append(position)
+		return cls(*stores), positions[0], positions[1]
+
+	@property
+	def pos(self) -> HistoryStore:
+		return HistoryStore(self.pos_offsets, self.pos_items, self.pos_times)
+
+	@property
+	def neg(self) -> HistoryStore:
+		return HistoryStore(self.neg_offsets, self.neg_items, self.neg_times)
+
+	def __len__(self) -> int:
+		return len(self.pos_offsets) - 1
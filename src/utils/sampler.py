@@ -0,0 +1,85 @@
+# -*- coding: UTF-8 -*-
+
+"""
+Vectorized negative sampling shared by the Dataset classes.
+
+Negatives of a whole epoch are drawn at once; only the entries that collide with known positives
+(e.g., a clicked item, or an existing KG triplet) are redrawn, so the cost per epoch is a few numpy
+calls instead of one Python loop iteration per instance.
+"""
+
+import numpy as np
+
+
+class AliasTable(object):
+	"""
+	Walker's alias method: O(1) sampling from a fixed discrete distribution after O(n) construction.
+	"""
+	def __init__(self, weights: np.ndarray):
+		weights = np.asarray(weights, dtype=np.float64)
+		n = len(weights)
+		prob = weights / weights.sum() * n
+		alias = np.arange(n)
+		small, large = list(np.where(prob < 1)[0]), list(np.where(prob >= 1)[0])
+		while len(small) and len(large):
+			s, l = small.pop(), large.pop()
+			alias[s] = l
+			prob[l] -= 1 - prob[s]
+			(small if prob[l] < 1 else large).append(l)
+		prob[small + large] = 1  # left-overs are only off by numerical errors
+		self.prob, self.alias = prob, alias
+
+	def sample(self, size) -> np.ndarray:
+		idx = np.random.randint(0, len(self.prob), size=size)
+		return np.where(np.random.rand(*idx.shape) < self.prob[idx], idx, self.alias[idx])
+
+
+class NegativeSampler(object):
+	"""
+	Draw ids in [low, high) uniformly or proportional to given counts (e.g., item popularity),
+	and redraw the entries rejected by a vectorized collision test.
+	"""
+	def __init__(self, high: int, low: int = 1, distribution: str = 'uniform', counts: np.ndarray = None):
+		self.low, self.high = low, high
+		self.alias = None
+		if distribution == 'pop':
+			self.alias = AliasTable(np.asarray(counts[low:high], dtype=np.float64))
+		elif distribution != 'uniform':
+			raise ValueError('Unknown negative sampling distribution: {}'.format(distribution))
+
+	def draw(self, size) -> np.ndarray:
+		if self.alias is None:
+			return np.random.randint(self.low, self.high, size=size)
+		return self.alias.sample(size) + self.low
+
+	def resample(self, candidates: np.ndarray, collide) -> np.ndarray:
+		"""
+		Redraw colliding candidates until none is left.
+		:param candidates: initial negatives of any shape
+		:param collide: function (flat index, values) -> bool array, whether the value is not a valid negative
+		                for the entry at that index of the flattened candidates
+		"""
+		shape = np.shape(candidates)
+		flat = np.array(candidates, dtype=np.int64).reshape(-1)
+		idx = np.where(collide(np.arange(len(flat)), flat))[0]
+		while len(idx):
+			flat[idx] = self.draw(len(idx))
+			idx = idx[collide(idx, flat[idx])]
+		return flat.reshape(shape)
+
+	def sample(self, user_ids: np.ndarray, n_neg: int, clicked_set) -> np.ndarray:
+		"""
+		Draw n_neg negatives for each user that are not in its row of clicked_set (a RaggedArray with sorted rows).
+		:return: [len(user_ids), n_neg]
+		"""
+		user_ids = np.asarray(user_ids, dtype=np.int64)
+		users = np.repeat(user_ids, n_neg)
+		return self.resample(self.draw((len(user_ids), n_neg)),
+							 lambda idx, values: clicked_set.contains(users[idx], values))
+
+	def sample_distinct(self, items: np.ndarray) -> np.ndarray:
+		"""
+		Draw one negative for each entry that differs from the item at the same place.
+		"""
+		items = np.asarray(items)
+		return self.resample(self.draw(items.shape), lambda idx, values: items.reshape(-1)[idx] == values)
@@ -0,0 +1,84 @@
+# -*- coding: UTF-8 -*-
+
+"""
+Candidate-order de-biasing used in training: candidates are shuffled before the forward pass, so that models cannot
+learn that the first candidate is the target, and predictions are put back in the original order for the loss.
+"""
+
+import torch
+
+
+class CandidateShuffle(object):
+	"""
+	Strategy interface: `shuffle` permutes the last axis of item_id, and `restore` applies the inverse permutation
+	to the prediction of the same batch.
+	"""
+	def shuffle(self, item_ids: torch.Tensor) -> torch.Tensor:
+		raise NotImplementedError
+
+	def restore(self, prediction: torch.Tensor) -> torch.Tensor:
+		raise NotImplementedError
+
+
+class NoShuffle(CandidateShuffle):
+	"""
+	For models scoring each candidate independently of its place in the list (e.g., dot-product heads).
+	"""
+	def shuffle(self, item_ids):
+		return item_ids
+
+	def restore(self, prediction):
+		return prediction
+
+
+class RowShuffle(CandidateShuffle):
+	"""
+	An independent permutation for each row (argsort of random keys), the most thorough and the most expensive one.
+	"""
+	def __init__(self):
+		self.indices = None
+
+	def shuffle(self, item_ids):
+		self.indices = torch.argsort(torch.rand(*item_ids.shape, device=item_ids.device), dim=-1)
+		return item_ids.gather(-1, self.indices)
+
+	def restore(self, prediction):
+		# the indices are a permutation, so every entry is written and no zero initialization is needed
+		return torch.empty_like(prediction).scatter_(-1, self.indices, prediction)
+
+
+class ColumnShuffle(CandidateShuffle):
+	"""
+	One permutation (randperm) shared by all the rows of a batch: a column gather instead of a per-row argsort.
+	The target lands in a random column in each batch, which is enough to keep it away from a fixed position.
+	"""
+	def __init__(self):
+		self.inverse = None
+
+	def shuffle(self, item_ids):
+		n_candidates = item_ids.shape[-1]
+		perm = torch.randperm(n_candidates, device=item_ids.device)
+		self.inverse = torch.empty_like(perm)
+		self.inverse[perm] = torch.arange(n_candidates, device=item_ids.device)
+		return item_ids.index_select(-1, perm)
+
+	def restore(self, prediction):
+		return prediction.index_select(-1, self.inverse)
+
+
+SHUFFLE_STRATEGIES = {
+	'row': RowShuffle,
+	'column': ColumnShuffle,
+	'none': NoShuffle,
+}
+
+
+def get_shuffle(name: str, model) -> CandidateShuffle:
+	"""
+	:param name: row, column, none, or auto (none for permutation-invariant models, row otherwise)
+	"""
+	if name == 'auto':
+		name = 'none' if getattr(model, 'permutation_invariant', False) else 'row'
+	if name not in SHUFFLE_STRATEGIES:
+		raise ValueError('Unknown candidate shuffle: {}'.format(name))
+	return SHUFFLE_STRATEGIES[name]()
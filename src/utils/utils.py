@@ -9,6 +9,8 @@ import numpy as np
 import pandas as pd
 from typing import List, Dict, NoReturn, Any
 
+from utils.ragged import RaggedArray
+
 
 def init_seed(seed):
 	random.seed(seed)
@@ -47,7 +49,11 @@ def check(check_list: List[tuple]) -> NoReturn:
 def eval_list_columns(df: pd.DataFrame) -> pd.DataFrame:
 	for col in df.columns:
 		if pd.api.types.is_string_dtype(df[col]):
-			df[col] = df[col].apply(lambda x: eval(str(x)))  # some list-value columns
+			ragged = RaggedArray.from_text(df[col].values)  # integer lists are parsed at once
+			if ragged is not None:
+				df[col] = ragged.to_cells()
+			else:
+				df[col] = df[col].apply(lambda x: eval(str(x)))  # some list-value columns
 	return df
 
 